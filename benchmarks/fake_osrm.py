@@ -0,0 +1,60 @@
+import json
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# Synthetic road model: straight line x detour factor at a flat urban speed.
+DETOUR_FACTOR = 1.35
+SPEED_KMH = 32.0
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * 6371
+
+def _parse_coords(path_part):
+    pts = [p.split(",") for p in path_part.split(";")]
+    lon = np.array([float(p[0]) for p in pts])
+    lat = np.array([float(p[1]) for p in pts])
+    return lat, lon
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.split("/")
+        # /table/v1/driving/{coords} or /route/v1/driving/{coords}
+        service, coords = parts[1], parts[-1]
+        lat, lon = _parse_coords(coords)
+        query = parse_qs(url.query)
+
+        if service == "table":
+            sources = [int(i) for i in query["sources"][0].split(";")] if "sources" in query else list(range(len(lat)))
+            dests = [int(i) for i in query["destinations"][0].split(";")] if "destinations" in query else list(range(len(lat)))
+            km = _haversine_km(lat[sources][:, None], lon[sources][:, None], lat[dests][None, :], lon[dests][None, :]) * DETOUR_FACTOR
+            body = {"code": "Ok", "distances": (km * 1000).tolist(), "durations": (km / SPEED_KMH * 3600).tolist()}
+        elif service == "route":
+            km = float((_haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:]) * DETOUR_FACTOR).sum())
+            geometry = {"type": "LineString", "coordinates": [[float(x), float(y)] for x, y in zip(lon, lat)]}
+            body = {"code": "Ok", "routes": [{"geometry": geometry, "distance": km * 1000, "duration": km / SPEED_KMH * 3600}]}
+        else:
+            body = {"code": "InvalidService"}
+
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass # keep benchmark output clean
+
+def start_fake_osrm(host="127.0.0.1", port=0):
+    """
+    Starts a local OSRM look-alike (table + route services) in a daemon thread.
+    Returns: (server, base_url). Call server.shutdown() when done.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+# Make the pipeline modules importable (same layout trick as run_benchmarks.py)
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+sys.path.append(root_dir)
+sys.path.append(os.path.join(root_dir, 'real_world_implementation'))
+
+import numpy as np
+import pandas as pd
+import distance
+from distance import create_distance_matrix
+from school_model import school_nodes
+from global_matrix import global_locations, pack_schools, fetch_groups
+from fake_osrm import start_fake_osrm
+from synthetic import make_instance, CLUSTERS
+from run_benchmarks import RESULTS_DIR
+
+# OSRM table requests and fetched cells of one matrix per school vs one shared matrix (global_matrix.py)
+# for schools whose stops overlap. Each school draws its stops from a common pool of synthetic stops;
+# the smaller the pool, the more stops the schools share. Matrices come from the fake OSRM server.
+
+def make_schools(n_schools, stops_per_school, pool, seed=0):
+    """Stage 1/2-shaped data for n_schools schools drawing stops_per_school stops each from a pool of `pool` stops."""
+    base = make_instance(pool + 1, seed=seed)
+    rng = np.random.default_rng(seed)
+    stop_ids = base['stops']['RouteStopMapIID'].to_numpy()
+    students, staff, vehicles, depots = [], [], [], {}
+    for k in range(n_schools):
+        school_id = 100 + k
+        chosen = rng.choice(stop_ids, size=min(stops_per_school, pool), replace=False)
+        for frames, key in ((students, 'students'), (staff, 'staff')):
+            frame = base[key][base[key]['PickupStopMapID'].isin(chosen)].copy()
+            frame['SchoolID'] = school_id
+            frames.append(frame)
+        fleet = base['vehicles'].copy()
+        fleet['SchoolID'] = school_id
+        vehicles.append(fleet)
+        lat, lon = CLUSTERS[k % len(CLUSTERS)][:2]
+        depots[school_id] = (lat + 0.01 * (k // len(CLUSTERS)), lon)
+    data = {'stops': base['stops'], 'students': pd.concat(students), 'staff': pd.concat(staff), 'vehicles': pd.concat(vehicles)}
+    return data, depots
+
+def table_requests(build):
+    before = distance.OSRM_REQUESTS.get("table", 0)
+    t0 = time.perf_counter()
+    build()
+    return distance.OSRM_REQUESTS.get("table", 0) - before, time.perf_counter() - t0
+
+def run_case(n_schools, stops_per_school, pool, seed):
+    data, depots = make_schools(n_schools, stops_per_school, pool, seed)
+    per_school = {"requests": 0, "cells": 0, "seconds": 0.0}
+    for school_id, (s_lat, s_lon) in depots.items():
+        last = None
+        for column in ('PickupStopMapID', 'DropStopMapID'):
+            school = school_nodes(school_id, data, s_lat, s_lon, stop_column=column)
+            if school is None: continue
+            coords = list(zip(school[0]['lat'], school[0]['lon']))
+            # The per-school path reuses the AM artifact for the PM trip when the stops are the same
+            if column == 'DropStopMapID' and coords == last: continue
+            last = coords
+            reqs, secs = table_requests(lambda: create_distance_matrix(coords, use_osrm_for_large=True))
+            per_school["requests"] += reqs
+            per_school["cells"] += len(coords) ** 2
+            per_school["seconds"] += secs
+
+    _, coords, members = global_locations(data, depots)
+    groups = pack_schools(members)
+    reqs, secs = table_requests(lambda: fetch_groups(coords, groups))
+    shared = {"requests": reqs, "locations": len(coords), "groups": len(groups), "cells": sum(len(g) ** 2 for g in groups), "seconds": secs}
+    return {"schools": n_schools, "stops_per_school": stops_per_school, "pool": pool, "per_school": per_school, "global": shared}
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-school matrices with one shared matrix for overlapping schools.")
+    parser.add_argument("--schools", type=int, nargs="+", default=[4, 8])
+    parser.add_argument("--stops", type=int, default=60, help="Stops per school")
+    parser.add_argument("--pools", type=int, nargs="+", default=[80, 160, 400], help="Size of the shared stop pool (smaller = more overlap)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=os.path.join(RESULTS_DIR, "global_matrix.json"))
+    args = parser.parse_args()
+
+    server, distance.OSRM_URL = start_fake_osrm()
+    results = []
+    try:
+        for n_schools in args.schools:
+            for pool in args.pools:
+                case = run_case(n_schools, args.stops, pool, args.seed)
+                results.append(case)
+                p, g = case["per_school"], case["global"]
+                print(f"🏫 {n_schools} schools x {args.stops} stops from a pool of {pool}: "
+                      f"per school {p['requests']} table requests / {p['cells']:,} cells ({p['seconds']:.2f}s) | "
+                      f"global {g['locations']} locations, {g['requests']} table requests / {g['cells']:,} cells, "
+                      f"{g['groups']} group(s) ({g['seconds']:.2f}s)")
+    finally:
+        server.shutdown()
+
+    os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f: json.dump(results, f, indent=2)
+    print(f"\n💾 Results stored: {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# Make the pipeline modules importable (same layout trick as 3_run_optimization.py)
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+sys.path.append(root_dir)
+sys.path.append(os.path.join(root_dir, 'real_world_implementation'))
+
+import numpy as np
+import distance
+from distance import create_distance_matrix
+from optimizer import optimize_routes
+from time_windows import parse_clock, unserved_nodes
+from time_dependent import build_td_stack, solve_time_dependent, route_etas
+from school_model import (aggregate_stop_demand, build_model_nodes, build_fleet, split_giant_stops, split_stops_by_fleet,
+                          extend_fleet_trips, build_time_windows)
+from config import DROP_PENALTY, TD_PROFILE_START, TD_BUCKET_MIN, TD_DURATION_FACTORS, SPLIT_STRATEGY
+from fake_osrm import start_fake_osrm
+from synthetic import make_instance, make_road_grid
+
+DEFAULT_SIZES = [50, 100, 250, 500, 1000, 2000, 3000]
+RESULTS_DIR = os.path.join(bench_dir, 'results')
+
+def build_case(n_nodes, seed, split_strategy=SPLIT_STRATEGY):
+    """Runs the real Stage 3 pre-processing on a synthetic school (stops split as Stage 3 does by default)."""
+    inst = make_instance(n_nodes, seed=seed)
+    school = inst['school'].iloc[0]
+    active_stops = aggregate_stop_demand(inst['stops'], inst['students'], inst['staff'])
+    df_model = build_model_nodes(active_stops, school['lat'], school['lon'])
+    fleet_list = build_fleet(inst['vehicles'])
+    split_limit = min(25, min(f['capacity'] for f in fleet_list))
+    df_model_split = split_giant_stops(df_model, split_limit) if split_strategy == "strict" else split_stops_by_fleet(df_model, fleet_list)
+    extended_fleet = extend_fleet_trips(fleet_list, df_model_split['demand'].sum())
+    return school, df_model_split, extended_fleet
+
+def timed(fn, repeat):
+    """Returns (last result, list of wall-clock seconds)."""
+    times, result = [], None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return result, times
+
+def run_case(n_nodes, args):
+    school, df_model_split, extended_fleet = build_case(n_nodes, args.seed, args.split_strategy)
+    coords = list(zip(df_model_split['lat'], df_model_split['lon']))
+    case = {"nodes": len(df_model_split), "vehicles": len(extended_fleet), "seed": args.seed, "split_strategy": args.split_strategy}
+
+    (dist_matrix, dur_matrix), times = timed(lambda: create_distance_matrix(coords, use_osrm_for_large=True, neighbours=args.neighbours), args.repeat)
+    case["matrix_s"] = statistics.median(times)
+
+    if args.road_graph:
+        case.update(run_road_graph_case(args.graph, coords, dur_matrix, args))
+
+    if n_nodes <= args.max_solve_nodes:
+        (routes, progress), times = timed(lambda: optimize_routes(
+            dur_matrix, list(df_model_split['demand']), [f['capacity'] for f in extended_fleet],
+            time_limit_s=args.time_limit, return_progress=True), 1)
+        case["solve_s"] = times[0]
+        case["routes"] = len(routes)
+        case["objective"] = progress["solutions"][-1]["objective"] if progress["solutions"] else None
+        case["first_solution_s"] = progress["first_solution_s"]
+        case["last_improvement_s"] = progress["last_improvement_s"]
+
+        if routes and n_nodes <= args.max_report_nodes:
+            from reporting import render_school_report, build_manifest
+            _, times = timed(lambda: build_manifest(school['SchoolName'], render_school_report(
+                school['SchoolName'], school['lat'], school['lon'], routes, extended_fleet,
+                df_model_split, coords, dist_matrix, dur_matrix)[1]), args.repeat)
+            case["report_s"] = statistics.median(times)
+
+    if args.time_dependent and n_nodes <= args.max_solve_nodes:
+        case.update(run_time_dependent_case(df_model_split, extended_fleet, dur_matrix, args))
+    if args.polish and n_nodes <= args.max_solve_nodes:
+        case.update(run_polish_case(df_model_split, extended_fleet, dur_matrix, args))
+    return case
+
+def run_road_graph_case(graph, coords, osrm_dur, args):
+    """Offline road-graph matrix vs. the OSRM matrix on the same stops: time and duration agreement."""
+    from road_graph import graph_matrix
+    (_, dur), times = timed(lambda: graph_matrix(graph, coords, workers=args.workers), args.repeat)
+    osrm_dur = np.asarray(osrm_dur)
+    off_diag = ~np.eye(len(coords), dtype=bool) & (osrm_dur > 0)
+    rel_err = np.abs(dur[off_diag] - osrm_dur[off_diag]) / osrm_dur[off_diag]
+    return {"graph_matrix_s": statistics.median(times), "graph_vs_osrm_dur_mape": float(rel_err.mean())}
+
+def run_time_dependent_case(df_model_split, extended_fleet, dur_matrix, args):
+    """Static vs. time-dependent solve with time windows: stack memory, solve time and ETA drift."""
+    tw = build_time_windows(df_model_split, dur_matrix, "07:30")
+    demands, capacities = list(df_model_split['demand']), [f['capacity'] for f in extended_fleet]
+    profile_start = parse_clock(TD_PROFILE_START)
+
+    t0 = time.perf_counter()
+    static_routes = optimize_routes(dur_matrix, demands, capacities, tw['windows'], tw['travel_times'],
+                                    time_limit_s=args.time_limit, drop_penalty=DROP_PENALTY)
+    tw_solve_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    stack = build_td_stack(dur_matrix, TD_DURATION_FACTORS)
+    solve_time_dependent(stack, demands, capacities, tw['windows'], tw['service'], tw['origin_min'], profile_start,
+                         TD_BUCKET_MIN, time_limit_s=args.time_limit, drop_penalty=DROP_PENALTY)
+    td_solve_s = time.perf_counter() - t0
+
+    # How far the static plan's ETAs are from what the traffic profile predicts for the same routes
+    drift = []
+    for r in static_routes:
+        nodes = [step['node'] for step in r['route']]
+        etas = route_etas(nodes, stack, tw['origin_min'] + r['route'][0]['arrival_time'], tw['service'], profile_start, TD_BUCKET_MIN)
+        drift.extend(abs(eta - tw['origin_min'] - step['arrival_time']) for step, eta in zip(r['route'], etas))
+
+    return {"tw_solve_s": tw_solve_s, "td_solve_s": td_solve_s, "td_stack_mb": stack.nbytes / 1e6,
+            "static_eta_drift_min": float(np.mean(drift)) if drift else None}
+
+def run_polish_case(df_model_split, extended_fleet, dur_matrix, args):
+    """Time-window solve at the full budget vs. half the budget followed by per-route polishing (total drive minutes)."""
+    from polish import polish_solution
+    tw = build_time_windows(df_model_split, dur_matrix, "07:30")
+    demands, capacities = list(df_model_split['demand']), [f['capacity'] for f in extended_fleet]
+    solve = lambda budget: optimize_routes(dur_matrix, demands, capacities, tw['windows'], tw['travel_times'],
+                                           time_limit_s=budget, drop_penalty=DROP_PENALTY)
+    full = solve(args.time_limit)
+    half = solve(max(1, args.time_limit // 2))
+    t0 = time.perf_counter()
+    polished, stats = polish_solution(half, dur_matrix, demands, tw['travel_times'], tw['windows'], args.workers)
+    polish_s = time.perf_counter() - t0
+    full_polished, full_stats = polish_solution(full, dur_matrix, demands, tw['travel_times'], tw['windows'], args.workers)
+    return {"full_budget_min": float(full.distance_meters.sum()) / 1000, "full_polished_min": full_stats["cost_after"],
+            "half_budget_min": stats["cost_before"], "half_polished_min": stats["cost_after"], "polish_s": polish_s,
+            "full_unserved": len(unserved_nodes(full, len(demands))), "half_unserved": len(unserved_nodes(half, len(demands))),
+            "polish_same_stops": bool(np.array_equal(np.sort(polished.nodes), np.sort(half.nodes)))}
+
+def compare(results, baseline, tolerance):
+    """Prints per-metric ratios vs. baseline. Returns list of regressions beyond tolerance."""
+    base_cases = {c["nodes"]: c for c in baseline["cases"]}
+    regressions = []
+    print(f"\n📊 Comparison vs baseline ({baseline['meta'].get('git_rev', '?')}), tolerance {tolerance:.0%}:")
+    for case in results["cases"]:
+        base = base_cases.get(case["nodes"])
+        if not base: continue
+        for metric in ("matrix_s", "graph_matrix_s", "solve_s", "report_s", "objective", "tw_solve_s", "td_solve_s", "td_stack_mb", "polish_s"):
+            if case.get(metric) is None or not base.get(metric): continue
+            ratio = case[metric] / base[metric]
+            flag = "⚠️ " if ratio > 1 + tolerance else ("✅" if ratio < 1 - tolerance else "  ")
+            print(f"   {flag} {case['nodes']:>5} nodes  {metric:<10} {base[metric]:>12.3f} -> {case[metric]:>12.3f}  (x{ratio:.2f})")
+            if ratio > 1 + tolerance:
+                regressions.append((case["nodes"], metric, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark matrix building, solving and reporting on synthetic Qatar schools.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES), help="Comma-separated node counts (depot included)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--time-limit", type=int, default=10, help="Solver budget per case (seconds)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions for matrix/report timings (median is kept)")
+    parser.add_argument("--max-solve-nodes", type=int, default=1000)
+    parser.add_argument("--max-report-nodes", type=int, default=500)
+    parser.add_argument("--out", default=os.path.join(RESULTS_DIR, "latest.json"))
+    parser.add_argument("--baseline", default=os.path.join(RESULTS_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    parser.add_argument("--time-dependent", action="store_true", help="Also benchmark the time-window and time-dependent solves")
+    parser.add_argument("--road-graph", nargs="?", const="synthetic",
+                        help="Also benchmark the offline road-graph backend: OSM extract / .csr.npz path, or a synthetic grid if no path")
+    parser.add_argument("--neighbours", type=int, default=None, help="Large cases fetch only k-nearest arcs from OSRM (rest estimated)")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for the road-graph backend and route polishing (default: all cores)")
+    parser.add_argument("--polish", action="store_true", help="Also compare full-budget solves with half-budget solves + route polishing")
+    parser.add_argument("--split-strategy", choices=["strict", "fleet"], default=SPLIT_STRATEGY, help="Stop splitting (default: the configured one)")
+    args = parser.parse_args()
+
+    if args.road_graph:
+        from road_graph import load_road_graph
+        args.graph = make_road_grid() if args.road_graph == "synthetic" else load_road_graph(args.road_graph)
+        print(f"🗺️ Road graph: {len(args.graph['lat'])} nodes, {len(args.graph['indices'])} edges")
+
+    server, distance.OSRM_URL = start_fake_osrm()
+    print(f"🧪 Fake OSRM listening on {distance.OSRM_URL}")
+
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root_dir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        rev = ""
+    results = {
+        "meta": {"git_rev": rev, "python": platform.python_version(), "machine": platform.machine(),
+                 "cpu_count": os.cpu_count(), "time_limit_s": args.time_limit, "created": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "cases": []
+    }
+
+    try:
+        for n in [int(s) for s in args.sizes.split(",")]:
+            print(f"\n⏱️  Case: {n} nodes")
+            case = run_case(n, args)
+            results["cases"].append(case)
+            if "graph_matrix_s" in case:
+                print(f"   road graph matrix {case['graph_matrix_s']:.2f}s (OSRM {case['matrix_s']:.2f}s) | duration gap vs OSRM {case['graph_vs_osrm_dur_mape']:.1%}")
+            print(f"   matrix {case['matrix_s']:.2f}s | solve {case.get('solve_s', float('nan')):.2f}s | report {case.get('report_s', float('nan')):.2f}s")
+            if "td_solve_s" in case:
+                print(f"   time windows {case['tw_solve_s']:.2f}s | time-dependent {case['td_solve_s']:.2f}s ({case['td_stack_mb']:.1f} MB stack) | static ETA drift {case['static_eta_drift_min'] or 0:.1f} min")
+            if "polish_s" in case:
+                print(f"   drive minutes: full budget {case['full_budget_min']:.1f} (polished {case['full_polished_min']:.1f}, {case['full_unserved']} unserved) | "
+                      f"half budget {case['half_budget_min']:.1f} -> polished {case['half_polished_min']:.1f} in {case['polish_s']:.2f}s ({case['half_unserved']} unserved)")
+    finally:
+        server.shutdown()
+
+    os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f: json.dump(results, f, indent=2)
+    print(f"\n💾 Results stored: {args.out}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f: json.dump(results, f, indent=2)
+        print(f"📌 Baseline updated: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n⚠️ {len(regressions)} metric(s) regressed beyond {args.tolerance:.0%}.")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+# Make the pipeline modules importable (same layout trick as run_benchmarks.py)
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+sys.path.append(root_dir)
+sys.path.append(os.path.join(root_dir, 'real_world_implementation'))
+
+import pandas as pd
+import distance
+from distance import create_distance_matrix
+from optimizer import optimize_routes
+from time_windows import unserved_nodes
+from school_model import (aggregate_stop_demand, build_model_nodes, build_fleet, split_giant_stops, split_stops_by_fleet,
+                          split_overflow, extend_fleet_trips)
+from config import DROP_PENALTY
+from fake_osrm import start_fake_osrm
+from run_benchmarks import timed, RESULTS_DIR
+
+# Node count, matrix time and solve time of the splitting strategies on the real schools
+# (real_world_implementation/data). Schools sit at the Stage 3 fallback location, matrices come
+# from the fake OSRM server, and the solve is capacity-only with drop penalties so that a
+# strategy that leaves stops without room shows up as unserved rather than as a failed solve.
+STRATEGIES = ["strict", "fleet", "fleet+lazy"]
+
+def solve(df_model_split, extended_fleet, time_limit):
+    coords = list(zip(df_model_split['lat'], df_model_split['lon']))
+    _, dur_matrix = create_distance_matrix(coords, use_osrm_for_large=True)
+    return optimize_routes(dur_matrix, list(df_model_split['demand']), [f['capacity'] for f in extended_fleet],
+                           time_limit_s=time_limit, drop_penalty=DROP_PENALTY, return_progress=True)
+
+def run_school(df_model, fleet_list, strategy, args):
+    split_limit = min(25, min(f['capacity'] for f in fleet_list))
+    df_model_split = split_giant_stops(df_model, split_limit) if strategy == "strict" else split_stops_by_fleet(df_model, fleet_list)
+    extended_fleet = extend_fleet_trips(fleet_list, df_model_split['demand'].sum())
+    coords = list(zip(df_model_split['lat'], df_model_split['lon']))
+    _, times = timed(lambda: create_distance_matrix(coords, use_osrm_for_large=True), args.repeat)
+    case = {"strategy": strategy, "nodes": len(df_model_split), "matrix_s": statistics.median(times)}
+
+    t0 = time.perf_counter()
+    routes, progress = solve(df_model_split, extended_fleet, args.time_limit)
+    dropped = unserved_nodes(routes, len(df_model_split))
+    if strategy.endswith("+lazy") and dropped:
+        df_model_split = split_overflow(df_model_split, dropped, split_limit)
+        routes, progress = solve(df_model_split, extended_fleet, args.time_limit)
+        dropped = unserved_nodes(routes, len(df_model_split))
+        case["nodes_after_lazy"] = len(df_model_split)
+    case["solve_s"] = time.perf_counter() - t0
+    case["routes"] = len(routes)
+    case["unserved"] = len(dropped)
+    case["objective"] = progress["solutions"][-1]["objective"] if progress["solutions"] else None
+    case["first_solution_s"] = progress["first_solution_s"]
+    return case
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare stop-splitting strategies on the real schools.")
+    parser.add_argument("--time-limit", type=int, default=10, help="Solver budget per solve (seconds)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions for matrix timings (median is kept)")
+    parser.add_argument("--out", default=os.path.join(RESULTS_DIR, "splitting.json"))
+    args = parser.parse_args()
+
+    data_dir = os.path.join(root_dir, 'real_world_implementation', 'data')
+    school_df = pd.read_csv(os.path.join(data_dir, 'raw_school.csv'))
+    all_stops_df = pd.read_csv(os.path.join(data_dir, 'geocoded_stops.csv'))
+    all_students_df = pd.read_csv(os.path.join(data_dir, 'raw_students.csv'))
+    all_staff_df = pd.read_csv(os.path.join(data_dir, 'raw_staff.csv'))
+    all_vehicles_df = pd.read_csv(os.path.join(data_dir, 'raw_vehicles.csv'))
+
+    server, distance.OSRM_URL = start_fake_osrm()
+    results = []
+    try:
+        for _, s_row in school_df.iterrows():
+            school_id = s_row['SchoolID']
+            school_vehicles = all_vehicles_df[all_vehicles_df['SchoolID'] == school_id]
+            active_stops = aggregate_stop_demand(all_stops_df, all_students_df[all_students_df['SchoolID'] == school_id],
+                                                 all_staff_df[all_staff_df['SchoolID'] == school_id])
+            if school_vehicles.empty or active_stops.empty: continue
+            df_model = build_model_nodes(active_stops, 25.2854, 51.5310)
+            fleet_list = build_fleet(school_vehicles)
+            print(f"\n🏫 {s_row['SchoolName']}: {len(df_model)} locations, buses {sorted({f['capacity'] for f in fleet_list})} seats")
+            for strategy in STRATEGIES:
+                case = run_school(df_model, fleet_list, strategy, args)
+                case["school"] = s_row['SchoolName']
+                results.append(case)
+                lazy = f" -> {case['nodes_after_lazy']} after lazy split" if "nodes_after_lazy" in case else ""
+                print(f"   {strategy:<11} {case['nodes']:>4} nodes{lazy} | matrix {case['matrix_s']:.2f}s | solve {case['solve_s']:.1f}s (first solution {case['first_solution_s'] or 0:.2f}s) | "
+                      f"{case['routes']} routes, {case['unserved']} unserved, objective {case['objective']}")
+    finally:
+        server.shutdown()
+
+    os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f: json.dump(results, f, indent=2)
+    print(f"\n💾 Results stored: {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+# Same bounds as Stage 2 geocoding; stops are drawn from population clusters inside them.
+QATAR_BOUNDS = {
+    'min_lat': 24.0, 'max_lat': 26.5,
+    'min_lon': 50.0, 'max_lon': 52.0
+}
+# (lat, lon, spread in degrees, weight): Doha core, Al Wakrah, Al Rayyan, Al Khor, Lusail
+CLUSTERS = [
+    (25.2854, 51.5310, 0.05, 0.45),
+    (25.1715, 51.6034, 0.03, 0.15),
+    (25.2919, 51.4244, 0.04, 0.20),
+    (25.6804, 51.4969, 0.03, 0.05),
+    (25.4200, 51.4900, 0.03, 0.15),
+]
+# Common seat counts in raw_vehicles.csv (capacity, share of fleet)
+FLEET_MIX = [(30, 0.45), (36, 0.05), (64, 0.20), (66, 0.30)]
+
+def make_instance(n_nodes, seed=0, school_id=10, max_stop_demand=25):
+    """
+    Synthetic school shaped like Stage 1/2 outputs.
+    n_nodes counts the depot, so demand per stop stays <= max_stop_demand (no splitting)
+    and the solver sees exactly n_nodes nodes.
+    Returns dict of DataFrames: school, stops (geocoded_stops.csv), students, staff, vehicles.
+    """
+    rng = np.random.default_rng(seed)
+    n_stops = n_nodes - 1
+
+    weights = np.array([c[3] for c in CLUSTERS])
+    cluster = rng.choice(len(CLUSTERS), size=n_stops, p=weights / weights.sum())
+    centers = np.array([(c[0], c[1]) for c in CLUSTERS])[cluster]
+    spread = np.array([c[2] for c in CLUSTERS])[cluster]
+    lat = np.clip(centers[:, 0] + rng.normal(0, 1, n_stops) * spread, QATAR_BOUNDS['min_lat'], QATAR_BOUNDS['max_lat'])
+    lon = np.clip(centers[:, 1] + rng.normal(0, 1, n_stops) * spread, QATAR_BOUNDS['min_lon'], QATAR_BOUNDS['max_lon'])
+
+    stop_ids = 200000 + np.arange(n_stops)
+    stops = pd.DataFrame({
+        'RouteStopMapIID': stop_ids, 'RouteID': 40000 + cluster, 'StopName': [f"SYN STOP {i}" for i in range(n_stops)],
+        'Longitude': np.nan, 'Latitude': np.nan,
+        'geocode_lat': lat, 'geocode_lon': lon, 'final_lat': lat, 'final_lon': lon
+    })
+
+    # Most stops serve a handful of passengers, a few are "giant" compound stops.
+    demand = np.clip(rng.geometric(0.35, n_stops), 1, max_stop_demand)
+    pickup = np.repeat(stop_ids, demand)
+    is_staff = rng.random(len(pickup)) < 0.1
+
+    st_pick = pickup[~is_staff]
+    students = pd.DataFrame({
+        'StudentRouteStopMapIID': np.arange(len(st_pick)), 'StudentID': 100000 + np.arange(len(st_pick)),
+        'PickupStopMapID': st_pick.astype(float), 'DropStopMapID': st_pick.astype(float), 'IsOneWay': False,
+        'PickupRouteID': np.nan, 'DropStopRouteID': np.nan, 'SchoolID': school_id, 'AcademicYearID': 10,
+        'TransportStatusID': 2.0, 'ClassID': np.nan, 'SectionID': np.nan
+    })
+    sf_pick = pickup[is_staff]
+    staff = pd.DataFrame({
+        'StaffRouteStopMapIID': np.arange(len(sf_pick)), 'StaffID': 10000 + np.arange(len(sf_pick)),
+        'PickupStopMapID': sf_pick, 'DropStopMapID': sf_pick.astype(float), 'IsOneWay': False,
+        'PickupRouteID': np.nan, 'DropStopRouteID': np.nan, 'SchoolID': school_id, 'AcademicYearID': 19.0,
+        'TransportStatusID': 1.0
+    })
+
+    caps = np.array([c[0] for c in FLEET_MIX])
+    shares = np.array([c[1] for c in FLEET_MIX])
+    n_vehicles = max(1, int(np.ceil(demand.sum() / (caps * shares).sum() * 1.15)))
+    capacity = rng.choice(caps, size=n_vehicles, p=shares)
+    vehicles = pd.DataFrame({
+        'VehicleIID': 10000 + np.arange(n_vehicles), 'VehicleRegistrationNumber': 300000 + np.arange(n_vehicles),
+        'MaximumSeatingCapacity': capacity, 'AllowSeatingCapacity': capacity, 'SchoolID': school_id
+    })
+
+    school = pd.DataFrame([{'SchoolID': school_id, 'SchoolName': f"SYNTHETIC SCHOOL {n_nodes}", 'Description': school_id,
+                            'Address1': "P. O. Box 33032, Doha", 'Place': "Doha", 'lat': 25.2854, 'lon': 51.5310}])
+    return {'school': school, 'stops': stops, 'students': students, 'staff': staff, 'vehicles': vehicles}
+
+def make_road_grid(spacing_km=0.4, arterial_every=8, seed=0):
+    """
+    Synthetic road network over the stop clusters: a jittered grid of two-way streets
+    (30 km/h) with faster arterials (60 km/h) every `arterial_every` lines.
+    Returns a road_graph graph dict, so the offline backend can be benchmarked without an OSM extract.
+    """
+    from road_graph import graph_from_edges, KM_PER_DEG
+    rng = np.random.default_rng(seed)
+    lat_min, lat_max, lon_min, lon_max = 24.95, 25.80, 51.25, 51.70
+    dlat = spacing_km / KM_PER_DEG
+    dlon = spacing_km / (KM_PER_DEG * np.cos(np.radians((lat_min + lat_max) / 2)))
+    rows, cols = int((lat_max - lat_min) / dlat) + 1, int((lon_max - lon_min) / dlon) + 1
+    r, c = np.divmod(np.arange(rows * cols), cols)
+    lat = lat_min + r * dlat + rng.normal(0, dlat * 0.1, rows * cols)
+    lon = lon_min + c * dlon + rng.normal(0, dlon * 0.1, rows * cols)
+
+    idx = np.arange(rows * cols).reshape(rows, cols)
+    east = (idx[:, :-1].ravel(), idx[:, 1:].ravel(), np.repeat(np.arange(rows) % arterial_every == 0, cols - 1))
+    north = (idx[:-1, :].ravel(), idx[1:, :].ravel(), np.tile(np.arange(cols) % arterial_every == 0, rows - 1))
+    a = np.concatenate([east[0], north[0]])
+    b = np.concatenate([east[1], north[1]])
+    speed = np.where(np.concatenate([east[2], north[2]]), 60.0, 30.0)
+    length_m = np.hypot((lat[a] - lat[b]) * KM_PER_DEG,
+                        (lon[a] - lon[b]) * KM_PER_DEG * np.cos(np.radians(lat[a]))) * 1000
+    return graph_from_edges(lat, lon, np.concatenate([a, b]), np.concatenate([b, a]),
+                            np.tile(length_m, 2), np.tile(speed, 2))
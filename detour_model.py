@@ -0,0 +1,150 @@
+import glob
+import json
+import os
+import numpy as np
+
+# Learned replacement for the flat "straight line at 30 km/h" estimate.
+# From real OSRM cells the model learns, per straight-line distance band, a detour factor
+# (road km / straight km) and an average speed, refined per region grid cell. Everything is
+# fitted in log space with bincount, so fitting and predicting are fully vectorized.
+
+DISTANCE_BANDS_KM = [0, 1, 2, 5, 10, 20, 40]
+GRID_DEG = 0.1 # Region cells of ~11 km
+MIN_CELL_SAMPLES = 30 # A region cell with this many samples gets half its own weight, half the band's
+FALLBACK_SPEED_KMH = 30.0
+
+def _band(hav_km):
+    return np.searchsorted(DISTANCE_BANDS_KM, hav_km, side="right") - 1
+
+def _group_key(lat_a, lon_a, lat_b, lon_b, band):
+    """Region cell of the trip midpoint, combined with its distance band."""
+    row = np.floor((np.asarray(lat_a) + lat_b) / 2 / GRID_DEG + 900).astype(np.int64)
+    col = np.floor((np.asarray(lon_a) + lon_b) / 2 / GRID_DEG + 1800).astype(np.int64)
+    return (row * 4000 + col) * len(DISTANCE_BANDS_KM) + band
+
+def _pair_haversine(lat_a, lon_a, lat_b, lon_b):
+    lat_a, lon_a, lat_b, lon_b = map(np.radians, (lat_a, lon_a, lat_b, lon_b))
+    h = np.sin((lat_b - lat_a) / 2) ** 2 + np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(h)) * 6371
+
+def samples_from_artifact(artifact, max_cells=None, seed=0):
+    """
+    Off-diagonal cells of a matrix artifact as 1-D arrays (lat_a, lon_a, lat_b, lon_b, dist km, dur min).
+    Cells that are themselves estimates (OSRM was down) are left out: the artifact's 'estimated' mask
+    where it has one, else cells that match the 30 km/h Haversine estimate.
+    """
+    coords = np.asarray(artifact["coords"], dtype=np.float64)
+    n = len(coords)
+    i, j = np.nonzero(~np.eye(n, dtype=bool))
+    if max_cells and len(i) > max_cells:
+        pick = np.random.default_rng(seed).choice(len(i), max_cells, replace=False)
+        i, j = i[pick], j[pick]
+    dist = np.asarray(artifact["dist"][i, j], dtype=np.float64)
+    dur = np.asarray(artifact["dur"][i, j], dtype=np.float64)
+    hav = _pair_haversine(coords[i, 0], coords[i, 1], coords[j, 0], coords[j, 1])
+    if "estimated" in artifact:
+        estimated = np.asarray(artifact["estimated"][i, j], dtype=bool)
+    else:
+        estimated = np.isclose(dist, hav, rtol=1e-4) & np.isclose(dur, hav / FALLBACK_SPEED_KMH * 60, rtol=1e-4)
+    keep = ~estimated & (dist > 0) & (dur > 0)
+    return {"lat_a": coords[i[keep], 0], "lon_a": coords[i[keep], 1], "lat_b": coords[j[keep], 0], "lon_b": coords[j[keep], 1],
+            "dist": dist[keep], "dur": dur[keep]}
+
+def samples_from_cache(cache_dir, max_cells_per_artifact=200_000):
+    """Pools the cells of every matrix artifact in a cache directory (see matrix_store.py)."""
+    from matrix_store import load_matrix_artifact
+    parts = [samples_from_artifact(load_matrix_artifact(os.path.dirname(meta)), max_cells_per_artifact)
+             for meta in sorted(glob.glob(os.path.join(cache_dir, "matrix_*", "meta.json")))]
+    if not parts: return None
+    return {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+
+def fit_detour_model(samples):
+    """
+    Fits band-level and (region cell, band)-level log detour factor and log speed.
+    Cell values are shrunk toward their band: weight n / (n + MIN_CELL_SAMPLES).
+    """
+    hav = _pair_haversine(samples["lat_a"], samples["lon_a"], samples["lat_b"], samples["lon_b"])
+    ok = hav > 0.05 # Below ~50 m the ratio is dominated by snapping noise
+    hav, dist, dur = hav[ok], samples["dist"][ok], samples["dur"][ok]
+    band = _band(hav)
+    log_factor = np.log(dist / hav)
+    log_speed = np.log(dist / (dur / 60.0))
+
+    n_bands = len(DISTANCE_BANDS_KM)
+    band_n = np.bincount(band, minlength=n_bands)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        band_factor = np.bincount(band, log_factor, n_bands) / band_n
+        band_speed = np.bincount(band, log_speed, n_bands) / band_n
+    # Bands without data borrow from the nearest band that has some (or the flat defaults)
+    filled = np.nonzero(band_n)[0]
+    if len(filled):
+        nearest = filled[np.abs(np.arange(n_bands)[:, None] - filled[None, :]).argmin(axis=1)]
+        band_factor, band_speed = band_factor[nearest], band_speed[nearest]
+    else:
+        band_factor, band_speed = np.zeros(n_bands), np.full(n_bands, np.log(FALLBACK_SPEED_KMH))
+
+    keys, inverse, counts = np.unique(_group_key(samples["lat_a"][ok], samples["lon_a"][ok], samples["lat_b"][ok], samples["lon_b"][ok], band),
+                                      return_inverse=True, return_counts=True)
+    w = counts / (counts + MIN_CELL_SAMPLES)
+    key_band = keys % n_bands
+    cell_factor = w * np.bincount(inverse, log_factor) / counts + (1 - w) * band_factor[key_band]
+    cell_speed = w * np.bincount(inverse, log_speed) / counts + (1 - w) * band_speed[key_band]
+    return {"bands_km": DISTANCE_BANDS_KM, "grid_deg": GRID_DEG, "samples": int(ok.sum()),
+            "band_log_factor": band_factor.tolist(), "band_log_speed": band_speed.tolist(),
+            "keys": keys.tolist(), "cell_log_factor": cell_factor.tolist(), "cell_log_speed": cell_speed.tolist()}
+
+def predict_pairs(model, lat_a, lon_a, lat_b, lon_b):
+    """Estimated road distance (km) and duration (minutes) for arrays of origin/destination pairs."""
+    hav = _pair_haversine(lat_a, lon_a, lat_b, lon_b)
+    band = _band(hav)
+    log_factor = np.asarray(model["band_log_factor"])[band]
+    log_speed = np.asarray(model["band_log_speed"])[band]
+    keys = np.asarray(model["keys"], dtype=np.int64)
+    if len(keys):
+        key = _group_key(lat_a, lon_a, lat_b, lon_b, band)
+        pos = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+        hit = keys[pos] == key
+        log_factor = np.where(hit, np.asarray(model["cell_log_factor"])[pos], log_factor)
+        log_speed = np.where(hit, np.asarray(model["cell_log_speed"])[pos], log_speed)
+    dist = hav * np.exp(log_factor)
+    return dist, dist / np.exp(log_speed) * 60.0
+
+def predict_matrix(model, a, b):
+    """(len(a), len(b)) estimated distance (km) and duration (minutes) matrices."""
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return predict_pairs(model, a[:, None, 0], a[:, None, 1], b[None, :, 0], b[None, :, 1])
+
+def evaluate_detour_model(model, samples):
+    """Mean absolute % error of the model and of the flat 30 km/h estimate on the given cells."""
+    dist, dur = predict_pairs(model, samples["lat_a"], samples["lon_a"], samples["lat_b"], samples["lon_b"])
+    hav = _pair_haversine(samples["lat_a"], samples["lon_a"], samples["lat_b"], samples["lon_b"])
+    mape = lambda est, real: float(np.mean(np.abs(est - real) / real))
+    return {"cells": int(len(dur)), "dist_mape": mape(dist, samples["dist"]), "dur_mape": mape(dur, samples["dur"]),
+            "flat_dist_mape": mape(hav, samples["dist"]), "flat_dur_mape": mape(hav / FALLBACK_SPEED_KMH * 60, samples["dur"])}
+
+def calibrate(samples, holdout=0.2, seed=0):
+    """Fits on (1 - holdout) of the cells, reports the error on the rest, then refits on all cells."""
+    test = np.random.default_rng(seed).random(len(samples["dist"])) < holdout
+    train_model = fit_detour_model({k: v[~test] for k, v in samples.items()})
+    model = fit_detour_model(samples)
+    model["holdout"] = evaluate_detour_model(train_model, {k: v[test] for k, v in samples.items()})
+    return model
+
+def save_detour_model(path, model):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(model, f)
+
+def load_detour_model(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def calibrate_from_cache(cache_dir, min_samples=500):
+    """
+    Fits the model on every cached matrix artifact and stores it as <cache_dir>/detour_model.json.
+    Returns the model, or None when there are too few real road cells yet.
+    """
+    samples = samples_from_cache(cache_dir) if os.path.isdir(cache_dir) else None
+    if samples is None or len(samples["dist"]) < min_samples: return None
+    model = calibrate(samples)
+    save_detour_model(os.path.join(cache_dir, "detour_model.json"), model)
+    return model
@@ -1,15 +1,12 @@
 import pandas as pd
 import os
 
-# Path to the data
-data_dir = r"d:\Antigravity\RouteOptimzation\real_world_implementation\data"
+# Path to the data (next to the pipeline scripts, wherever the repository is checked out)
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "real_world_implementation", "data")
 stops_path = os.path.join(data_dir, "geocoded_stops.csv")
 
-if not os.path.exists(stops_path):
-    print(f"File not found: {stops_path}")
-else:
-    df = pd.read_csv(stops_path)
-    
+def diagnose_stops(df):
+    """Prints coordinates shared by several StopNames and StopNames with several coordinates."""
     # Check if 'final_lat' and 'final_lon' exist, otherwise fallback to 'Latitude'
     lat_col = 'final_lat' if 'final_lat' in df.columns else 'Latitude'
     lon_col = 'final_lon' if 'final_lon' in df.columns else 'Longitude'
@@ -44,3 +41,9 @@ else:
             for c_idx, c_row in coords.iterrows():
                 print(f"   -> ({c_row[lat_col]}, {c_row[lon_col]})")
             print("-" * 30)
+
+if __name__ == "__main__":
+    if not os.path.exists(stops_path):
+        print(f"File not found: {stops_path}")
+    else:
+        diagnose_stops(pd.read_csv(stops_path))
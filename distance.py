@@ -1,8 +1,38 @@
 import math
-import requests
+import os
+import shutil
+import hashlib
+import numpy as np
 import json
-import time
 import sys
+from osrm_client import OsrmClient
+
+# Local OSRM server (override with the OSRM_URL environment variable, e.g. for benchmarks)
+OSRM_URL = os.environ.get("OSRM_URL", "http://127.0.0.1:5000")
+# Matrix backend: "osrm" (default), "graph" (offline road graph, see road_graph.py) or "haversine" (estimates only).
+# With ROAD_GRAPH_PATH set (OSM extract or cached .csr.npz), the graph also replaces the
+# Haversine estimate whenever OSRM is unreachable.
+MATRIX_BACKEND = os.environ.get("MATRIX_BACKEND", "osrm")
+ROAD_GRAPH_PATH = os.environ.get("ROAD_GRAPH_PATH", "")
+_road_graph = None
+# One OSRM client for all calls (see osrm_client.py): keep-alive connections are reused across requests
+# (and across jobs in the long-running service), timeouts follow the observed latency and a circuit
+# breaker sends every caller straight to its fallback while the server is down.
+OSRM_CLIENT = OsrmClient()
+# Requests sent per OSRM service this process (e.g. {'table': 3, 'route': 40}), for run summaries.
+OSRM_REQUESTS = OSRM_CLIENT.requests
+
+def osrm_get(url, timeout):
+    """GET on OSRM; `timeout` is the read timeout until the client has timed enough requests."""
+    return OSRM_CLIENT.get(url, timeout)
+
+def check_osrm():
+    """Startup health check of the OSRM server at OSRM_URL (opens the circuit if it is down)."""
+    if MATRIX_BACKEND != "osrm": return False
+    return OSRM_CLIENT.check_health(OSRM_URL)
+
+# Calibrated detour-factor model (see detour_model.py). None -> straight line at a flat 30 km/h.
+DETOUR_MODEL = None
 
 def haversine(lat1, lon1, lat2, lon2):
     """Fallback: Great circle distance in kilometers."""
@@ -11,26 +41,215 @@ def haversine(lat1, lon1, lat2, lon2):
     a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
     return 2 * math.asin(math.sqrt(a)) * 6371
 
-def create_distance_matrix(locations, use_osrm_for_large=False):
+def haversine_matrix(a, b):
+    """Vectorized great circle distances (km) between two lists of (lat, lon): shape (len(a), len(b))."""
+    a, b = np.radians(np.asarray(a, dtype=np.float64)), np.radians(np.asarray(b, dtype=np.float64))
+    dlat = b[None, :, 0] - a[:, None, 0]
+    dlon = b[None, :, 1] - a[:, None, 1]
+    h = np.sin(dlat / 2) ** 2 + np.cos(a[:, None, 0]) * np.cos(b[None, :, 0]) * np.sin(dlon / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(h)) * 6371
+
+def estimate_matrix(a, b):
+    """
+    Road distance (km) / duration (minutes) estimates between two lists of (lat, lon), used wherever
+    OSRM has no value: the detour model when one is calibrated, else Haversine at 30 km/h.
+    """
+    if DETOUR_MODEL is not None:
+        from detour_model import predict_matrix
+        dist, dur = predict_matrix(DETOUR_MODEL, a, b)
+    else:
+        dist = haversine_matrix(a, b)
+        dur = dist / 30.0 * 60.0
+    return dist, dur
+
+def fetch_rows_cols(locations, new_locations, chunk=90, return_estimated=False):
+    """
+    Distances/durations between new locations and an existing matrix's locations, in both
+    directions, without rebuilding the full matrix (k new nodes cost O(n * k) cells, not O(n^2)).
+    Returns: (dist_out, dist_in, dur_out, dur_in) where *_out is (k, n+k) new -> all and
+    *_in is (n+k, k) all -> new; 'all' is locations followed by new_locations. km / minutes.
+    return_estimated=True appends (est_out, est_in): True where a cell kept its estimate.
+    """
+    all_locs = list(locations) + list(new_locations)
+    k = len(new_locations)
+    # Same estimate baseline as create_distance_matrix
+    dist_out, dur_out = estimate_matrix(new_locations, all_locs)
+    dist_in, dur_in = estimate_matrix(all_locs, new_locations)
+    dist_out[np.arange(k), len(locations) + np.arange(k)] = 0.0
+    dur_out[np.arange(k), len(locations) + np.arange(k)] = 0.0
+    dist_in[len(locations) + np.arange(k), np.arange(k)] = 0.0
+    dur_in[len(locations) + np.arange(k), np.arange(k)] = 0.0
+
+    est_out, est_in = np.ones(dist_out.shape, dtype=bool), np.ones(dist_in.shape, dtype=bool)
+    est_out[np.arange(k), len(locations) + np.arange(k)] = False
+    est_in[len(locations) + np.arange(k), np.arange(k)] = False
+    failed = None
+    for start in range(0, len(all_locs), chunk):
+        block = all_locs[start:start + chunk]
+        subset = list(new_locations) + block
+        loc_string = ";".join([f"{lon},{lat}" for lat, lon in subset])
+        new_idx = ";".join(str(i) for i in range(k))
+        block_idx = ";".join(str(i) for i in range(k, len(subset)))
+        for sources, dests, out in ((new_idx, block_idx, True), (block_idx, new_idx, False)):
+            # Each request falls back on its own: a failed block keeps its estimates, the others are still fetched
+            try:
+                url = f"{OSRM_URL}/table/v1/driving/{loc_string}?sources={sources}&destinations={dests}&annotations=distance,duration"
+                data = osrm_get(url, timeout=5).json()
+            except Exception as e:
+                failed = e
+                continue
+            if data.get('code') != 'Ok':
+                failed = data.get('code')
+                continue
+            d = np.array(data['distances'], dtype=np.float64) / 1000.0
+            t = np.array(data['durations'], dtype=np.float64) / 60.0
+            cols = slice(start, start + len(block))
+            target_d, target_t, target_e = (dist_out[:, cols], dur_out[:, cols], est_out[:, cols]) if out else (dist_in[cols, :], dur_in[cols, :], est_in[cols, :])
+            np.copyto(target_d, d, where=~np.isnan(d))
+            np.copyto(target_t, t, where=~np.isnan(t))
+            target_e &= np.isnan(d) | np.isnan(t)
+    if failed is not None:
+        print(f"⚠️ OSRM failed ({failed}). Estimates kept for {int(est_out.sum() + est_in.sum())} cell(s) of {k} new node(s).")
+    if return_estimated: return dist_out, dist_in, dur_out, dur_in, est_out, est_in
+    return dist_out, dist_in, dur_out, dur_in
+
+def road_graph_matrix(locations):
+    """(distance_matrix, duration_matrix) from the offline road graph at ROAD_GRAPH_PATH (loaded once)."""
+    global _road_graph
+    from road_graph import load_road_graph, graph_matrix
+    if _road_graph is None:
+        if not ROAD_GRAPH_PATH: raise ValueError("ROAD_GRAPH_PATH is not set.")
+        _road_graph = load_road_graph(ROAD_GRAPH_PATH)
+    dist, dur = graph_matrix(_road_graph, locations)
+    print(f"✅ Success: Computed {len(locations)}x{len(locations)} matrices on the offline road graph.")
+    return dist.tolist(), dur.tolist()
+
+def _fallback_matrix(locations, dist_matrix, dur_matrix, estimated):
+    """
+    OSRM is unavailable for the cells flagged in `estimated`: they come from the offline road graph
+    if one is configured (and are unflagged), else they keep the Haversine / detour estimates.
+    """
+    if ROAD_GRAPH_PATH and estimated.any():
+        print("   ↪️ Falling back to the offline road graph.")
+        graph_dist, graph_dur = (np.asarray(m) for m in road_graph_matrix(locations))
+        dist, dur = np.asarray(dist_matrix, dtype=np.float64), np.asarray(dur_matrix, dtype=np.float64)
+        dist[estimated], dur[estimated] = graph_dist[estimated], graph_dur[estimated]
+        estimated[:] = False
+        return dist.tolist(), dur.tolist()
+    return dist_matrix, dur_matrix
+
+def fetch_neighbour_cells(locations, dist_matrix, dur_matrix, k, group=25, max_coords=100):
+    """
+    Large instances: fetches real road values only between each location and its k nearest
+    neighbours (both directions); every other arc keeps the estimate. Locations are grouped
+    spatially so one table request covers a group and its neighbours (all pairs among them).
+    Returns (dist_matrix, dur_matrix, fetched) where fetched marks the cells OSRM answered.
+    """
+    size = len(locations)
+    loc = np.asarray(locations, dtype=np.float64)
+    nearest = np.argsort(haversine_matrix(loc, loc), axis=1)[:, 1:k + 1]
+    order = np.lexsort((loc[:, 1], np.floor(loc[:, 0] / 0.05)))
+    fetched = np.zeros((size, size), dtype=bool)
+    requests_sent, failed = 0, None
+
+    for start in range(0, size, group):
+        src = order[start:start + group]
+        others = np.setdiff1d(nearest[src].ravel(), src)
+        step = max_coords - len(src)
+        for piece in range(0, max(len(others), 1), step):
+            subset = np.concatenate([src, others[piece:piece + step]])
+            loc_string = ";".join([f"{lon},{lat}" for lat, lon in loc[subset]])
+            try:
+                data = osrm_get(f"{OSRM_URL}/table/v1/driving/{loc_string}?annotations=distance,duration", timeout=20).json()
+            except Exception as e:
+                failed = e # this group keeps its estimates, the next one is still tried
+                continue
+            requests_sent += 1
+            if data.get('code') != 'Ok': continue
+            for i, a in enumerate(subset):
+                for j, b in enumerate(subset):
+                    if data['distances'][i][j] is not None:
+                        dist_matrix[a][b] = data['distances'][i][j] / 1000.0
+                    if data['durations'][i][j] is not None:
+                        dur_matrix[a][b] = data['durations'][i][j] / 60.0
+                    if data['distances'][i][j] is not None and data['durations'][i][j] is not None: fetched[a, b] = True
+    if failed is not None: print(f"⚠️ OSRM failed on some neighbour groups ({failed}).")
+    print(f"✅ Neighbour matrices for {size} nodes: {requests_sent} requests, {fetched.mean():.0%} of cells from OSRM, rest estimated.")
+    return dist_matrix, dur_matrix, fetched
+
+def _tile_key(locations, chunk):
+    rounded = np.round(np.asarray(locations, dtype=np.float64), 6)
+    return hashlib.sha1(rounded.tobytes() + str(chunk).encode()).hexdigest()
+
+def load_tiles(checkpoint_dir, key):
+    """
+    Tiles already fetched by an interrupted chunked build of the same locations: {(row_chunk, col_chunk): (dist, dur, est)}.
+    Tiles of other locations (or another chunk size) are discarded.
+    """
+    meta_path = os.path.join(checkpoint_dir, "meta.json")
+    if not os.path.exists(meta_path): return {}
+    with open(meta_path, encoding="utf-8") as f:
+        if json.load(f).get("key") != key:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            return {}
+    tiles = {}
+    for name in os.listdir(checkpoint_dir):
+        if not name.endswith(".npz"): continue
+        r, c = (int(part[1:]) for part in name[:-4].split("_"))
+        with np.load(os.path.join(checkpoint_dir, name)) as tile:
+            tiles[(r, c)] = (tile["dist"], tile["dur"], tile["est"] if "est" in tile.files else np.zeros(tile["dist"].shape, dtype=bool))
+    return tiles
+
+def save_tile(checkpoint_dir, key, total, r, c, dist, dur, est):
+    """Persists one fetched tile (written to a temporary file and renamed, so a kill never leaves half a tile)."""
+    meta_path = os.path.join(checkpoint_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        with open(meta_path, "w", encoding="utf-8") as f: json.dump({"key": key, "total": total}, f)
+    path = os.path.join(checkpoint_dir, f"r{r}_c{c}.npz")
+    with open(path + ".tmp", "wb") as f: np.savez(f, dist=dist, dur=dur, est=est)
+    os.replace(path + ".tmp", path)
+
+def tiles_complete(checkpoint_dir):
+    """True when every tile of the build was fetched (the directory can then be removed)."""
+    meta_path = os.path.join(checkpoint_dir, "meta.json")
+    if not os.path.exists(meta_path): return False
+    with open(meta_path, encoding="utf-8") as f: total = json.load(f)["total"]
+    return sum(name.endswith(".npz") for name in os.listdir(checkpoint_dir)) >= total
+
+def create_distance_matrix(locations, use_osrm_for_large=False, backend=None, neighbours=None, checkpoint_dir=None,
+                           return_estimated=False):
     """
     Creates road-accurate distance and duration matrices using OSRM Table API.
     locations: List of (lat, lon) tuples.
     use_osrm_for_large: If True, chunking will be used for schools > MAX_NODES.
-    Returns: (distance_matrix, duration_matrix) in kilometers and minutes.
+    backend: "osrm", "graph" or "haversine" (default: MATRIX_BACKEND).
+    neighbours: for schools > MAX_NODES, fetch only each node's k nearest neighbours from OSRM
+                and estimate the other arcs (far fewer requests, see fetch_neighbour_cells).
+    checkpoint_dir: chunked builds save every fetched tile there and skip the tiles already saved
+                    (an interrupted build picks up where it stopped).
+    return_estimated: also return an (n, n) boolean mask, True where a cell is an estimate rather
+                      than a road value (OSRM or the offline road graph).
+    Returns: (distance_matrix, duration_matrix[, estimated]) in kilometers and minutes.
     """
     size = len(locations)
-    if size == 0: return [], []
-    
-    # Initialize matrices with Haversine as a baseline fallback
-    dist_matrix = [[0.0] * size for _ in range(size)]
-    dur_matrix = [[0.0] * size for _ in range(size)]
+    estimated = np.ones((size, size), dtype=bool)
+    np.fill_diagonal(estimated, False)
+    def result(dist, dur):
+        return (dist, dur, estimated) if return_estimated else (dist, dur)
+
+    if size == 0: return result([], [])
+    backend = backend or MATRIX_BACKEND
+    if backend == "graph":
+        estimated[:] = False
+        return result(*road_graph_matrix(locations))
     
-    for i in range(size):
-        for j in range(size):
-            if i != j:
-                d = haversine(locations[i][0], locations[i][1], locations[j][0], locations[j][1])
-                dist_matrix[i][j] = d
-                dur_matrix[i][j] = (d / 30.0) * 60.0 # Estimate: 30km/h average
+    # Initialize matrices with the estimates as a baseline fallback (fills any None OSRM cell)
+    dist_est, dur_est = estimate_matrix(locations, locations)
+    np.fill_diagonal(dist_est, 0.0)
+    np.fill_diagonal(dur_est, 0.0)
+    dist_matrix, dur_matrix = dist_est.tolist(), dur_est.tolist()
+    if backend == "haversine": return result(dist_matrix, dur_matrix)
 
     # OSRM Table API limit
     MAX_NODES = 100 
@@ -38,8 +257,8 @@ def create_distance_matrix(locations, use_osrm_for_large=False):
     if size <= MAX_NODES:
         try:
             loc_string = ";".join([f"{lon},{lat}" for lat, lon in locations])
-            url = f"http://127.0.0.1:5000/table/v1/driving/{loc_string}?annotations=distance,duration"
-            response = requests.get(url, timeout=5)
+            url = f"{OSRM_URL}/table/v1/driving/{loc_string}?annotations=distance,duration"
+            response = osrm_get(url, timeout=5)
             data = response.json()
             if data.get('code') == 'Ok':
                 road_distances = data['distances']
@@ -50,55 +269,88 @@ def create_distance_matrix(locations, use_osrm_for_large=False):
                             dist_matrix[i][j] = road_distances[i][j] / 1000.0
                         if road_durations[i][j] is not None:
                             dur_matrix[i][j] = road_durations[i][j] / 60.0 # Convert seconds to minutes
+                        if road_distances[i][j] is not None and road_durations[i][j] is not None:
+                            estimated[i, j] = False
                 print(f"✅ Success: Fetched {size}x{size} distance/duration matrices.")
-                return dist_matrix, dur_matrix
+                return result(dist_matrix, dur_matrix)
+            print(f"⚠️ OSRM answered {data.get('code')}. Using Haversine/Estimates.")
+            return result(*_fallback_matrix(locations, dist_matrix, dur_matrix, estimated))
         except Exception as e:
             print(f"⚠️ OSRM failed ({e}). Using Haversine/Estimates.")
-            return dist_matrix, dur_matrix
+            return result(*_fallback_matrix(locations, dist_matrix, dur_matrix, estimated))
     else:
         if not use_osrm_for_large:
             print(f"ℹ️ Node count ({size}) is large. Using Haversine (use_osrm_for_large=False).")
-            return dist_matrix, dur_matrix
+            return result(dist_matrix, dur_matrix)
+        if neighbours:
+            dist_matrix, dur_matrix, fetched = fetch_neighbour_cells(locations, dist_matrix, dur_matrix, neighbours)
+            estimated &= ~fetched
+            return result(dist_matrix, dur_matrix)
 
         print(f"🚀 Processing LARGE dataset ({size} nodes). Fetching road data in chunks...")
         CHUNK = 50 # Reduced chunk size for combined annotations to avoid URL length limits
         num_chunks = (size + CHUNK - 1) // CHUNK
         total_reqs = num_chunks * num_chunks
-        completed = 0
+        completed, failed, error = 0, 0, None
+        key = _tile_key(locations, CHUNK)
+        tiles = load_tiles(checkpoint_dir, key) if checkpoint_dir else {}
+        if tiles: print(f"   ♻️ Resuming: {len(tiles)}/{total_reqs} chunks already fetched.")
         
-        try:
-            for row_chunk in range(num_chunks):
-                for col_chunk in range(num_chunks):
-                    row_start, row_end = row_chunk * CHUNK, min((row_chunk + 1) * CHUNK, size)
-                    col_start, col_end = col_chunk * CHUNK, min((col_chunk + 1) * CHUNK, size)
-                    
-                    subset_nodes = locations[row_start:row_end] + locations[col_start:col_end]
-                    sources_idx = ";".join([str(i) for i in range(len(locations[row_start:row_end]))])
-                    dest_idx = ";".join([str(i) for i in range(len(locations[row_start:row_end]), len(subset_nodes))])
-                    
-                    loc_string = ";".join([f"{lon},{lat}" for lat, lon in subset_nodes])
-                    url = f"http://127.0.0.1:5000/table/v1/driving/{loc_string}?sources={sources_idx}&destinations={dest_idx}&annotations=distance,duration"
-                    
-                    response = requests.get(url, timeout=20)
-                    data = response.json()
-                    
-                    if data.get('code') == 'Ok':
-                        dist_chunk = data['distances']
-                        dur_chunk = data['durations']
-                        for i in range(len(dist_chunk)):
-                            for j in range(len(dist_chunk[0])):
-                                if dist_chunk[i][j] is not None:
-                                    dist_matrix[row_start + i][col_start + j] = dist_chunk[i][j] / 1000.0
-                                if dur_chunk[i][j] is not None:
-                                    dur_matrix[row_start + i][col_start + j] = dur_chunk[i][j] / 60.0
-                    
+        for row_chunk in range(num_chunks):
+            for col_chunk in range(num_chunks):
+                row_start, row_end = row_chunk * CHUNK, min((row_chunk + 1) * CHUNK, size)
+                col_start, col_end = col_chunk * CHUNK, min((col_chunk + 1) * CHUNK, size)
+                if (row_chunk, col_chunk) in tiles:
+                    dist_tile, dur_tile, est_tile = tiles[(row_chunk, col_chunk)]
+                    for i in range(row_end - row_start):
+                        dist_matrix[row_start + i][col_start:col_end] = dist_tile[i].tolist()
+                        dur_matrix[row_start + i][col_start:col_end] = dur_tile[i].tolist()
+                    estimated[row_start:row_end, col_start:col_end] = est_tile
                     completed += 1
-                    sys.stdout.write(f"\r   Progress: {completed}/{total_reqs} chunks fetched... ")
-                    sys.stdout.flush()
-            
-            print(f"\n✅ Large matrices complete for {size} nodes.")
-        except Exception as e:
-            print(f"\n⚠️ OSRM failed at {completed}/{total_reqs} ({e}). Fallback used.")
+                    continue
+                
+                subset_nodes = locations[row_start:row_end] + locations[col_start:col_end]
+                sources_idx = ";".join([str(i) for i in range(len(locations[row_start:row_end]))])
+                dest_idx = ";".join([str(i) for i in range(len(locations[row_start:row_end]), len(subset_nodes))])
+                
+                loc_string = ";".join([f"{lon},{lat}" for lat, lon in subset_nodes])
+                url = f"{OSRM_URL}/table/v1/driving/{loc_string}?sources={sources_idx}&destinations={dest_idx}&annotations=distance,duration"
+                
+                # Each tile falls back on its own: a failed or timed-out tile keeps its estimates and the
+                # build goes on (while the circuit is open the remaining tiles fail without a request)
+                try:
+                    data = osrm_get(url, timeout=20).json()
+                except Exception as e:
+                    failed, error = failed + 1, e
+                    continue
+                if data.get('code') != 'Ok':
+                    # Not saved as a tile, so --resume asks OSRM again
+                    failed, error = failed + 1, data.get('code')
+                    continue
+                
+                dist_chunk = data['distances']
+                dur_chunk = data['durations']
+                for i in range(len(dist_chunk)):
+                    for j in range(len(dist_chunk[0])):
+                        if dist_chunk[i][j] is not None:
+                            dist_matrix[row_start + i][col_start + j] = dist_chunk[i][j] / 1000.0
+                        if dur_chunk[i][j] is not None:
+                            dur_matrix[row_start + i][col_start + j] = dur_chunk[i][j] / 60.0
+                        if dist_chunk[i][j] is not None and dur_chunk[i][j] is not None:
+                            estimated[row_start + i, col_start + j] = False
+                if checkpoint_dir:
+                    save_tile(checkpoint_dir, key, total_reqs, row_chunk, col_chunk,
+                              np.array([r[col_start:col_end] for r in dist_matrix[row_start:row_end]]),
+                              np.array([r[col_start:col_end] for r in dur_matrix[row_start:row_end]]),
+                              estimated[row_start:row_end, col_start:col_end])
+                
+                completed += 1
+                sys.stdout.write(f"\r   Progress: {completed}/{total_reqs} chunks fetched... ")
+                sys.stdout.flush()
+        
+        if failed:
+            print(f"\n⚠️ OSRM failed on {failed}/{total_reqs} chunks ({error}). Estimates kept for {int(estimated.sum())} cells.")
+            return result(*_fallback_matrix(locations, dist_matrix, dur_matrix, estimated))
+        print(f"\n✅ Large matrices complete for {size} nodes.")
             
-    return dist_matrix, dur_matrix
-
+    return result(dist_matrix, dur_matrix)
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from distance import create_distance_matrix, fetch_rows_cols, tiles_complete
+
+# Coordinates are matched at ~0.1 m precision when reusing an artifact.
+COORD_DECIMALS = 6
+
+def coords_hash(coords):
+    rounded = np.round(np.asarray(coords, dtype=np.float64), COORD_DECIMALS)
+    return hashlib.sha1(rounded.tobytes()).hexdigest()
+
+def save_matrix_artifact(artifact_dir, arrays, node_ids, coords, **meta):
+    """
+    Writes one .npy file per matrix (e.g. dist/dur) plus meta.json with node IDs and coordinates.
+    arrays: {name: square matrix}. Stored as float32 so large schools stay compact on disk and in RAM
+    (boolean masks such as 'estimated' stay boolean).
+    """
+    os.makedirs(artifact_dir, exist_ok=True)
+    # Written to a temporary file and renamed, so memory maps of the previous version stay valid
+    for name, matrix in arrays.items():
+        path = os.path.join(artifact_dir, f"{name}.npy")
+        matrix = np.asarray(matrix)
+        with open(path + ".tmp", "wb") as f: np.save(f, matrix if matrix.dtype == bool else matrix.astype(np.float32))
+        os.replace(path + ".tmp", path)
+    if "estimated" in arrays: meta["estimated_cells"] = int(np.count_nonzero(arrays["estimated"]))
+    meta.update({
+        "arrays": sorted(arrays),
+        "node_ids": [str(n) for n in node_ids],
+        "coords": [[float(lat), float(lon)] for lat, lon in coords],
+        "coords_hash": coords_hash(coords),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S")
+    })
+    with open(os.path.join(artifact_dir, "meta.json.tmp"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(artifact_dir, "meta.json.tmp"), os.path.join(artifact_dir, "meta.json"))
+
+def load_matrix_artifact(artifact_dir, mmap=True):
+    """
+    Loads an artifact. With mmap=True the matrices are read-only memory maps (zero copy):
+    pages are shared between processes and only touched rows are read from disk.
+    Returns: dict with one entry per array plus 'node_ids', 'coords' and 'meta'.
+    'estimated' (where present) is True for cells that are estimates rather than road values.
+    """
+    with open(os.path.join(artifact_dir, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    artifact = {"node_ids": meta["node_ids"], "coords": np.asarray(meta["coords"]), "meta": meta}
+    for name in meta["arrays"]:
+        artifact[name] = np.load(os.path.join(artifact_dir, f"{name}.npy"), mmap_mode="r" if mmap else None)
+    return artifact
+
+def report_estimates(artifact):
+    """Warns when a stored artifact holds estimated cells (they are only fetched again with a rebuild)."""
+    count = artifact["meta"].get("estimated_cells", 0)
+    if count:
+        n = len(artifact["node_ids"])
+        print(f"   ⚠️ {count} of {n * n - n} cells of this matrix are estimates (OSRM was unavailable): `cli.py matrix --rebuild` fetches them again.")
+
+def locate_rows(artifact, coords):
+    """Row index of each coordinate in the artifact (None where the location is not stored)."""
+    lookup = {tuple(c): i for i, c in enumerate(np.round(artifact["coords"], COORD_DECIMALS).tolist())}
+    return [lookup.get(tuple(c)) for c in np.round(np.asarray(coords, dtype=np.float64).reshape(-1, 2), COORD_DECIMALS).tolist()]
+
+def locate_nodes(artifact, coords):
+    """Row index of each coordinate in the artifact, or None if any coordinate is missing."""
+    idx = locate_rows(artifact, coords)
+    if any(i is None for i in idx): return None
+    return np.asarray(idx, dtype=np.intp)
+
+def submatrix(matrix, idx):
+    """
+    Square sub-matrix for the given node indices (a view when idx is the identity).
+    Stacked (buckets, n, n) arrays are sliced on their last two axes.
+    """
+    idx = np.asarray(idx, dtype=np.intp)
+    if len(idx) == matrix.shape[-1] and np.array_equal(idx, np.arange(len(idx))):
+        return matrix
+    return matrix[..., idx[:, None], idx[None, :]]
+
+def artifact_block(artifact, rows):
+    """
+    In-memory copy of the given artifact rows (and columns), in that order, with 'rows' holding the
+    artifact row of each: one copy per school, after which its nodes slice it by local index.
+    """
+    rows = np.asarray(rows, dtype=np.intp)
+    block = {name: submatrix(artifact[name], rows) for name in artifact["meta"]["arrays"]}
+    block.update({"node_ids": [artifact["node_ids"][i] for i in rows], "coords": artifact["coords"][rows], "meta": artifact["meta"], "rows": rows})
+    return block
+
+def get_or_build_matrix(artifact_dir, node_ids, coords, use_osrm_for_large=False, rebuild=False, neighbours=None, resume=False):
+    """
+    Returns the (dist, dur) artifact for these locations, building it only when needed (or when rebuild=True).
+    - Same coordinates as the stored artifact: loaded as memory maps, no OSRM calls.
+    - Coordinates are a subset of the stored ones (e.g. a stop lost its demand): sliced, no OSRM calls.
+    - Otherwise: built with create_distance_matrix (neighbours: see there) and saved for the next run.
+    Chunked builds keep every fetched tile in <artifact_dir>/tiles until all tiles are in. With resume=True
+    an unfinished build (tiles still there) is completed, fetching only the missing tiles; otherwise the
+    tiles of an earlier build are discarded before a new one.
+    The returned dict has 'rows': for each requested location, its row in the stored artifact.
+    A reused artifact that still holds estimated cells (OSRM was unavailable when it was built) is reported.
+    """
+    tiles_dir = os.path.join(artifact_dir, "tiles")
+    unfinished = resume and os.path.isdir(tiles_dir)
+    if unfinished: print("   ⏯️ Matrix build was interrupted: completing it from the saved tiles.")
+    if not rebuild and not unfinished and os.path.exists(os.path.join(artifact_dir, "meta.json")):
+        artifact = load_matrix_artifact(artifact_dir)
+        if artifact["meta"]["coords_hash"] == coords_hash(coords):
+            print(f"   ♻️ Reusing matrix artifact ({len(coords)} nodes, built {artifact['meta']['created']}).")
+            report_estimates(artifact)
+            artifact["rows"] = np.arange(len(coords))
+            return artifact
+        idx = locate_nodes(artifact, coords)
+        if idx is not None:
+            print(f"   ♻️ Reusing matrix artifact subset ({len(idx)} of {len(artifact['node_ids'])} nodes).")
+            report_estimates(artifact)
+            return artifact_block(artifact, idx)
+
+    if not resume: shutil.rmtree(tiles_dir, ignore_errors=True)
+    dist_matrix, dur_matrix, estimated = create_distance_matrix(list(coords), use_osrm_for_large=use_osrm_for_large, neighbours=neighbours,
+                                                                checkpoint_dir=tiles_dir, return_estimated=True)
+    save_matrix_artifact(artifact_dir, {"dist": dist_matrix, "dur": dur_matrix, "estimated": estimated}, node_ids, coords)
+    if tiles_complete(tiles_dir): shutil.rmtree(tiles_dir)
+    artifact = load_matrix_artifact(artifact_dir)
+    artifact["rows"] = np.arange(len(coords))
+    return artifact
+
+def extend_matrix(artifact, new_ids, new_coords):
+    """
+    In-memory copy of a loaded artifact with new locations appended, fetching only their rows and columns.
+    Existing cells are kept as-is. Any other stored array cannot be extended from a
+    single fetch and is dropped. Returns the grown artifact and the new locations' row indices.
+    """
+    n, k = len(artifact["node_ids"]), len(new_coords)
+    dist_out, dist_in, dur_out, dur_in, est_out, est_in = fetch_rows_cols([tuple(c) for c in artifact["coords"]], list(new_coords),
+                                                                          return_estimated=True)
+
+    arrays = {}
+    # Artifacts written before the estimate mask existed: their stored cells count as road values
+    old_est = artifact["estimated"] if "estimated" in artifact else np.zeros((n, n), dtype=bool)
+    for name, old, out, inc in (("dist", artifact["dist"], dist_out, dist_in), ("dur", artifact["dur"], dur_out, dur_in),
+                                ("estimated", old_est, est_out, est_in)):
+        grown = np.zeros((n + k, n + k), dtype=bool if name == "estimated" else np.float32)
+        grown[:n, :n] = old
+        grown[n:, :] = out
+        grown[:, n:] = inc
+        arrays[name] = grown
+    dropped = [name for name in artifact["meta"]["arrays"] if name not in arrays]
+    if dropped: print(f"   ⚠️ Dropping {', '.join(dropped)} from the artifact (cannot extend stacked arrays).")
+
+    node_ids = artifact["node_ids"] + [str(i) for i in new_ids]
+    coords = np.vstack([artifact["coords"], np.asarray(new_coords, dtype=np.float64).reshape(k, 2)])
+    meta = dict(artifact["meta"], arrays=sorted(arrays), estimated_cells=int(np.count_nonzero(arrays["estimated"])))
+    return dict(arrays, node_ids=node_ids, coords=coords, meta=meta), np.arange(n, n + k)
+
+def extend_matrix_artifact(artifact_dir, new_ids, new_coords):
+    """
+    Appends new locations to a stored artifact (see extend_matrix).
+    Returns the reloaded artifact and the new locations' row indices.
+    """
+    grown, new_rows = extend_matrix(load_matrix_artifact(artifact_dir), new_ids, new_coords)
+    meta = {key: v for key, v in grown["meta"].items() if key not in ("arrays", "node_ids", "coords", "coords_hash", "created", "estimated_cells")}
+    arrays = {name: grown[name] for name in grown["meta"]["arrays"]}
+    save_matrix_artifact(artifact_dir, arrays, grown["node_ids"], grown["coords"], **meta)
+    return load_matrix_artifact(artifact_dir), new_rows
+
+def match_or_extend_matrix(artifact_dir, node_ids, coords):
+    """
+    Rows of the given locations in a stored artifact. Locations it does not have yet are appended,
+    fetching only their rows and columns. Returns (artifact, rows).
+    """
+    artifact = load_matrix_artifact(artifact_dir)
+    rows = locate_rows(artifact, coords)
+    missing = [i for i, r in enumerate(rows) if r is None]
+    if missing:
+        print(f"   ➕ {len(missing)} of {len(rows)} locations are new: fetching only their rows and columns.")
+        artifact, new_rows = extend_matrix_artifact(artifact_dir, [list(node_ids)[i] for i in missing], [coords[i] for i in missing])
+        for i, r in zip(missing, new_rows): rows[i] = int(r)
+    else:
+        print(f"   ♻️ All {len(rows)} locations are in the matrix artifact: no OSRM calls.")
+    return artifact, np.asarray(rows, dtype=np.intp)
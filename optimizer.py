@@ -1,11 +1,89 @@
+import csv
+import json
+import time
+import numpy as np
 from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+from solution import RouteSolution
 
-def optimize_routes(cost_matrix, demands, capacities, time_windows=None, travel_times=None, depot_idx=0):
+def attach_solution_monitor(routing, dimension_limits):
+    """
+    Records every improving solution found during the search.
+    dimension_limits: {dimension name: per-vehicle span limit}, used to report slack.
+    Returns the progress dict that is filled while the solver runs.
+    """
+    progress = {"started_at": time.time(), "solutions": []}
+
+    def on_solution():
+        objective = routing.CostVar().Value()
+        solutions = progress["solutions"]
+        if solutions and objective >= solutions[-1]["objective"]:
+            return # GLS reports non-improving moves too; keep only the quality curve
+
+        vehicles_used = 0
+        slack = {name: 0 for name in dimension_limits}
+        for vehicle_id in range(routing.vehicles()):
+            start, end = routing.Start(vehicle_id), routing.End(vehicle_id)
+            if routing.IsEnd(routing.NextVar(start).Value()):
+                continue
+            vehicles_used += 1
+            for name, limits in dimension_limits.items():
+                dim = routing.GetDimensionOrDie(name)
+                span = dim.CumulVar(end).Min() - dim.CumulVar(start).Min()
+                slack[name] += limits[vehicle_id] - span
+
+        solutions.append({
+            "elapsed_s": round(time.time() - progress["started_at"], 3),
+            "objective": objective,
+            "vehicles_used": vehicles_used,
+            "slack": slack
+        })
+
+    routing.AddAtSolutionCallback(on_solution)
+    return progress
+
+def summarize_progress(progress, time_limit_s):
+    """Adds first-solution / last-improvement timings to a progress dict."""
+    solutions = progress["solutions"]
+    progress["time_limit_s"] = time_limit_s
+    progress["first_solution_s"] = solutions[0]["elapsed_s"] if solutions else None
+    progress["last_improvement_s"] = solutions[-1]["elapsed_s"] if solutions else None
+    # If the last improvement landed in the final 10% of the budget, GLS had not converged.
+    progress["still_improving"] = bool(solutions) and solutions[-1]["elapsed_s"] >= 0.9 * time_limit_s
+    return progress
+
+def save_search_progress(progress, path):
+    """Dumps the solution-quality curve as CSV (one row per solution) or JSON (full dict)."""
+    if path.endswith(".json"):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(progress, f, indent=2)
+        return
+
+    dim_names = sorted({name for s in progress["solutions"] for name in s["slack"]})
+    # Iterated solves (solve_time_dependent) tag each solution with its iteration
+    extra = ["iteration"] if any("iteration" in s for s in progress["solutions"]) else []
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(extra + ["elapsed_s", "objective", "vehicles_used"] + [f"slack_{name}" for name in dim_names])
+        for s in progress["solutions"]:
+            writer.writerow([s.get(k) for k in extra] + [s["elapsed_s"], s["objective"], s["vehicles_used"]] + [s["slack"].get(name, 0) for name in dim_names])
+
+def optimize_routes(cost_matrix, demands, capacities, time_windows=None, travel_times=None, depot_idx=0,
+                    time_limit_s=30, return_progress=False, drop_penalty=None):
     """
     Solves the Vehicle Routing Problem.
     - cost_matrix: The matrix used for objective minimization (can be distance or time).
     - transit_callback: Maps cost_matrix to integer weights.
+    - time_limit_s: Search budget for Guided Local Search.
+    - drop_penalty: If set, every stop may be skipped at this cost (disjunction) so that a stop
+      whose time window cannot be met is left off the routes instead of failing the whole solve.
+    - return_progress: If True, returns (routes, progress) where progress holds the
+      timestamp, objective, vehicles used and per-dimension slack of each improving solution.
+    routes is a RouteSolution (flat arrays); iterating it yields the per-route step dicts.
     """
+    # Numpy / memory-mapped matrices: materialize once so the callbacks index plain lists.
+    if hasattr(cost_matrix, "tolist"): cost_matrix = cost_matrix.tolist()
+    if hasattr(travel_times, "tolist"): travel_times = travel_times.tolist()
+
     manager = pywrapcp.RoutingIndexManager(len(cost_matrix), len(capacities), depot_idx)
     routing = pywrapcp.RoutingModel(manager)
 
@@ -32,11 +110,12 @@ def optimize_routes(cost_matrix, demands, capacities, time_windows=None, travel_
         True,  # start cumul to zero
         "Capacity",
     )
+    dimension_limits = {"Capacity": list(capacities)}
 
 
     # 3. Time Callback (Optional: Only if TW provided)
     time_dimension = None
-    if time_windows and travel_times:
+    if time_windows and travel_times is not None:
         def time_callback(from_index, to_index):
             """Returns the travel time between the two nodes."""
             from_node = manager.IndexToNode(from_index)
@@ -46,12 +125,13 @@ def optimize_routes(cost_matrix, demands, capacities, time_windows=None, travel_
         time_callback_index = routing.RegisterTransitCallback(time_callback)
         routing.AddDimension(
             time_callback_index,
-            30,  # allow waiting time (slack) up to 30 mins
+            30,  # allow waiting time (slack) up to 30 mins (polish.MAX_WAIT_MIN mirrors it)
             240, # maximum time per vehicle (4 hours)
             False, # Don't force start cumul to zero
             "Time",
         )
         time_dimension = routing.GetDimensionOrDie("Time")
+        dimension_limits["Time"] = [240] * len(capacities)
 
         # Add time window constraints
         for location_idx, time_window in enumerate(time_windows):
@@ -72,6 +152,13 @@ def optimize_routes(cost_matrix, demands, capacities, time_windows=None, travel_
             routing.AddVariableMaximizedByFinalizer(time_dimension.CumulVar(routing.Start(i)))
             routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.End(i)))
 
+    # 4. Optional stops (Disjunctions): dropped nodes are reported by the caller
+    if drop_penalty is not None:
+        for node in range(len(cost_matrix)):
+            if node == depot_idx:
+                continue
+            routing.AddDisjunction([manager.NodeToIndex(node)], int(drop_penalty))
+
     # Setting search parameters.
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
     search_parameters.first_solution_strategy = (
@@ -81,57 +168,46 @@ def optimize_routes(cost_matrix, demands, capacities, time_windows=None, travel_
     search_parameters.local_search_metaheuristic = (
         routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
     
-    # Time Limit: Give it 30 seconds to refine the solution.
+    # Time Limit: Default 30 seconds to refine the solution.
     # Increase this to 60s or 120s for even better results on large datasets.
-    search_parameters.time_limit.seconds = 30
+    search_parameters.time_limit.seconds = time_limit_s
+
+    progress = attach_solution_monitor(routing, dimension_limits) if return_progress else None
 
     # Solve the problem.
     solution = routing.SolveWithParameters(search_parameters)
 
-    # Extract routes from the solution
-    routes = []
+    # Extract routes straight into the flat solution arrays (see solution.py)
+    n_steps = len(cost_matrix) - 1 + 2 * len(capacities) # every stop at most once + start/end per vehicle
+    nodes, cost, arrival = np.empty(n_steps, dtype=np.int32), np.empty(n_steps), np.full(n_steps, np.nan)
+    offsets, vehicle_ids, distance_meters = [0], [], []
     if solution:
         for vehicle_id in range(len(capacities)):
             index = routing.Start(vehicle_id)
-            plan_output = []
+            pos = offsets[-1]
             route_distance = 0
             
-            while not routing.IsEnd(index):
-                node_index = manager.IndexToNode(index)
-                
-                step_info = {
-                    "node": node_index,
-                    "cumulative_distance": route_distance / 1000.0
-                }
-                
+            while True:
+                nodes[pos] = manager.IndexToNode(index)
+                cost[pos] = route_distance / 1000.0
                 # Add time info if available
                 if time_dimension:
-                    time_var = time_dimension.CumulVar(index)
-                    step_info["arrival_time"] = solution.Min(time_var)
-                
-                plan_output.append(step_info)
+                    arrival[pos] = solution.Min(time_dimension.CumulVar(index))
+                pos += 1
+                if routing.IsEnd(index): break # End Node recorded
                 
                 previous_index = index
                 index = solution.Value(routing.NextVar(index))
                 route_distance += routing.GetArcCostForVehicle(previous_index, index, vehicle_id)
             
-            # Add End Node
-            node_index = manager.IndexToNode(index)
-            step_info = {
-                "node": node_index,
-                "cumulative_distance": route_distance / 1000.0
-            }
-            if time_dimension:
-                time_var = time_dimension.CumulVar(index)
-                step_info["arrival_time"] = solution.Min(time_var)
-            
-            plan_output.append(step_info)
-            
-            if len(plan_output) > 2:
-                routes.append({
-                    "vehicle_id": vehicle_id,
-                    "route": plan_output,
-                    "distance_meters": route_distance
-                })
-    
+            if pos - offsets[-1] > 2:
+                offsets.append(pos)
+                vehicle_ids.append(vehicle_id)
+                distance_meters.append(route_distance)
+
+    routes = RouteSolution(nodes[:offsets[-1]], offsets, vehicle_ids, distance_meters, cost[:offsets[-1]], arrival[:offsets[-1]])
+    routes.set_loads(demands)
+
+    if return_progress:
+        return routes, summarize_progress(progress, time_limit_s)
     return routes
@@ -0,0 +1,112 @@
+import os
+import time
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+# Shared OSRM HTTP client: one pooled session, a startup health check, read timeouts that follow the
+# observed latency, and a circuit breaker. After BREAKER_FAILURES failed requests in a row the circuit
+# opens and every request fails at once (OsrmUnavailable), so callers drop straight to their fallback
+# instead of each waiting out a timeout; after BREAKER_COOLDOWN_S one trial request is let through.
+
+CONNECT_TIMEOUT_S = float(os.environ.get("OSRM_CONNECT_TIMEOUT_S", 2.0))
+MIN_TIMEOUT_S = float(os.environ.get("OSRM_MIN_TIMEOUT_S", 2.0))
+MAX_TIMEOUT_S = float(os.environ.get("OSRM_MAX_TIMEOUT_S", 30.0))
+# Read timeout = TIMEOUT_FACTOR x the slowest recent latency, scaled up to the request's size (clamped)
+TIMEOUT_FACTOR = 4.0
+LATENCY_WINDOW = 50 # recent requests per service kept for the latency estimate
+MIN_SAMPLES = 3 # until then the caller's timeout is used
+BREAKER_FAILURES = int(os.environ.get("OSRM_BREAKER_FAILURES", 3))
+BREAKER_COOLDOWN_S = float(os.environ.get("OSRM_BREAKER_COOLDOWN_S", 30.0))
+# Health probe: a two-point route in central Doha
+HEALTH_PATH = "/route/v1/driving/51.5310,25.2854;51.5320,25.2860?overview=false"
+
+class OsrmUnavailable(Exception):
+    """Raised without any network call while the circuit is open."""
+
+def request_cells(url):
+    """(service, cells) of an OSRM request: sources x destinations for /table, coordinates for /route."""
+    parts = urlsplit(url)
+    service = parts.path.split("/v1/", 1)[0].rsplit("/", 1)[-1]
+    n = parts.path.rsplit("/", 1)[-1].count(";") + 1
+    if service != "table": return service, n
+    query = parse_qs(parts.query)
+    sources = query["sources"][0].count(";") + 1 if "sources" in query else n
+    dests = query["destinations"][0].count(";") + 1 if "destinations" in query else n
+    return service, sources * dests
+
+class OsrmClient:
+    def __init__(self):
+        self.session = None
+        self.requests = {} # requests sent per service
+        self.latency = {} # service -> recent (seconds, cells)
+        self.failures = 0
+        self.open_until = 0.0
+        self.healthy = None # result of the last health check
+
+    def _session(self):
+        # requests is imported on first use, so commands that only read cached matrices start faster
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+            self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+            self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        return self.session
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def timeout(self, service, cells, default):
+        """Read timeout for a request of `cells` cells: learned from recent requests, else `default`."""
+        samples = self.latency.get(service)
+        if not samples or len(samples) < MIN_SAMPLES: return default
+        # A smaller request is assumed to take at most as long as a larger one, a larger one proportionally longer
+        expected = max(seconds * max(1.0, cells / n) for seconds, n in samples)
+        return min(MAX_TIMEOUT_S, max(MIN_TIMEOUT_S, TIMEOUT_FACTOR * expected))
+
+    def _failed(self):
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES and not self.is_open():
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN_S
+            print(f"\n   ⚡ OSRM failed {self.failures} times in a row: circuit open for {BREAKER_COOLDOWN_S:.0f}s (fallback backend used).")
+
+    def get(self, url, timeout):
+        """
+        GET with the adaptive read timeout (`timeout` until enough requests were timed).
+        Raises OsrmUnavailable while the circuit is open; timeouts, connection errors and 5xx answers count as failures.
+        """
+        if self.is_open(): raise OsrmUnavailable(f"circuit open for another {self.open_until - time.monotonic():.0f}s")
+        service, cells = request_cells(url)
+        self.requests[service] = self.requests.get(service, 0) + 1
+        t0 = time.perf_counter()
+        try:
+            response = self._session().get(url, timeout=(CONNECT_TIMEOUT_S, self.timeout(service, cells, timeout)))
+        except Exception:
+            self._failed()
+            raise
+        if response.status_code >= 500:
+            self._failed()
+            raise OsrmUnavailable(f"HTTP {response.status_code}")
+        self.failures = 0
+        self.latency.setdefault(service, deque(maxlen=LATENCY_WINDOW)).append((time.perf_counter() - t0, cells))
+        return response
+
+    def check_health(self, base_url):
+        """
+        One probe request with short timeouts. An unreachable server opens the circuit right away,
+        so a run without OSRM goes straight to the fallback backend. Returns True if OSRM answered.
+        """
+        t0 = time.perf_counter()
+        try:
+            response = self._session().get(base_url + HEALTH_PATH, timeout=(CONNECT_TIMEOUT_S, MIN_TIMEOUT_S))
+            self.healthy = response.status_code < 500 and response.json().get("code") == "Ok"
+            problem = f"answered {response.json().get('code', response.status_code)}"
+        except Exception as e:
+            self.healthy, problem = False, type(e).__name__
+        if self.healthy:
+            self.failures, self.open_until = 0, 0.0
+            print(f"🩺 OSRM is up at {base_url} ({(time.perf_counter() - t0) * 1000:.0f} ms).")
+        else:
+            self.failures, self.open_until = BREAKER_FAILURES, time.monotonic() + BREAKER_COOLDOWN_S
+            print(f"⚠️ OSRM at {base_url} failed the health check ({problem}): using the fallback backend, "
+                  f"estimated cells are marked in the matrices.")
+        return self.healthy
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from solution import RouteSolution
+
+# Intra-route polishing after the global solve. Once stops are assigned to buses every route is a
+# small TSP with a fixed depot at both ends, so each one is improved on its own (2-opt segment
+# reversals and Or-opt moves of 1-3 consecutive stops) over its slice of the cost matrix.
+# All moves of one kind are scored at once with numpy; the best improving move that keeps the
+# time windows is applied, until no move improves. Reordering stops never changes a route's load,
+# so capacity stays feasible by construction.
+
+MAX_OR_OPT_SEGMENT = 3
+ROUTE_SPAN_MIN = 240 # Same limit as the solver's Time dimension
+MAX_WAIT_MIN = 30 # Same waiting slack per stop as the solver's Time dimension
+MAX_CHECKS_PER_ROUND = 64 # Improving moves tried (best first) before giving up on a round
+EPS = 1e-9
+
+def route_times(seq, travel, windows, start):
+    """
+    Arrival at each step as the solver's Time dimension computes it (buses wait for a window to open,
+    at most MAX_WAIT_MIN per stop). seq, travel and windows are local to one route. Returns (arrivals, feasible).
+    """
+    t, arrivals, feasible = float(start), [float(start)], True
+    for a, b in zip(seq[:-1], seq[1:]):
+        reach = t + travel[a, b]
+        t = max(reach, windows[b, 0])
+        arrivals.append(t)
+        feasible = feasible and t <= windows[b, 1] and t - reach <= MAX_WAIT_MIN
+    return arrivals, feasible and arrivals[-1] - arrivals[0] <= ROUTE_SPAN_MIN
+
+def _two_opt_moves(seq, cost):
+    """(delta, new sequence) of improving segment reversals, best first."""
+    m = len(seq)
+    fwd, bwd = cost[seq[:-1], seq[1:]], cost[seq[1:], seq[:-1]]
+    F, B = np.concatenate([[0.0], np.cumsum(fwd)]), np.concatenate([[0.0], np.cumsum(bwd)])
+    i, j = np.arange(1, m - 1)[:, None], np.arange(1, m - 1)[None, :]
+    ic, jc = np.minimum(i, j), np.maximum(i, j) # valid pairs are masked below; this keeps the indexing in range
+    delta = (cost[seq[ic - 1], seq[jc]] + cost[seq[ic], seq[jc + 1]] - fwd[ic - 1] - fwd[jc]
+             + (B[jc] - B[ic]) - (F[jc] - F[ic]))
+    delta = np.where(j > i, delta, np.inf)
+    for flat in np.argsort(delta, axis=None)[:MAX_CHECKS_PER_ROUND]:
+        if delta.flat[flat] >= -EPS: return
+        a, b = np.unravel_index(flat, delta.shape)
+        a, b = a + 1, b + 1
+        yield delta.flat[flat], np.concatenate([seq[:a], seq[a:b + 1][::-1], seq[b + 1:]])
+
+def _or_opt_moves(seq, cost):
+    """(delta, new sequence) of improving moves of a 1-3 stop segment to another position, best first."""
+    m = len(seq)
+    fwd = cost[seq[:-1], seq[1:]]
+    candidates = []
+    for length in range(1, min(MAX_OR_OPT_SEGMENT, m - 2) + 1):
+        i = np.arange(1, m - length)[:, None] # segment seq[i : i + length]
+        e = i + length - 1
+        q = np.arange(m - 1)[None, :] # insert between seq[q] and seq[q + 1]
+        removed = fwd[i - 1] + fwd[e] - cost[seq[i - 1], seq[e + 1]]
+        added = cost[seq[q], seq[i]] + cost[seq[e], seq[q + 1]] - fwd[q]
+        delta = np.where((q < i - 1) | (q > e), added - removed, np.inf)
+        for flat in np.argsort(delta, axis=None)[:MAX_CHECKS_PER_ROUND]:
+            if delta.flat[flat] >= -EPS: break
+            a, b = np.unravel_index(flat, delta.shape)
+            candidates.append((delta.flat[flat], a + 1, length, b))
+    for d, start, length, q in sorted(candidates)[:MAX_CHECKS_PER_ROUND]:
+        segment, rest = seq[start:start + length], np.concatenate([seq[:start], seq[start + length:]])
+        pos = q + 1 if q < start else q + 1 - length
+        yield d, np.concatenate([rest[:pos], segment, rest[pos:]])
+
+def polish_route(cost, travel=None, windows=None, start=0.0, max_rounds=200):
+    """
+    Improves one route given as local matrices: step k of the route is row / column k, so the
+    current order is 0, 1, ..., m-1 (depot first and last). Returns the new order of the steps.
+    travel / windows: the route's Time-dimension transit times and windows; None skips the check.
+    """
+    seq = np.arange(cost.shape[0])
+    if len(seq) < 4: return seq
+    for _ in range(max_rounds):
+        improved = False
+        for moves in (_two_opt_moves, _or_opt_moves):
+            for _, candidate in moves(seq, cost):
+                if travel is None or route_times(candidate, travel, windows, start)[1]:
+                    seq, improved = candidate, True
+                    break
+        if not improved: break
+    return seq
+
+def _polish_task(task):
+    return polish_route(*task)
+
+def polish_solution(routes, cost_matrix, demands, travel_times=None, time_windows=None, workers=1):
+    """
+    Polishes every route of a RouteSolution, in parallel when workers > 1 (0 = all cores).
+    cost_matrix: the solver objective (e.g. durations); travel_times / time_windows as passed to optimize_routes.
+    Returns (polished RouteSolution, stats dict with total cost before / after and routes improved).
+    """
+    cost_matrix = np.asarray(cost_matrix, dtype=np.float64)
+    windows = np.asarray(time_windows, dtype=np.float64) if time_windows is not None else None
+    tasks, seqs, arrivals = [], [], []
+    for r in range(len(routes)):
+        route = routes.route(r)
+        seq = route["nodes"].astype(np.intp)
+        seqs.append(seq)
+        arrivals.append(route["arrival"])
+        local = np.ix_(seq, seq)
+        tasks.append((cost_matrix[local], np.asarray(travel_times)[local] if windows is not None else None,
+                      windows[seq] if windows is not None else None, route["arrival"][0] if windows is not None else 0.0))
+
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            orders = list(pool.map(_polish_task, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+    else:
+        orders = [_polish_task(t) for t in tasks]
+
+    nodes, arc_cost, arrival, before, after, improved = [], [], [], 0.0, 0.0, 0
+    for seq, order, task, solver_arrival in zip(seqs, orders, tasks, arrivals):
+        # Same integer cost units as the solver's arc cost callback
+        arcs = (task[0][order[:-1], order[1:]] * 1000).astype(np.int64)
+        old = (task[0][np.arange(len(seq) - 1), np.arange(1, len(seq))] * 1000).astype(np.int64).sum()
+        before, after = before + old, after + arcs.sum()
+        improved += int(arcs.sum() < old)
+        nodes.append(seq[order])
+        arc_cost.append(np.concatenate([[0], np.cumsum(arcs)]))
+        # Unchanged routes keep the solver's times; reordered ones are re-timed from the same start
+        changed = windows is not None and not np.array_equal(order, np.arange(len(seq)))
+        arrival.append(route_times(order, task[1], task[2], task[3])[0] if changed else solver_arrival)
+
+    offsets = np.concatenate([[0], np.cumsum([len(s) for s in seqs])]).astype(np.int64)
+    polished = RouteSolution(np.concatenate(nodes) if nodes else [], offsets, routes.vehicle_ids,
+                             [c[-1] for c in arc_cost], np.concatenate(arc_cost) / 1000.0 if arc_cost else [],
+                             np.concatenate(arrival) if arrival else [])
+    polished.set_loads(demands)
+    return polished, {"cost_before": before / 1000.0, "cost_after": after / 1000.0, "routes_improved": improved}
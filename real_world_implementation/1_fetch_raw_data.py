@@ -1,9 +1,9 @@
-import pyodbc
 import pandas as pd
 import os
 from config import DB_CONFIG
 
 def get_db_connection():
+    import pyodbc
     conn_str = (
         f"DRIVER={DB_CONFIG['driver']};"
         f"SERVER={DB_CONFIG['server']};"
@@ -13,13 +13,18 @@ def get_db_connection():
     )
     return pyodbc.connect(conn_str)
 
-def fetch_raw_data():
+def fetch_raw_data(output_dir=None, save=True):
+    """
+    Pulls schools, vehicles, stops, students and staff from SQL Server.
+    Returns the DataFrames (school, vehicles, raw_stops, students, staff); with save=True they are
+    also written as raw_*.csv, so later stages can run in a separate process.
+    """
     conn = get_db_connection()
     
     # Create data directory
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    output_dir = os.path.join(script_dir, 'data')
-    if not os.path.exists(output_dir):
+    output_dir = output_dir or os.path.join(script_dir, 'data')
+    if save and not os.path.exists(output_dir):
         os.makedirs(output_dir)
         
     print(f"🚀 Connected to {DB_CONFIG['database']}. Fetching raw data...")
@@ -28,7 +33,7 @@ def fetch_raw_data():
     print("   Fetching School Info...")
     sql_school = "select SchoolID,SchoolName,Description,Address1,Place from schools.Schools"
     df_school = pd.read_sql(sql_school, conn)
-    df_school.to_csv(os.path.join(output_dir, "raw_school.csv"), index=False)
+    if save: df_school.to_csv(os.path.join(output_dir, "raw_school.csv"), index=False)
 
     # 2. Vehicles
     print("   Fetching Vehicles...")
@@ -41,7 +46,7 @@ def fetch_raw_data():
     where IsActive=1
     """
     df_vehicles = pd.read_sql(sql_vehicles, conn)
-    df_vehicles.to_csv(os.path.join(output_dir, "raw_vehicles.csv"), index=False)
+    if save: df_vehicles.to_csv(os.path.join(output_dir, "raw_vehicles.csv"), index=False)
 
     # 3. All Active Stops (Including those with missing Lat/Lon)
     print("   Fetching Route Stops...")
@@ -52,7 +57,7 @@ def fetch_raw_data():
     where IsActive=1
     """
     df_stops = pd.read_sql(sql_stops, conn)
-    df_stops.to_csv(os.path.join(output_dir, "raw_stops.csv"), index=False)
+    if save: df_stops.to_csv(os.path.join(output_dir, "raw_stops.csv"), index=False)
 
     # 4. Student Demand with Names
     print("   Fetching Student Assignments & Names...")
@@ -66,7 +71,7 @@ def fetch_raw_data():
     where m.IsActive=1
     """
     df_students = pd.read_sql(sql_students, conn)
-    df_students.to_csv(os.path.join(output_dir, "raw_students.csv"), index=False)
+    if save: df_students.to_csv(os.path.join(output_dir, "raw_students.csv"), index=False)
 
     # 5. Staff Demand with Names
     print("   Fetching Staff Assignments & Names...")
@@ -80,7 +85,7 @@ def fetch_raw_data():
     where m.IsActive=1
     """
     df_staff = pd.read_sql(sql_staff, conn)
-    df_staff.to_csv(os.path.join(output_dir, "raw_staff.csv"), index=False)
+    if save: df_staff.to_csv(os.path.join(output_dir, "raw_staff.csv"), index=False)
 
     conn.close()
     
@@ -96,7 +101,8 @@ def fetch_raw_data():
     
     print(f"   - Students: {len(df_students)} records")
     print(f"   - Staff:    {len(df_staff)} records")
-    print(f"\n✅ Raw data saved to: {output_dir}")
+    if save: print(f"\n✅ Raw data saved to: {output_dir}")
+    return {'school': df_school, 'vehicles': df_vehicles, 'raw_stops': df_stops, 'students': df_students, 'staff': df_staff}
 
 if __name__ == "__main__":
     fetch_raw_data()
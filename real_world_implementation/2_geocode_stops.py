@@ -58,21 +58,11 @@ def smart_geocode(geolocator, stop_name):
             
     return 0.0, 0.0
 
-def run_geocoding():
-    print("🌍 Starting Strict Geocoding for Qatar...")
-    
-    # Paths
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    input_file = os.path.join(script_dir, 'data', 'raw_stops.csv')
-    output_file = os.path.join(script_dir, 'data', 'geocoded_stops.csv')
-    
-    if not os.path.exists(input_file):
-        print(f"❌ Error: {input_file} not found. Run Step 1 first.")
-        return
-
-    df = pd.read_csv(input_file)
-    print(f"Total Stops to Process: {len(df)}")
-    
+def geocode_stops(df):
+    """
+    Geocodes every distinct StopName once (Qatar only) and adds geocode_lat/lon and final_lat/lon
+    (geocoded value, else the database coordinates). Returns (geocoded DataFrame, found, failed).
+    """
     # Identify unique stop names to avoid re-geocoding the same text
     unique_names = df['StopName'].unique()
     print(f"Unique Stop Names: {len(unique_names)}")
@@ -101,6 +91,7 @@ def run_geocoding():
         geocode_cache[name] = (lat, lon)
         
     print("\nApplying coordinates to dataset...")
+    df = df.copy()
     
     # Apply results back to main dataframe
     def get_lat(name): return geocode_cache.get(name, (0,0))[0]
@@ -115,11 +106,33 @@ def run_geocoding():
     
     df['final_lat'] = df.apply(lambda r: r['geocode_lat'] if r['geocode_lat'] != 0 else r['Latitude'], axis=1)
     df['final_lon'] = df.apply(lambda r: r['geocode_lon'] if r['geocode_lon'] != 0 else r['Longitude'], axis=1)
+    return df, success_count, fail_count
+
+def run_geocoding(df=None, data_dir=None, save=True):
+    """Stage 2: raw_stops.csv (or the given raw stops DataFrame) -> geocoded_stops.csv. Returns the geocoded stops."""
+    print("🌍 Starting Strict Geocoding for Qatar...")
+    
+    # Paths
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = data_dir or os.path.join(script_dir, 'data')
+    input_file = os.path.join(data_dir, 'raw_stops.csv')
+    output_file = os.path.join(data_dir, 'geocoded_stops.csv')
+    
+    if df is None:
+        if not os.path.exists(input_file):
+            print(f"❌ Error: {input_file} not found. Run Step 1 first.")
+            return None
+        df = pd.read_csv(input_file)
+    print(f"Total Stops to Process: {len(df)}")
+    
+    df, success_count, fail_count = geocode_stops(df)
     
     # Save
-    df.to_csv(output_file, index=False)
-    print(f"💾 Saved results to {output_file}")
+    if save:
+        df.to_csv(output_file, index=False)
+        print(f"💾 Saved results to {output_file}")
     print(f"📊 Stats: {success_count} Found, {fail_count} Failed.")
+    return df
 
 if __name__ == "__main__":
     run_geocoding()
@@ -1,448 +1,248 @@
 import pandas as pd
+import numpy as np
 import os
 import sys
-from geopy.geocoders import Nominatim
-import time
-import json
-import math
-import folium
-import requests
-import html
 
 # Add parent directory to path to import optimizer
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
-from distance import create_distance_matrix
-from optimizer import optimize_routes
-
-def get_real_road_geometry(coords):
-    if len(coords) < 2: return coords, 0, 0
-    full_path, total_dist, total_duration, chunk_size = [], 0, 0, 40
-    for i in range(0, len(coords) - 1, chunk_size - 1):
-        chunk = coords[i:i + chunk_size]
-        loc_string = ";".join([f"{lon},{lat}" for lat, lon in chunk])
-        url = f"http://127.0.0.1:5000/route/v1/driving/{loc_string}?overview=full&geometries=geojson"
-        try:
-            r = requests.get(url, timeout=15)
-            data = r.json()
-            if data['code'] == 'Ok':
-                geom = data['routes'][0]['geometry']['coordinates']
-                path_chunk = [[p[1], p[0]] for p in geom]
-                full_path.extend(path_chunk if not full_path else path_chunk[1:])
-                total_dist += data['routes'][0]['distance']
-                total_duration += data['routes'][0]['duration']
-            else: full_path.extend([[p[0], p[1]] for p in chunk])
-        except: full_path.extend([[p[0], p[1]] for p in chunk])
-    return full_path, total_dist, total_duration
-
-def run_optimization():
+import distance
+from matrix_store import get_or_build_matrix, match_or_extend_matrix, submatrix, artifact_block
+from detour_model import calibrate_from_cache
+from optimizer import optimize_routes, save_search_progress
+from time_windows import unserved_nodes, parse_clock, travel_time_matrix
+from time_dependent import build_td_stack, solve_time_dependent, frozen_durations, retime_routes, late_stops
+from polish import polish_solution
+from config import (SCHOOL_BELL_TIMES, DEFAULT_BELL_TIME, DROP_PENALTY, TD_PROFILE_START, TD_BUCKET_MIN, TD_DURATION_FACTORS, TD_ITERATIONS, MATRIX_NEIGHBOURS, SPLIT_STRATEGY, SPLIT_LAZY,
+                    SOLVER_TIME_LIMIT_S, POLISH_ROUTES, POLISH_WORKERS, PLAN_AFTERNOON, SCHOOL_DISMISSAL_TIMES, DEFAULT_DISMISSAL_TIME,
+                    CONSOLIDATE_STOPS, GLOBAL_MATRIX, USE_TIME_WINDOWS, USE_TIME_DEPENDENT)
+from school_model import (load_pipeline_data, school_safe_name, locate_school, school_nodes, split_giant_stops,
+                          split_stops_by_fleet, split_overflow, extend_fleet_trips, build_time_windows)
+from plan_store import save_plan
+from dropoff import plan_dropoff, save_dropoff, load_dropoff
+from global_matrix import build_global_matrix
+from checkpoint import (checkpoint_dir, school_input_hash, resumable_stage, reset_checkpoint, save_state, save_solution,
+                        load_solution)
+
+def solve_school(df_model, fleet_list, matrix, bell_time, outputs_dir, safe_name):
+    """
+    Splits the stops, solves the morning VRP and polishes the routes.
+    Returns (df_model_split, extended_fleet, routes, tw), or None if the solver found no routes.
+    """
+    # 2. Splitting: strict (smallest bus) or only as much as the real fleet needs
+    min_v_cap = min(f['capacity'] for f in fleet_list)
+    split_limit = min(25, min_v_cap)
+    df_model_split = split_giant_stops(df_model, split_limit) if SPLIT_STRATEGY == "strict" else split_stops_by_fleet(df_model, fleet_list)
+
+    # 3. Simulate Fleet Trips
+    extended_fleet = extend_fleet_trips(fleet_list, df_model_split['demand'].sum())
+
+    # With lazy splitting the first solve may drop stops that no bus had room for: they are split and solved again
+    for attempt in range(2 if SPLIT_LAZY else 1):
+        node_loc = df_model_split['loc_idx'].to_numpy()
+        dist_matrix, dur_matrix = submatrix(matrix['dist'], node_loc), submatrix(matrix['dur'], node_loc)
+
+        tw = None
+        if USE_TIME_WINDOWS:
+            tw = build_time_windows(df_model_split, dur_matrix, bell_time)
+            print(f"   ⏰ Bell {bell_time}: {int(tw['infeasible'].sum())} stops cannot meet their window even on a direct trip.")
+
+        demands, capacities = list(df_model_split['demand']), [f['capacity'] for f in extended_fleet]
+        drop_penalty = DROP_PENALTY if tw or SPLIT_LAZY else None
+        print(f"   🤖 Solving VRP: {len(df_model_split)} nodes, {len(extended_fleet)} vehicles (Optimizing for Time)...")
+        if tw and USE_TIME_DEPENDENT:
+            td_stack = build_td_stack(dur_matrix, TD_DURATION_FACTORS)
+            print(f"   🚦 Time-dependent travel times: {td_stack.shape[0]} x {TD_BUCKET_MIN}-min buckets ({td_stack.nbytes / 1e6:.2f} MB)")
+            routes, progress = solve_time_dependent(td_stack, demands, capacities, tw['windows'], tw['service'], tw['origin_min'],
+                                                    parse_clock(TD_PROFILE_START), TD_BUCKET_MIN, iterations=TD_ITERATIONS,
+                                                    time_limit_s=SOLVER_TIME_LIMIT_S, drop_penalty=drop_penalty, return_progress=True)
+        else:
+            # Optimization is now based on dur_matrix (time) instead of distance
+            routes, progress = optimize_routes(dur_matrix, demands, capacities,
+                                               time_windows=tw['windows'] if tw else None, travel_times=tw['travel_times'] if tw else None,
+                                               time_limit_s=SOLVER_TIME_LIMIT_S, drop_penalty=drop_penalty, return_progress=True)
+
+        dropped = unserved_nodes(routes, len(df_model_split)) if routes else []
+        overflow = [n for n in dropped if df_model_split.iloc[n]['demand'] > split_limit and not (tw and tw['infeasible'][n])]
+        if not SPLIT_LAZY or attempt == 1 or not overflow: break
+        print(f"   ✂️ Lazy split: {len(overflow)} dropped stops are split into parts of at most {split_limit} and solved again.")
+        df_model_split = split_overflow(df_model_split, overflow, split_limit)
+
+    if progress['solutions']:
+        print(f"   📈 First solution at {progress['first_solution_s']:.1f}s, last improvement at {progress['last_improvement_s']:.1f}s "
+              f"({len(progress['solutions'])} improving solutions{', still improving at time limit' if progress['still_improving'] else ''})")
+        save_search_progress(progress, os.path.join(outputs_dir, f'search_{safe_name}.csv'))
+
+    if not routes: return None
+
+    # 3b. Polish each route's stop order on its own (time windows kept, loads unchanged)
+    if POLISH_ROUTES:
+        if tw and USE_TIME_DEPENDENT:
+            # Arc times frozen at the planned departures, then exact time-dependent ETAs for the new order
+            frozen = frozen_durations(routes, td_stack, tw['service'], tw['origin_min'], parse_clock(TD_PROFILE_START), TD_BUCKET_MIN)
+            routes, stats = polish_solution(routes, frozen, demands, travel_time_matrix(frozen, tw['service']), tw['windows'], POLISH_WORKERS)
+            retime_routes(routes, td_stack, tw['service'], tw['origin_min'], parse_clock(TD_PROFILE_START), TD_BUCKET_MIN)
+        else:
+            routes, stats = polish_solution(routes, dur_matrix, demands, tw['travel_times'] if tw else None, tw['windows'] if tw else None, POLISH_WORKERS)
+        print(f"   ✨ Polished {stats['routes_improved']} of {len(routes)} routes: cost {stats['cost_before']:.1f} -> {stats['cost_after']:.1f}")
+    if tw and USE_TIME_DEPENDENT:
+        # Stored with the plan so replan.py re-times changed routes with the same profile
+        tw['traffic'] = {"factors": [float(f) for f in TD_DURATION_FACTORS],
+                         "profile_start_min": parse_clock(TD_PROFILE_START), "bucket_min": TD_BUCKET_MIN}
+        # The solver saw arc times frozen at guessed departures: check the exact ETAs against the windows
+        late = late_stops(routes, tw['windows'])
+        if late:
+            buses = list(dict.fromkeys(extended_fleet[routes.vehicle_ids[r]]['name'] for r, _, _ in late))
+            print(f"   ⚠️ {len(late)} stops / school arrivals on {len(buses)} buses are past their window with traffic-timed ETAs "
+                  f"(up to {max(m for _, _, m in late):.1f} min late): {', '.join(buses[:5])}{' ...' if len(buses) > 5 else ''}")
+    return df_model_split, extended_fleet, routes, tw
+
+def optimize_school(s_row, data, s_lat, s_lon, cache_dir, outputs_dir, report=True, resume=False, global_matrix_dir=None):
+    """
+    Stage 3 for one school: split, matrix, solve, plan, report and manifest (report=False stops after the plan).
+    Progress is checkpointed per school; resume=True skips the work a matching checkpoint already covers.
+    global_matrix_dir: the shared all-schools artifact (see global_matrix.py) instead of a per-school matrix.
+    Returns a summary dict (paths, node / route counts, unserved stops), or None if there is nothing to route.
+    """
+    school_id, school_name = s_row['SchoolID'], s_row['SchoolName']
+    safe_name = school_safe_name(school_name)
+    print(f"\n🏫 Processing: {school_name}")
+    
+    # 1. Aggregate Stops
+    school = school_nodes(school_id, data, s_lat, s_lon)
+    if school is None: return None
+    df_model, fleet_list = school
+
+    # 1b. Stop consolidation: stops within walking distance of a kept stop are merged into it (fewer solver nodes)
+    reassigned = None
+    if CONSOLIDATE_STOPS:
+        from consolidation import consolidate_stops # scipy is only needed when consolidating
+        df_model, reassigned = consolidate_stops(df_model)
+
+    USE_REAL_ROADS_ALWAYS = True # Since we have a local OSRM server, we use it for everything
+    if global_matrix_dir:
+        # Shared artifact: the school's rows are scattered, so its block is copied out of the memory map once
+        # and the hash, estimate count, solve and report all slice that copy (plans map back through 'rows')
+        artifact_dir = global_matrix_dir
+        artifact, rows = match_or_extend_matrix(artifact_dir, df_model['name'], list(zip(df_model['lat'], df_model['lon'])))
+        matrix = artifact_block(artifact, rows)
+        del artifact
+    else:
+        # The matrix is built over distinct locations (depot + stops), not split parts, so a
+        # different fleet / split limit reuses the stored artifact without any OSRM calls.
+        artifact_dir = os.path.join(cache_dir, f'matrix_{safe_name}')
+        matrix = get_or_build_matrix(artifact_dir, df_model['name'], list(zip(df_model['lat'], df_model['lon'])),
+                                     use_osrm_for_large=USE_REAL_ROADS_ALWAYS, neighbours=MATRIX_NEIGHBOURS, resume=resume)
+    bell_time = SCHOOL_BELL_TIMES.get(school_id, DEFAULT_BELL_TIME)
+    dismissal_time = SCHOOL_DISMISSAL_TIMES.get(school_id, DEFAULT_DISMISSAL_TIME)
+    school_info = {"school_id": int(school_id), "school_name": school_name, "safe_name": safe_name, "lat": s_lat, "lon": s_lon}
+
+    # Checkpoint: the inputs are hashed; a matching checkpoint lets --resume skip the solve (and the report)
+    ckpt_dir = checkpoint_dir(cache_dir, safe_name)
+    locs = np.unique(df_model['loc_idx'].to_numpy())
+    input_hash = school_input_hash(school_id, data, s_lat, s_lon, submatrix(matrix['dist'], locs), submatrix(matrix['dur'], locs))
+    estimated_cells = int(np.count_nonzero(submatrix(matrix['estimated'], locs))) if 'estimated' in matrix else 0
+    if estimated_cells:
+        print(f"   ⚠️ {estimated_cells} of {len(locs) * (len(locs) - 1)} matrix cells of this school are estimates (marked in the manifest; `cli.py matrix --rebuild` fetches them again).")
+    stage, summary = resumable_stage(ckpt_dir, input_hash) if resume else (None, None)
+    if stage == "reported" or (stage == "solved" and not report):
+        print(f"   ⏭️ Checkpoint matches the inputs ({stage}): skipped.")
+        return summary
+
+    if stage == "solved":
+        print("   ⏭️ Routes restored from the checkpoint (inputs unchanged): skipping the solve.")
+        plan, routes = load_solution(ckpt_dir, "am")
+        local = {int(r): i for i, r in enumerate(matrix['rows'])} # artifact row -> row of this school's matrix
+        df_model_split = plan['nodes'].assign(loc_idx=[local[int(r)] for r in plan['nodes']['loc_idx']])
+        extended_fleet, tw, unserved = plan['fleet'], plan['time_windows'], summary['unserved']
+        afternoon = load_dropoff(ckpt_dir)
+    else:
+        reset_checkpoint(ckpt_dir)
+        solved = solve_school(df_model, fleet_list, matrix, bell_time, outputs_dir, safe_name)
+        if solved is None: return None
+        df_model_split, extended_fleet, routes, tw = solved
+
+        unserved = [df_model_split.iloc[n]['name'] for n in unserved_nodes(routes, len(df_model_split))]
+        if unserved:
+            print(f"   ⚠️ {len(unserved)} stops left unserved: {', '.join(unserved[:5])}{' ...' if len(unserved) > 5 else ''}")
+
+        # Keep the solved plan so replan.py can apply single changes without re-solving
+        # (loc_idx is re-pointed at rows of the stored artifact, which may be a superset of df_model)
+        plan_nodes = df_model_split.assign(loc_idx=matrix['rows'][df_model_split['loc_idx'].to_numpy()])
+        save_plan(os.path.join(cache_dir, f'plan_{safe_name}.json'), school_info, plan_nodes, extended_fleet, routes, artifact_dir, tw, bell_time)
+
+        summary = {"school_id": int(school_id), "school_name": school_name, "safe_name": safe_name, "nodes": len(df_model_split),
+                   "routes": len(routes), "unserved": unserved,
+                   "stops_removed": len(reassigned) if reassigned is not None else 0, "estimated_cells": estimated_cells,
+                   "plan": os.path.join(cache_dir, f'plan_{safe_name}.json')}
+
+        # 3c. Afternoon drop-off on the same matrix artifact (only drop-off-only locations are fetched)
+        afternoon = None
+        if PLAN_AFTERNOON:
+            afternoon = plan_dropoff(school_id, data, s_lat, s_lon, artifact_dir, dismissal_time)
+            if afternoon: summary.update({"pm_routes": len(afternoon["routes"]), "pm_unserved": afternoon["unserved"]})
+        if reassigned is not None:
+            # Who walks where, for the manifests and for informing families
+            moves = [reassigned.assign(trip="AM")] + ([afternoon["reassigned"].assign(trip="PM")] if afternoon and afternoon["reassigned"] is not None else [])
+            moves_path = os.path.join(outputs_dir, f'consolidation_{safe_name}.csv')
+            pd.concat(moves, ignore_index=True).to_csv(moves_path, index=False)
+            summary["consolidation"] = moves_path
+
+        save_solution(ckpt_dir, "am", school_info, plan_nodes, extended_fleet, routes, artifact_dir, tw, bell_time)
+        if afternoon: save_dropoff(ckpt_dir, school_info, afternoon, artifact_dir, dismissal_time)
+        save_state(ckpt_dir, input_hash, "solved", summary)
+    if not report: return summary
+
+    # 4. Generate Integrated Report (folium is only imported when a report is wanted)
+    from reporting import render_school_report, build_manifest, dropoff_dashboard_data
+    node_loc = df_model_split['loc_idx'].to_numpy()
+    dist_matrix, dur_matrix = submatrix(matrix['dist'], node_loc), submatrix(matrix['dur'], node_loc)
+    estimated = submatrix(matrix['estimated'], node_loc) if 'estimated' in matrix else None
+    coords = list(zip(df_model_split['lat'], df_model_split['lon']))
+    dashboard_html, dashboard_data = render_school_report(school_name, s_lat, s_lon, routes, extended_fleet, df_model_split, coords, dist_matrix, dur_matrix,
+                                                          time_origin=tw['origin_min'] if tw else None, unserved=unserved, estimated=estimated)
+    with open(os.path.join(outputs_dir, f'report_{safe_name}.html'), 'w', encoding='utf-8') as f: f.write(dashboard_html)
+    # --- GENERATE CSV MANIFEST FOR DRIVERS ---
+    df_manifest = build_manifest(school_name, dashboard_data, dropoff_dashboard_data(afternoon) if afternoon else None)
+    csv_path = os.path.join(outputs_dir, f'manifest_{safe_name}.csv')
+    df_manifest.to_csv(csv_path, index=False)
+    print(f"📄 Manifest stored: {csv_path}")
+    summary.update({"report": os.path.join(outputs_dir, f'report_{safe_name}.html'), "manifest": csv_path})
+    save_state(ckpt_dir, input_hash, "reported", summary)
+    return summary
+
+def run_optimization(resume=False):
+    """All schools. resume=True continues an interrupted run: schools whose checkpoint matches their inputs are skipped."""
     print("🚀 Starting Multi-School Route Optimization (Numbered Stops)...")
     data_dir, outputs_dir = os.path.join(current_dir, 'data'), os.path.join(current_dir, 'outputs')
+    cache_dir = os.path.join(current_dir, 'cache')
     if not os.path.exists(outputs_dir): os.makedirs(outputs_dir)
     
-    school_df = pd.read_csv(os.path.join(data_dir, 'raw_school.csv'))
-    all_stops_df = pd.read_csv(os.path.join(data_dir, 'geocoded_stops.csv'))
-    all_students_df = pd.read_csv(os.path.join(data_dir, 'raw_students.csv'))
-    all_staff_df = pd.read_csv(os.path.join(data_dir, 'raw_staff.csv'))
-    all_vehicles_df = pd.read_csv(os.path.join(data_dir, 'raw_vehicles.csv'))
+    data = load_pipeline_data(data_dir)
 
+    from geopy.geocoders import Nominatim
     geolocator = Nominatim(user_agent="school_optimizer_v14")
 
-    for _, s_row in school_df.iterrows():
-        school_id, school_name = s_row['SchoolID'], s_row['SchoolName']
-        print(f"\n🏫 Processing: {school_name}")
-        
-        school_vehicles = all_vehicles_df[all_vehicles_df['SchoolID'] == school_id].copy()
-        if school_vehicles.empty: continue
-        school_students = all_students_df[all_students_df['SchoolID'] == school_id].copy()
-        school_staff = all_staff_df[all_staff_df['SchoolID'] == school_id].copy()
-
-        try:
-            loc = geolocator.geocode(f"{s_row['Address1']}, {s_row['Place']}, Qatar", country_codes="qa")
-            s_lat, s_lon = loc.latitude, loc.longitude
-        except: s_lat, s_lon = 25.2854, 51.5310 
-
-        # 1. Aggregate Stops
-        stops_distinct = all_stops_df.groupby(['StopName', 'final_lat', 'final_lon']).agg({'RouteStopMapIID': list}).reset_index()
-        id_to_group = {iid: row['StopName'] for _, row in stops_distinct.iterrows() for iid in row['RouteStopMapIID']}
-        
-        school_students['GroupKey'] = school_students['PickupStopMapID'].map(id_to_group)
-        school_staff['GroupKey'] = school_staff['PickupStopMapID'].map(id_to_group)
-        student_data = school_students.groupby('GroupKey').agg({'StudentID': [('count', 'size'), ('ids', lambda x: ", ".join(x.astype(str).unique()))]}); student_data.columns = ['student_count', 'student_ids']
-        staff_data = school_staff.groupby('GroupKey').agg({'StaffID': [('count', 'size'), ('ids', lambda x: ", ".join(x.astype(str).unique()))]}); staff_data.columns = ['staff_count', 'staff_ids']
-        
-        stops_final = pd.merge(stops_distinct, student_data, left_on='StopName', right_index=True, how='left')
-        stops_final = pd.merge(stops_final, staff_data, left_on='StopName', right_index=True, how='left')
-        stops_final[['student_count', 'staff_count']] = stops_final[['student_count', 'staff_count']].fillna(0).astype(int)
-        stops_final['total_demand'] = stops_final['student_count'] + stops_final['staff_count']
-        stops_final[['student_ids', 'staff_ids']] = stops_final[['student_ids', 'staff_ids']].fillna("")
-
-        active_stops = stops_final[(stops_final['total_demand'] > 0) & (stops_final['final_lat'] > 24.5)].copy()
-        if active_stops.empty: continue
-
-        model_data = [{'stop_id': 0, 'name': 'SCHOOL', 'lat': float(s_lat), 'lon': float(s_lon), 'student_count': 0, 'staff_count': 0, 'demand': 0, 'student_ids': "", 'staff_ids': ""}]
-        for idx, row in active_stops.iterrows():
-            model_data.append({'stop_id': idx, 'name': row['StopName'], 'lat': float(row['final_lat']), 'lon': float(row['final_lon']), 'student_count': int(row['student_count']), 'staff_count': int(row['staff_count']), 'demand': int(row['total_demand']), 'student_ids': row['student_ids'], 'staff_ids': row['staff_ids']})
-        
-        df_model = pd.DataFrame(model_data)
-        fleet_list = [{'name': str(v.get('VehicleRegistrationNumber', f"V{i+1}")), 'capacity': int(v.get('MaximumSeatingCapacity', 30))} for i, v in school_vehicles.iterrows()]
-        
-        # 2. STRICT SPLITTING logic
-        min_v_cap = min(f['capacity'] for f in fleet_list)
-        split_limit = min(25, min_v_cap)
-
-        split_rows = []
-        for idx, row in df_model.iterrows():
-            if idx == 0: split_rows.append(row); continue
-            if row['demand'] > split_limit:
-                num_parts = math.ceil(row['demand'] / split_limit)
-                for i in range(num_parts):
-                    new_part = row.copy()
-                    new_part['demand'] = row['demand'] // num_parts + (1 if i < row['demand'] % num_parts else 0)
-                    new_part['student_count'] = row['student_count'] // num_parts + (1 if i < row['student_count'] % num_parts else 0)
-                    new_part['staff_count'] = row['staff_count'] // num_parts + (1 if i < row['staff_count'] % num_parts else 0)
-                    new_part['name'] = f"{row['name']} (Part {i+1})"
-                    if i > 0: new_part['student_ids'] = ""; new_part['staff_ids'] = ""
-                    split_rows.append(new_part)
-            else:
-                split_rows.append(row)
-        df_model_split = pd.DataFrame(split_rows).reset_index(drop=True)
-
-        # 3. Simulate Fleet Trips
-        total_pax = df_model_split['demand'].sum()
-        extended_fleet = list(fleet_list)
-        mult = 1
-        while sum(f['capacity'] for f in extended_fleet) < total_pax and mult < 6:
-            mult += 1
-            for f in fleet_list: extended_fleet.append({'name': f"{f['name']} (Trip {mult})", 'capacity': f['capacity']})
-
-        USE_REAL_ROADS_ALWAYS = True # Since we have a local OSRM server, we use it for everything
-        coords = list(zip(df_model_split['lat'], df_model_split['lon']))
-        dist_matrix, dur_matrix = create_distance_matrix(coords, use_osrm_for_large=USE_REAL_ROADS_ALWAYS)
-        
-        print(f"   🤖 Solving VRP: {len(df_model_split)} nodes, {len(extended_fleet)} vehicles (Optimizing for Time)...")
-        # Optimization is now based on dur_matrix (time) instead of distance
-        routes = optimize_routes(dur_matrix, list(df_model_split['demand']), [f['capacity'] for f in extended_fleet])
-
-        if not routes: continue
-
-        # 4. Generate Integrated Report
-        m = folium.Map(location=[s_lat, s_lon], zoom_start=11, tiles='cartodbpositron')
-        folium.Marker([s_lat, s_lon], icon=folium.Icon(color='red', icon='school', prefix='fa'), tooltip=f"<b>{school_name}</b>").add_to(m)
-        colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf', '#e6194b', '#3cb44b', '#ffe119']
-        
-        dashboard_data = {"school_name": school_name, "routes": []}
-        global_stop_markers = {} # (lat, lon) -> list of stop details
-
-        for i, route_info in enumerate(routes):
-            v_info = extended_fleet[route_info['vehicle_id']]
-            v_info['bus_name_safe'] = v_info['name'].replace("'", "").replace('"', "")
-            color = colors[i % len(colors)]
-            node_coords = [coords[step['node']] for step in route_info['route']]
-            road_path, road_dist, road_duration = get_real_road_geometry(node_coords)
-            
-            # FIX: Force the visual line to start/end EXACTLY at the School Pin
-            # This closes any 'snapping gaps' from OSRM and ensures the link is visible
-            if road_path: 
-                road_path.insert(0, list(node_coords[0]))
-                road_path.append(list(node_coords[-1]))
-            
-            # --- OFFSET LOGIC: Prevent lines from overlapping on same roads ---
-            # Shift lat/lon by a few meters based on route index
-            offset = 0.00003 * (i - len(routes)/2) 
-            offset_path = [[p[0] + offset, p[1] + offset] for p in road_path]
-
-            avg_speed_kmh = (road_dist / road_duration * 3.6) if road_duration > 0 else 0
-            route_pax_count = sum(df_model_split.iloc[step['node']]['demand'] for step in route_info['route'])
-            
-            line = folium.PolyLine(
-                offset_path, 
-                color=color, 
-                weight=4, 
-                opacity=0.7,
-                tooltip=f"Bus {v_info['name']} ({route_pax_count} pax)"
-            )
-            line.add_to(m)
-            # Tag the road line with the bus name for filtering
-            m.get_root().script.add_child(folium.Element(f"setTimeout(() => {{ if (typeof {line.get_name()} !== 'undefined') {line.get_name()}.options.bus_name = '{v_info['bus_name_safe']}'; }}, 100);"))
-            
-            route_stops_for_manifest = []
-            stop_seq_num = 0
-            curr_dist, curr_time = 0, 0
-            prev_node = None
-            
-            for step_idx, step in enumerate(route_info['route']):
-                node_idx = step['node']
-                row = df_model_split.iloc[node_idx]
-                
-                if prev_node is not None:
-                    curr_dist += dist_matrix[prev_node][node_idx]
-                    curr_time += dur_matrix[prev_node][node_idx]
-                prev_node = node_idx
-                
-                # Add to manifest
-                route_stops_for_manifest.append({
-                    "name": row['name'], "students": int(row['student_count']), 
-                    "staff": int(row['staff_count']), "pax": int(row['demand']), 
-                    "s_ids": str(row['student_ids']), "st_ids": str(row['staff_ids']), 
-                    "distance": curr_dist,
-                    "duration": curr_time
-                })
-
-                
-                if node_idx > 0:
-                    stop_seq_num += 1
-                    pos = (float(row['lat']), float(row['lon']))
-                    if pos not in global_stop_markers:
-                        global_stop_markers[pos] = []
-                    
-                    global_stop_markers[pos].append({
-                        "bus": v_info['name'],
-                        "color": color,
-                        "seq": stop_seq_num,
-                        "pax": int(row['demand']),
-                        "name": row['name'].split(" (Part")[0]
-                    })
-
-            dashboard_data["routes"].append({
-                "vehicle_name": v_info['name'], "max_cap": int(v_info['capacity']),
-                "total_pax": int(route_pax_count),
-                "stop_count": int(stop_seq_num),
-                "total_dist": f"{road_dist/1000:.2f} km" if road_dist > 0 else f"{route_info['distance_meters']/1000:.2f} km",
-                "avg_speed": f"{avg_speed_kmh:.1f} km/h",
-                "stops": route_stops_for_manifest
-            })
-
-        # --- DRAW GLOBAL CLUSTERED MARKERS ---
-        for pos, bus_visits in global_stop_markers.items():
-            # If multiple buses, we'll use a neutral color for the circle but show all bus info
-            main_color = bus_visits[0]['color'] if len(bus_visits) == 1 else '#333333'
-            stop_name = bus_visits[0]['name']
-            
-            # Combine sequence labels (e.g. "B1: 1, B2: 4")
-            labels = []
-            for v in bus_visits:
-                labels.append(f"{v['seq']}")
-            numbers_label = ", ".join(labels)
-
-            popup_html = f"<div style='font-family:Inter; padding:5px;'><b>{stop_name}</b><hr>"
-            for v in bus_visits:
-                popup_html += f"<div style='margin-bottom:5px;'><span style='color:{v['color']}; font-weight:bold;'>Bus {v['bus']}</span>: Stop #{v['seq']} ({v['pax']} pax)</div>"
-            popup_html += "</div>"
-
-            cm = folium.CircleMarker(
-                pos, radius=7, color=main_color, weight=2, fill=True, fill_color='white', fill_opacity=1,
-                popup=folium.Popup(popup_html, max_width=300)
-            )
-            cm.add_to(m)
-            
-            # Tag marker with all buses that visit it
-            bus_names_js = json.dumps([v['bus'].replace("'", "").replace('"', "") for v in bus_visits])
-            m.get_root().script.add_child(folium.Element(f"setTimeout(() => {{ if (typeof {cm.get_name()} !== 'undefined') {cm.get_name()}.options.bus_names = {bus_names_js}; }}, 100);"))
-
-            # The Label Marker
-            lbl = folium.Marker(
-                pos,
-                icon=folium.DivIcon(
-                    icon_size=(40, 20), icon_anchor=(20, 26),
-                    html=f"""<div id="lbl-{id(pos)}" style="font-family:'Inter'; font-size:10px; font-weight:bold; color:white; background-color:{main_color}; border:1.5px solid white; border-radius:10px; padding:2px 6px; display:inline-block; white-space:nowrap; box-shadow:0 1px 3px rgba(0,0,0,0.4); pointer-events:none;">{numbers_label}</div>"""
-                )
-            )
-            lbl.add_to(m)
-            m.get_root().script.add_child(folium.Element(f"setTimeout(() => {{ if (typeof {lbl.get_name()} !== 'undefined') {lbl.get_name()}.options.bus_names = {bus_names_js}; }}, 100);"))
-
-
-        # --- FILTER UI & LOGIC INJECTION ---
-        all_bus_names = sorted(list(set(v['bus'].replace("'", "").replace('"', "") for visits in global_stop_markers.values() for v in visits)))
-        options_html = "".join([f'<option value="{name}">{name}</option>' for name in all_bus_names])
-        
-        filter_html = f"""
-        <div id="bus-filter-container" style="
-            position: fixed; top: 10px; right: 50px; z-index: 9999; 
-            background: rgba(255, 255, 255, 0.95); padding: 12px; border-radius: 10px; 
-            box-shadow: 0 4px 15px rgba(0,0,0,0.15); font-family: 'Inter', sans-serif;
-            border: 1px solid #e2e8f0; backdrop-filter: blur(4px);
-        ">
-            <div style="font-size: 10px; font-weight: 800; color: #475569; margin-bottom: 6px; text-transform: uppercase; letter-spacing: 0.8px;">Bus Route Filter</div>
-            <select id="bus-select" onchange="window.filterBus(this.value)" style="
-                padding: 8px 12px; border-radius: 6px; border: 1px solid #cbd5e1;
-                font-size: 13px; color: #1e293b; background: white; cursor: pointer; outline: none; width: 160px;
-                font-family: 'Inter', sans-serif;
-            ">
-                <option value="all">Show All Routes</option>
-                {options_html}
-            </select>
-        </div>
-        """
-        m.get_root().html.add_child(folium.Element(filter_html))
-
-        filter_js = f"""
-        window.filterBus = function(busName) {{
-            var mapInstance = null;
-            // Robust check for the Leaflet map instance
-            for (var key in window) {{
-                if (key.startsWith('map_') && window[key] instanceof L.Map) {{
-                    mapInstance = window[key];
-                    break;
-                }}
-            }}
-            if (!mapInstance) {{
-                console.error("Map instance not found");
-                return;
-            }}
-
-            mapInstance.eachLayer(function(layer) {{
-                // Check if this layer has our custom bus tagging
-                var hasBusTag = layer.options && (layer.options.bus_name || layer.options.bus_names);
-                
-                if (hasBusTag) {{
-                    var isMatch = false;
-                    if (busName === 'all') {{
-                        isMatch = true;
-                    }} else if (layer.options.bus_name === busName) {{
-                        isMatch = true;
-                    }} else if (layer.options.bus_names && layer.options.bus_names.indexOf(busName) !== -1) {{
-                        isMatch = true;
-                    }}
-
-                    if (isMatch) {{
-                        if (layer.setStyle) layer.setStyle({{opacity: 0.8, fillOpacity: 0.6}});
-                        if (layer.setOpacity) layer.setOpacity(1.0);
-                        if (layer.getElement && layer.getElement()) layer.getElement().style.opacity = '1';
-                    }} else {{
-                        if (layer.setStyle) layer.setStyle({{opacity: 0.05, fillOpacity: 0.02}});
-                        if (layer.setOpacity) layer.setOpacity(0.1);
-                        if (layer.getElement && layer.getElement()) layer.getElement().style.opacity = '0.05';
-                    }}
-                }}
-            }});
-        }};
-        """
-        m.get_root().script.add_child(folium.Element(filter_js))
-
-        safe_name = school_name.replace(" ", "_").replace(",", "").replace("-", "_").replace("__", "_")
-        map_content = html.escape(m.get_root().render())
-        dashboard_html = f"""
-<!DOCTYPE html>
-<html><head><meta charset="UTF-8"><title>Fleet Report - {school_name}</title>
-<link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet"><style>
-body{{font-family:'Inter',sans-serif;margin:0;display:flex;height:100vh;background:#f4f7f9;overflow:hidden;}}
-#sidebar{{width:350px;background:white;border-right:1px solid #e1e8ed;display:flex;flex-direction:column;}}
-#bus-list{{flex:1;overflow-y:auto;}} 
-.bus-card{{padding:15px 20px;border-bottom:1px solid #f0f3f5;cursor:pointer;}}
-.bus-card.active{{border-left:5px solid #3498db;background:#ebf5fb;}}
-#detail-view{{flex:1;display:flex;flex-direction:column;padding:25px;position:relative;}}
-.nav-tabs{{display:flex;gap:10px;margin-bottom:20px;}}
-.tab-btn{{padding:10px 20px;border:none;border-radius:8px;cursor:pointer;background:#e2e8f0;font-weight:600;}}
-.tab-btn.active{{background:#3498db;color:white;}}
-.summary-table{{width:100%;border-collapse:separate;border-spacing:0;background:white;border-radius:12px;box-shadow:0 4px 6px rgba(0,0,0,0.05);}}
-.summary-table th, .summary-table td{{padding:15px;text-align:left;border-bottom:1px solid #f1f5f9;}}
-.summary-table th{{background:#1e293b;color:white;font-size:11px;position:sticky;top:0;z-index:10;}}
-#fleet-pane{{overflow-y:auto; flex:1; border-radius:12px;}}
-.timeline{{position:relative;padding-left:40px;margin-top:20px;border-left:2px solid #e2e8f0;margin-left:15px;}}
-.stop-item{{position:relative;margin-bottom:15px;background:white;padding:15px;border-radius:10px;box-shadow:0 2px 4px rgba(0,0,0,0.03);}}
-.stop-item::before{{content:attr(data-step);position:absolute;left:-51px;top:20px;width:20px;height:20px;border-radius:50%;background:#3498db;color:white;font-size:10px;font-weight:bold;text-align:center;line-height:20px;border:3px solid white;box-shadow:0 0 0 2px #3498db;}}
-.pax-pill{{padding:3px 8px;border-radius:4px;font-size:10px;font-weight:700;margin-right:5px;}}
-.student{{background:#e0f2fe;color:#0369a1;}} .staff{{background:#dcfce7;color:#15803d;}}
-</style></head><body>
-<div id="sidebar">
-    <div style="padding:20px;background:#1e293b;color:white;"><h3>Report Center</h3><p style="font-size:11px;opacity:0.7;">{school_name}</p></div>
-    <div id="bus-list"></div>
-</div>
-<div id="detail-view">
-    <div class="nav-tabs">
-        <button class="tab-btn active" onclick="switchTab('fleet', this)">Summary View</button>
-        <button class="tab-btn" onclick="switchTab('map', this)">Road Map</button>
-        <button class="tab-btn" id="manifest-tab" style="display:none;" onclick="switchTab('manifest', this)">Manifest Details</button>
-    </div>
-    <div id="fleet-pane" style="display:block;">
-        <table class="summary-table">
-            <thead><tr><th>Bus Plate</th><th>Max Capacity</th><th>Total Stops</th><th>Occupied</th><th>Utilization%</th><th>Distance</th><th>Avg Speed</th></tr></thead>
-            <tbody id="fleet-body"></tbody>
-        </table>
-    </div>
-    <div id="map-pane" style="display:none; height:100%;"><iframe srcdoc="{map_content}" style="width:100%; height:100%; border:none;"></iframe></div>
-    <div id="manifest-pane" style="display:none; overflow-y:auto;"><div class="timeline" id="timeline"></div></div>
-</div>
-<script>
-const data = {json.dumps(dashboard_data)};
-function switchTab(t, btn){{
-    ['fleet','map','manifest'].forEach(x => document.getElementById(x+'-pane').style.display = 'none');
-    document.getElementById(t+'-pane').style.display = 'block';
-    document.querySelectorAll('.tab-btn').forEach(b => b.classList.remove('active'));
-    btn.classList.add('active');
-}}
-data.routes.forEach(r => {{
-    const util = ((r.total_pax / r.max_cap)*100).toFixed(1);
-    document.getElementById('fleet-body').innerHTML += `<tr><td><b>${{r.vehicle_name}}</b></td><td>${{r.max_cap}} Seats</td><td>${{r.stop_count}} Stops</td><td><b style="color:${{r.total_pax > r.max_cap ? 'red' : '#27ae60'}}">${{r.total_pax}} Pax</b></td><td>${{util}}%</td><td>${{r.total_dist}}</td><td>${{r.avg_speed}}</td></tr>`;
-    const card = document.createElement('div'); card.className = 'bus-card';
-    card.innerHTML = `<h4>${{r.vehicle_name}}</h4><p>${{r.total_pax}} / ${{r.max_cap}} Pax • ${{r.total_dist}}</p>`;
-    card.onclick = () => {{
-        document.querySelectorAll('.bus-card').forEach(c => c.classList.remove('active')); card.classList.add('active');
-        document.getElementById('manifest-tab').style.display = 'inline';
-        switchTab('manifest', document.getElementById('manifest-tab'));
-        const tl = document.getElementById('timeline'); tl.innerHTML = '';
-        let stepCount = 0;
-        r.stops.forEach((s, idx) => {{
-            if (s.name !== "SCHOOL" || s.distance > 0) {{
-                stepCount++;
-                tl.innerHTML += `<div class="stop-item" data-step="${{stepCount}}"><h4>${{s.name}}</h4><p style="font-size:11px;color:#94a3b8;">${{s.distance.toFixed(2)}} km • ${{s.duration.toFixed(1)}} mins</p>
-                ${{s.students > 0 ? `<span class="pax-pill student">${{s.students}} Students</span>` : ''}}
-                ${{s.staff > 0 ? `<span class="pax-pill staff">${{s.staff}} Staff</span>` : ''}}
-                <div style="font-size:10px;color:#64748b;margin-top:5px;">IDs: ${{s.s_ids}} ${{s.st_ids}}</div></div>`;
-            }} else {{
-                tl.innerHTML += `<div class="stop-item" data-step="S"><h4>HOME (DEPOT)</h4><p style="font-size:11px;color:#94a3b8;">Start Point</p></div>`;
-            }}
-        }});
-    }}; document.getElementById('bus-list').appendChild(card);
-}});
-</script></body></html>
-        """
-        with open(os.path.join(outputs_dir, f'report_{safe_name}.html'), 'w', encoding='utf-8') as f: f.write(dashboard_html)
-        # --- GENERATE CSV MANIFEST FOR DRIVERS ---
-        manifest_rows = []
-        for r in dashboard_data["routes"]:
-            # Morning Route (Pickup)
-            for idx, s in enumerate(r["stops"]):
-                manifest_rows.append({
-                    "School": school_name,
-                    "Bus Plate": r["vehicle_name"],
-                    "Trip Type": "AM (Pickup)",
-                    "Sequence": idx + 1,
-                    "Stop Name": s["name"],
-                    "Activity": "DROP OFF" if s["name"] == "SCHOOL" else "PICK UP",
-                    "Students": s["students"],
-                    "Staff": s["staff"],
-                    "Total Pax": s["pax"],
-                    "Dist (km)": f"{s['distance']:.2f}",
-                    "Time (min)": f"{s['duration']:.1f}"
-                })
-            
-            # Afternoon Route (Drop-off) - Reversed
-            reversed_stops = r["stops"][::-1] # Simple reversal
-            for idx, s in enumerate(reversed_stops):
-                 manifest_rows.append({
-                    "School": school_name,
-                    "Bus Plate": r["vehicle_name"],
-                    "Trip Type": "PM (Drop-off)",
-                    "Sequence": idx + 1,
-                    "Stop Name": s["name"],
-                    "Activity": "PICK UP" if s["name"] == "SCHOOL" else "DROP OFF",
-                    "Students": s["students"],
-                    "Staff": s["staff"],
-                    "Total Pax": s["pax"],
-                    "Dist (km)": "N/A",
-                    "Time (min)": "N/A"
-                })
-
-        df_manifest = pd.DataFrame(manifest_rows)
-        csv_path = os.path.join(outputs_dir, f'manifest_{safe_name}.csv')
-        df_manifest.to_csv(csv_path, index=False)
-        print(f"📄 Manifest stored: {csv_path}")
+    # Missing OSRM cells are estimated with a detour model learned from the matrices cached so far
+    distance.DETOUR_MODEL = calibrate_from_cache(cache_dir)
+    if distance.DETOUR_MODEL:
+        h = distance.DETOUR_MODEL['holdout']
+        print(f"📐 Detour model from {distance.DETOUR_MODEL['samples']} cached road cells: held-out duration error "
+              f"{h['dur_mape']:.1%} (flat 30 km/h: {h['flat_dur_mape']:.1%}), distance error {h['dist_mape']:.1%}")
+
+    # Down or unreachable OSRM: the circuit opens now and every matrix / map falls back at once instead of timing out
+    distance.check_osrm()
+    schools = [(s_row, locate_school(geolocator, s_row)) for _, s_row in data['school'].iterrows()]
+    # One matrix over the stops of all schools: stops shared by several schools are fetched once
+    global_dir = build_global_matrix(cache_dir, data, {s_row['SchoolID']: loc for s_row, loc in schools}, resume) if GLOBAL_MATRIX else None
+    for s_row, (s_lat, s_lon) in schools:
+        optimize_school(s_row, data, s_lat, s_lon, cache_dir, outputs_dir, resume=resume, global_matrix_dir=global_dir)
+    counts = distance.OSRM_REQUESTS
+    print(f"\n🌐 OSRM requests this run: {sum(counts.values())} ({', '.join(f'{n} {k}' for k, n in sorted(counts.items())) or 'none'})")
 
     print("\n🎉 Map enriched: Numbered stops everywhere (Tooltips, Popups, Timeline). Filter active.")
 
 if __name__ == "__main__":
-    run_optimization()
+    run_optimization(resume="--resume" in sys.argv[1:])
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+import config
+from plan_store import save_plan, load_plan
+from solution import RouteSolution
+
+# Per-school checkpoints for long multi-school runs (Stage 3 --resume).
+# cache/checkpoint_<school>/ holds the input hash, the stage the school reached ("solved": AM and
+# PM routes stored; "reported": map and manifest written), the run summary and the solved routes
+# (plan JSON for nodes / fleet / windows + RouteSolution arrays). Each file is written to a
+# temporary name and renamed, so a run killed at any point leaves either the old or the new state.
+
+def school_input_hash(school_id, data, s_lat, s_lon, dist, dur):
+    """
+    SHA-1 of everything Stage 3 reads for one school: its students, staff and vehicles, the stop
+    table, the depot, every setting in config.py and the school's matrix cells (dist / dur).
+    """
+    h = hashlib.sha1()
+    for key in ('students', 'staff', 'vehicles'):
+        frame = data[key][data[key]['SchoolID'] == school_id]
+        h.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+    h.update(pd.util.hash_pandas_object(data['stops'], index=False).to_numpy().tobytes())
+    settings = {name: getattr(config, name) for name in dir(config) if name.isupper() and not name.startswith(("DB_", "SERVICE_"))}
+    h.update(json.dumps([round(float(s_lat), 6), round(float(s_lon), 6), settings], sort_keys=True, default=str).encode())
+    for matrix in (dist, dur):
+        h.update(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+def checkpoint_dir(cache_dir, safe_name):
+    return os.path.join(cache_dir, f'checkpoint_{safe_name}')
+
+def reset_checkpoint(ckpt_dir):
+    """Drops a school's checkpoint before it is solved again (no stale trip can be restored later)."""
+    shutil.rmtree(ckpt_dir, ignore_errors=True)
+
+def load_state(ckpt_dir):
+    """The school's checkpoint state ({input_hash, stage, summary, updated}), or None."""
+    path = os.path.join(ckpt_dir, "state.json")
+    if not os.path.exists(path): return None
+    with open(path, encoding="utf-8") as f: return json.load(f)
+
+def save_state(ckpt_dir, input_hash, stage, summary):
+    os.makedirs(ckpt_dir, exist_ok=True)
+    path = os.path.join(ckpt_dir, "state.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"input_hash": input_hash, "stage": stage, "summary": summary, "updated": time.strftime("%Y-%m-%d %H:%M:%S")}, f, default=str)
+    os.replace(path + ".tmp", path)
+
+def resumable_stage(ckpt_dir, input_hash):
+    """
+    (stage, summary) the school can resume from: the checkpoint must match the current inputs and
+    the files it lists must still exist. (None, None) when the school has to be solved again.
+    """
+    state = load_state(ckpt_dir)
+    if state is None: return None, None
+    if state["input_hash"] != input_hash:
+        print("   🔁 Inputs changed since the checkpoint: solving again.")
+        return None, None
+    stage, summary = state["stage"], state["summary"]
+    if summary.get("consolidation") and not os.path.exists(summary["consolidation"]): return None, None
+    # Routes are still good when only the rendered files are gone: they are rendered again
+    if stage == "reported" and not all(os.path.exists(summary[k]) for k in ("report", "manifest")): stage = "solved"
+    return stage, summary
+
+def save_solution(ckpt_dir, prefix, school, nodes, fleet, routes, matrix_dir, tw=None, clock=None):
+    """Stores one solved trip: <prefix>_plan.json (plan_store format, loc_idx = artifact rows) and <prefix>_routes.npz."""
+    os.makedirs(ckpt_dir, exist_ok=True)
+    save_plan(os.path.join(ckpt_dir, f"{prefix}_plan.json"), school, nodes, fleet, routes, matrix_dir, tw, clock)
+    path = os.path.join(ckpt_dir, f"{prefix}_routes.npz")
+    with open(path + ".tmp", "wb") as f: routes.save(f)
+    os.replace(path + ".tmp", path)
+
+def load_solution(ckpt_dir, prefix):
+    """(plan, RouteSolution) stored by save_solution, or (None, None) if the trip was not stored."""
+    path = os.path.join(ckpt_dir, f"{prefix}_plan.json")
+    if not os.path.exists(path): return None, None
+    return load_plan(path), RouteSolution.load(os.path.join(ckpt_dir, f"{prefix}_routes.npz"))
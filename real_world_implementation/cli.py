@@ -0,0 +1,153 @@
+import argparse
+import glob
+import importlib
+import json
+import os
+import sys
+import time
+
+# Only the standard library is imported here: each subcommand imports what it needs
+# (pyodbc for fetch, geopy for geocode, OR-Tools for solve, folium for report...).
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+
+STAGES = ("fetch", "geocode", "diagnose", "matrix", "solve", "report")
+
+def _timed_import(name, timings):
+    t0 = time.perf_counter()
+    module = importlib.import_module(name)
+    timings[f"import {name}"] = timings.get(f"import {name}", 0) + time.perf_counter() - t0
+    return module
+
+def _schools(args, data):
+    schools = data['school']
+    return schools[schools['SchoolID'].isin(args.school)] if args.school else schools
+
+def _locate(args, s_row, timings):
+    school_model = _timed_import("school_model", timings)
+    if args.no_geocode: return 25.2854, 51.5310
+    geopy = _timed_import("geopy.geocoders", timings)
+    return school_model.locate_school(geopy.Nominatim(user_agent="school_optimizer_v14"), s_row)
+
+# Each stage takes the parsed args and the in-memory data of this process, and returns it updated.
+# Stages chained in one `run` call hand DataFrames to each other instead of re-reading CSVs.
+
+def stage_fetch(args, data, timings):
+    fetch = _timed_import("1_fetch_raw_data", timings)
+    data.update(fetch.fetch_raw_data(args.data_dir, save=args.save))
+    return data
+
+def stage_geocode(args, data, timings):
+    geocode = _timed_import("2_geocode_stops", timings)
+    stops = geocode.run_geocoding(data.get('raw_stops'), args.data_dir, save=args.save)
+    if stops is not None: data['stops'] = stops
+    return data
+
+def stage_diagnose(args, data, timings):
+    pd = _timed_import("pandas", timings)
+    diagnostic = _timed_import("diagnostic_stops", timings)
+    stops = data['stops'] if 'stops' in data else pd.read_csv(os.path.join(args.data_dir, 'geocoded_stops.csv'))
+    diagnostic.diagnose_stops(stops)
+    return data
+
+def stage_matrix(args, data, timings):
+    school_model = _timed_import("school_model", timings)
+    matrix_store = _timed_import("matrix_store", timings)
+    config = _timed_import("config", timings)
+    data = school_model.load_pipeline_data(args.data_dir, data)
+    _timed_import("distance", timings).check_osrm()
+    if config.GLOBAL_MATRIX:
+        global_matrix = _timed_import("global_matrix", timings)
+        depots = {s_row['SchoolID']: _locate(args, s_row, timings) for _, s_row in _schools(args, data).iterrows()}
+        global_matrix.build_global_matrix(args.cache_dir, data, depots, resume=args.resume, rebuild=args.rebuild)
+        return data
+    for _, s_row in _schools(args, data).iterrows():
+        s_lat, s_lon = _locate(args, s_row, timings)
+        school = school_model.school_nodes(s_row['SchoolID'], data, s_lat, s_lon)
+        if school is None: continue
+        df_model = school[0]
+        print(f"\n🏫 Matrix: {s_row['SchoolName']} ({len(df_model)} locations)")
+        matrix_store.get_or_build_matrix(os.path.join(args.cache_dir, f"matrix_{school_model.school_safe_name(s_row['SchoolName'])}"),
+                                         df_model['name'], list(zip(df_model['lat'], df_model['lon'])), use_osrm_for_large=True,
+                                         rebuild=args.rebuild, neighbours=config.MATRIX_NEIGHBOURS, resume=args.resume)
+    return data
+
+def stage_solve(args, data, timings):
+    stage3 = _timed_import("3_run_optimization", timings)
+    data = stage3.load_pipeline_data(args.data_dir, data)
+    stage3.distance.DETOUR_MODEL = stage3.calibrate_from_cache(args.cache_dir)
+    stage3.distance.check_osrm()
+    os.makedirs(args.outputs_dir, exist_ok=True)
+    schools = [(s_row, _locate(args, s_row, timings)) for _, s_row in _schools(args, data).iterrows()]
+    global_dir = None
+    if stage3.GLOBAL_MATRIX:
+        global_dir = stage3.build_global_matrix(args.cache_dir, data, {s_row['SchoolID']: loc for s_row, loc in schools}, args.resume)
+    summaries = []
+    for s_row, (s_lat, s_lon) in schools:
+        summary = stage3.optimize_school(s_row, data, s_lat, s_lon, args.cache_dir, args.outputs_dir,
+                                         report=not args.no_report, resume=args.resume, global_matrix_dir=global_dir)
+        if summary: summaries.append(summary)
+    data['solved'] = summaries
+    return data
+
+def stage_report(args, data, timings):
+    replan = _timed_import("replan", timings)
+    _timed_import("distance", timings).check_osrm() # road geometry for the maps
+    os.makedirs(args.outputs_dir, exist_ok=True)
+    for plan_path in sorted(glob.glob(os.path.join(args.cache_dir, "plan_*.json"))):
+        state = replan.load_state(plan_path)
+        if args.school and state["plan"]["school"]["school_id"] not in args.school: continue
+        report_path, csv_path = replan.render_plan_report(state, args.outputs_dir)
+        print(f"📄 Report: {report_path}\n📄 Manifest: {csv_path}")
+    return data
+
+STAGE_FUNCS = {"fetch": stage_fetch, "geocode": stage_geocode, "diagnose": stage_diagnose,
+               "matrix": stage_matrix, "solve": stage_solve, "report": stage_report}
+
+def run_stages(stages, args):
+    """Runs the stages in order in this process; returns (data, timings in seconds)."""
+    data, timings = {}, {}
+    for stage in stages:
+        t0 = time.perf_counter()
+        data = STAGE_FUNCS[stage](args, data, timings)
+        timings[stage] = time.perf_counter() - t0
+    return data, timings
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--data-dir", default=os.path.join(current_dir, 'data'))
+    common.add_argument("--cache-dir", default=os.path.join(current_dir, 'cache'))
+    common.add_argument("--outputs-dir", default=os.path.join(current_dir, 'outputs'))
+    common.add_argument("--school", type=int, nargs="*", help="SchoolIDs to process (default: all)")
+    common.add_argument("--no-geocode", action="store_true", help="Skip school geocoding (central Doha depot)")
+    common.add_argument("--no-report", action="store_true", help="solve: stop after the plan (no map, no manifest)")
+    common.add_argument("--rebuild", action="store_true", help="matrix: ignore the cached artifact(s)")
+    common.add_argument("--resume", action="store_true",
+                        help="matrix / solve: continue an interrupted run (saved tiles, schools whose checkpoint matches their inputs)")
+    common.add_argument("--timings", action="store_true", help="Print import and stage times")
+
+    parser = argparse.ArgumentParser(description="School bus route optimization pipeline.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for stage in STAGES:
+        p = sub.add_parser(stage, parents=[common], help=f"Run the {stage} stage")
+        p.set_defaults(stages=[stage], save=True)
+    run = sub.add_parser("run", parents=[common], help="Chain stages in one process, e.g. `run geocode solve`")
+    run.add_argument("stages", nargs="+", choices=STAGES)
+    run.add_argument("--save", action="store_true", help="Also write the intermediate CSVs (fetch / geocode)")
+    return parser
+
+def main(argv=None):
+    t0 = time.perf_counter()
+    args = build_parser().parse_args(argv)
+    data, timings = run_stages(args.stages, args)
+    if args.timings:
+        print("\n⏱️ Timings:")
+        for name, seconds in timings.items(): print(f"   {name:<32} {seconds:7.2f}s")
+        print(f"   {'total (after interpreter start)':<32} {time.perf_counter() - t0:7.2f}s")
+    if data.get('solved'):
+        print(json.dumps([{k: s[k] for k in ("school_id", "nodes", "routes")} for s in data['solved']]))
+
+if __name__ == "__main__":
+    main()
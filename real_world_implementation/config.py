@@ -10,3 +10,96 @@ DB_CONFIG = {
 # No API Key needed for OpenStreetMap (Nominatim)
 # We just need a custom User-Agent to identify our app
 USER_AGENT = "school_route_optimizer_demo_v1"
+
+# --- Time Windows (Stage 3) ---
+# School bell per SchoolID (HH:MM). Buses must reach the depot before the bell minus the arrival buffer.
+SCHOOL_BELL_TIMES = {
+    10: "07:30",
+    20: "07:30",
+    30: "07:15",
+    40: "07:45",
+    50: "07:45",
+}
+DEFAULT_BELL_TIME = "07:30"
+SCHOOL_ARRIVAL_BUFFER_MIN = 10
+PLANNING_HORIZON_MIN = 180 # Planning clock starts this many minutes before the bell
+# Dwell time per stop = base + per passenger boarding time
+SERVICE_TIME_BASE_MIN = 1.0
+SERVICE_TIME_PER_PAX_MIN = 0.25
+# Longest acceptable ride (pickup -> school) by passenger type
+MAX_RIDE_MIN = {"student": 75, "staff": 90}
+# Cost of leaving a stop unserved (solver cost units: minutes x 1000)
+DROP_PENALTY = 10_000_000
+
+# --- Stop Consolidation (Stage 3) ---
+# Before solving, nearby stops are merged into a smaller covering set so that every passenger walks
+# at most CONSOLIDATION_MAX_WALK_M (straight line x WALK_DETOUR_FACTOR) to a served stop.
+# Off by default: it changes where people board. Reassignments are written to outputs/consolidation_*.csv.
+CONSOLIDATE_STOPS = False
+CONSOLIDATION_MAX_WALK_M = 400
+WALK_DETOUR_FACTOR = 1.3
+
+# --- Afternoon Drop-off (Stage 3) ---
+# Drop-off routes from DropStopMapID, planned next to the morning pickups on the same matrix artifact.
+PLAN_AFTERNOON = True
+SCHOOL_DISMISSAL_TIMES = {
+    10: "14:00",
+    20: "14:00",
+    30: "13:45",
+    40: "12:30",
+    50: "12:30",
+}
+DEFAULT_DISMISSAL_TIME = "14:00"
+
+# --- Time-Dependent Travel Times (Stage 3) ---
+# Duration multiplier per 30-minute departure bucket starting at TD_PROFILE_START (Doha morning peak).
+# The stack is the static OSRM duration matrix scaled by these factors (no per-bucket OSRM profiles).
+TD_PROFILE_START = "05:30"
+TD_BUCKET_MIN = 30
+TD_DURATION_FACTORS = [1.00, 1.05, 1.20, 1.45, 1.55, 1.35, 1.15]
+# Solve / re-freeze rounds of the time-dependent solve; together they get SOLVER_TIME_LIMIT_S
+TD_ITERATIONS = 2
+
+# --- Road Estimates (Stage 3) ---
+# Schools above the OSRM table limit (100 locations) fetch only each stop's k nearest neighbours;
+# other arcs use the detour model calibrated from cached OSRM matrices. 0 = fetch every cell.
+MATRIX_NEIGHBOURS = 0
+# One matrix over the stops of all schools plus their depots, fetched once per run and sliced per
+# school (stops shared by several schools are not fetched again). False: one matrix per school.
+GLOBAL_MATRIX = True
+
+# --- Solve Modes (Stage 3) ---
+# Pickup deadlines from the school bell + per-stop service time (morning and afternoon, scenarios too).
+# False: capacity-only solves on drive times, without ETAs in the manifests.
+USE_TIME_WINDOWS = True
+# Arc times follow the morning traffic profile below (requires time windows). False: static OSRM durations.
+USE_TIME_DEPENDENT = True
+
+# --- Stop Splitting (Stage 3) ---
+# "strict": every stop above min(25, smallest bus) is split (one small van splits everything).
+# "fleet": only stops no bus can carry are split, into parts sized by the real fleet capacities.
+SPLIT_STRATEGY = "fleet"
+# After the first solve, split the stops the solver had to drop for lack of room and solve again.
+SPLIT_LAZY = True
+
+# --- Solver Budget & Route Polishing (Stage 3) ---
+SOLVER_TIME_LIMIT_S = 30 # Guided Local Search budget per solve
+# After the global solve, each route's stop order is improved on its own (2-opt / Or-opt, time windows kept)
+POLISH_ROUTES = True
+POLISH_WORKERS = 0 # Processes for polishing routes in parallel (0 = all cores)
+
+# --- Optimization Service (service.py) ---
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_WORKERS = 2 # Jobs solved concurrently; further jobs wait in the queue
+SERVICE_QUEUE_SIZE = 100 # Submissions beyond this are refused (HTTP 503)
+
+# --- Live ETAs (live_eta.py) ---
+LIVE_ETA_HOST = "127.0.0.1"
+LIVE_ETA_PORT = 8766
+LIVE_QUEUE_SIZE = 10000 # Position events buffered between the socket readers and the ETA engine
+# Positions are snapped to the straight segments between a trip's stops (remaining legs only).
+# Legs within SNAP_TOLERANCE_M of the nearest one are ties and the earliest wins, since buses only move forward.
+SNAP_TOLERANCE_M = 150
+ARRIVED_RADIUS_M = 100 # Closer than this to a stop = the bus is at the stop
+OFF_ROUTE_M = 1500 # Farther than this from every remaining leg = off route (ETAs kept from the last good fix)
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+from config import CONSOLIDATION_MAX_WALK_M, WALK_DETOUR_FACTOR
+
+# Stop consolidation before the solve (location-allocation as a set cover).
+# Every active stop is a candidate; a candidate covers the stops within walking distance of it
+# (straight line x WALK_DETOUR_FACTOR, neighbours found with a k-d tree). A greedy cover picks
+# the candidate covering the most uncovered stops (ties: most passengers), then chosen stops
+# that became redundant are dropped. Removed stops walk to their nearest chosen stop.
+# The kept stops are a subset of the original locations, so the matrix artifact is reused as is.
+
+KM_PER_DEG = 111.32
+
+def _plane_km(lat, lon):
+    """Local equirectangular projection (km), good to a few metres at city scale."""
+    scale = np.cos(np.radians(np.mean(lat)))
+    return np.column_stack((lat, lon * scale)) * KM_PER_DEG
+
+def cover_stops(lat, lon, demand, max_walk_m=CONSOLIDATION_MAX_WALK_M, detour=WALK_DETOUR_FACTOR):
+    """
+    Greedy set cover of the stops by stops within walking distance.
+    Returns (chosen stop indices, assigned chosen stop per stop, walking metres per stop).
+    """
+    demand = np.asarray(demand, dtype=np.float64)
+    n = len(demand)
+    xy = _plane_km(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+    reach = cKDTree(xy).query_ball_point(xy, max_walk_m / detour / 1000.0)
+    cover = csr_matrix((np.ones(sum(len(r) for r in reach)), np.concatenate(list(reach)).astype(np.intp),
+                        np.concatenate([[0], np.cumsum([len(r) for r in reach])])), shape=(n, n))
+
+    uncovered, chosen = np.ones(n, dtype=bool), []
+    weight = demand.sum() + 1.0
+    while uncovered.any():
+        gain = cover @ (uncovered * (weight + demand)) # stops covered first, passengers break ties
+        best = int(np.argmax(gain))
+        chosen.append(best)
+        uncovered[cover[best].indices] = False
+
+    # Redundancy pass: a chosen stop whose stops are all covered by other chosen stops is dropped
+    times_covered = np.asarray(cover[chosen].sum(axis=0)).ravel()
+    for c in sorted(chosen, key=lambda c: demand[c]):
+        covered = cover[c].indices
+        if (times_covered[covered] > 1).all():
+            times_covered[covered] -= 1
+            chosen.remove(c)
+
+    chosen = np.array(sorted(chosen), dtype=np.intp)
+    dist_km, nearest = cKDTree(xy[chosen]).query(xy)
+    return chosen, chosen[nearest], dist_km * 1000.0 * detour
+
+def _join_ids(values):
+    return ", ".join(v for v in values if v)
+
+def consolidate_stops(df_model, max_walk_m=CONSOLIDATION_MAX_WALK_M, detour=WALK_DETOUR_FACTOR):
+    """
+    Merges the stops of a node table (row 0 = SCHOOL depot) into a covering subset.
+    Kept stops take over the passengers, IDs and names of the stops merged into them (walk_ins).
+    Returns (consolidated node table, reassignment table: one row per removed stop).
+    """
+    stops = df_model.iloc[1:].reset_index(drop=True)
+    if len(stops) < 2: return df_model, pd.DataFrame(columns=['stop', 'assigned_to', 'walk_m', 'students', 'staff', 'student_ids', 'staff_ids'])
+    chosen, assigned, walk_m = cover_stops(stops['lat'].to_numpy(), stops['lon'].to_numpy(), stops['demand'].to_numpy(), max_walk_m, detour)
+
+    moved = np.flatnonzero(assigned != np.arange(len(stops)))
+    reassigned = pd.DataFrame({
+        'stop': stops['name'].iloc[moved].to_numpy(), 'assigned_to': stops['name'].iloc[assigned[moved]].to_numpy(),
+        'walk_m': np.round(walk_m[moved]).astype(int), 'students': stops['student_count'].iloc[moved].to_numpy(),
+        'staff': stops['staff_count'].iloc[moved].to_numpy(), 'student_ids': stops['student_ids'].iloc[moved].to_numpy(),
+        'staff_ids': stops['staff_ids'].iloc[moved].to_numpy()})
+
+    rows = [df_model.iloc[0]]
+    for c in chosen:
+        members = np.flatnonzero(assigned == c)
+        row = stops.iloc[c].copy()
+        for col in ('student_count', 'staff_count', 'demand'): row[col] = int(stops[col].iloc[members].sum())
+        row['student_ids'] = _join_ids(stops['student_ids'].iloc[members])
+        row['staff_ids'] = _join_ids(stops['staff_ids'].iloc[members])
+        row['walk_ins'] = ", ".join(f"{stops['name'].iloc[m]} ({walk_m[m]:.0f} m)" for m in members if m != c)
+        rows.append(row)
+    consolidated = pd.DataFrame(rows).reset_index(drop=True)
+    consolidated['loc_idx'] = range(len(consolidated))
+    print(f"   🚶 Stop consolidation: {len(stops)} -> {len(chosen)} stops ({len(moved)} removed, "
+          f"{int(reassigned['students'].sum() + reassigned['staff'].sum())} passengers walk up to {reassigned['walk_m'].max() if len(moved) else 0} m)")
+    return consolidated, reassigned
@@ -0,0 +1,91 @@
+import numpy as np
+
+from matrix_store import match_or_extend_matrix, load_matrix_artifact
+from optimizer import optimize_routes
+from polish import polish_solution
+from solution import RouteSolution
+from time_windows import parse_clock, unserved_nodes
+from config import DROP_PENALTY, SOLVER_TIME_LIMIT_S, POLISH_ROUTES, POLISH_WORKERS, CONSOLIDATE_STOPS, USE_TIME_WINDOWS
+from school_model import school_nodes, split_stops_by_fleet, extend_fleet_trips, build_time_windows
+from checkpoint import save_solution, load_solution
+
+# Afternoon drop-off planning on the morning's matrix artifact.
+# A drop-off trip (school -> stops, ride time limit counted from the school) is a morning pickup
+# trip run backwards. So the afternoon is solved as a pickup problem on the transposed duration
+# matrix (a zero-copy view), with the same time-window rules, and every route is then reversed and
+# re-timed from the dismissal bell. Stops shared with the morning use the same artifact rows;
+# only drop-off-only locations are fetched (one OSRM row + column each).
+
+def mirror_routes(routes, service, demands):
+    """
+    Reverses pickup-form routes (solved on the transposed matrix) into drop-off routes.
+    A stop reached at a_i (reversed time) and left after its service s_i is reached at
+    a_end - a_i - s_i minutes after the bus leaves school; arc costs are unchanged by the reversal.
+    """
+    service, demands = np.asarray(service, dtype=np.float64), np.asarray(demands, dtype=np.int64)
+    nodes, cost, arrival, load = [], [], [], []
+    for r in range(len(routes)):
+        route = routes.route(r)
+        seq, a = route["nodes"][::-1], route["arrival"][::-1]
+        t = a[0] - a - service[seq]
+        t[0], t[-1] = 0.0, a[0] - a[-1] # leave school at 0, back at school after the whole trip
+        arcs = np.diff(route["cost"])[::-1]
+        nodes.append(seq)
+        arrival.append(t)
+        cost.append(np.concatenate([[0.0], np.cumsum(arcs)]))
+        load.append(demands[seq].sum() - np.cumsum(demands[seq])) # on board after each drop
+    offsets = np.concatenate([[0], np.cumsum([len(n) for n in nodes])])
+    concat = lambda parts: np.concatenate(parts) if parts else []
+    return RouteSolution(concat(nodes), offsets, routes.vehicle_ids, routes.distance_meters, concat(cost), concat(arrival), concat(load))
+
+def plan_dropoff(school_id, data, s_lat, s_lon, artifact_dir, dismissal_time):
+    """
+    Drop-off routes for one school from DropStopMapID, on the morning matrix artifact (extended if needed).
+    Returns None if nobody rides home, else a dict with nodes (split), fleet, routes (drop-off order),
+    origin_min (dismissal clock), unserved stop names, the location rows / artifact for reporting,
+    the stop reassignments (None unless CONSOLIDATE_STOPS) and the windows of the reversed problem (tw).
+    Without USE_TIME_WINDOWS, tw and origin_min are None (no drop-off times).
+    """
+    school = school_nodes(school_id, data, s_lat, s_lon, stop_column='DropStopMapID')
+    if school is None: return None
+    df_model, fleet_list = school
+    print(f"   🌇 Afternoon drop-off: {len(df_model) - 1} stops from DropStopMapID, dismissal {dismissal_time}")
+    reassigned = None
+    if CONSOLIDATE_STOPS:
+        from consolidation import consolidate_stops # scipy is only needed when consolidating
+        df_model, reassigned = consolidate_stops(df_model)
+    matrix, rows = match_or_extend_matrix(artifact_dir, df_model['name'], list(zip(df_model['lat'], df_model['lon'])))
+
+    df_split = split_stops_by_fleet(df_model, fleet_list)
+    extended_fleet = extend_fleet_trips(fleet_list, df_split['demand'].sum())
+    node_loc = rows[df_split['loc_idx'].to_numpy()]
+    dur_t = matrix['dur'][np.ix_(node_loc, node_loc)].T # transposed: reversed trips
+    tw = build_time_windows(df_split, dur_t, dismissal_time) if USE_TIME_WINDOWS else None
+    demands = list(df_split['demand'])
+    routes = optimize_routes(dur_t, demands, [f['capacity'] for f in extended_fleet], tw['windows'] if tw else None,
+                             tw['travel_times'] if tw else None, time_limit_s=SOLVER_TIME_LIMIT_S, drop_penalty=DROP_PENALTY)
+    if routes and POLISH_ROUTES:
+        routes, _ = polish_solution(routes, dur_t, demands, tw['travel_times'] if tw else None, tw['windows'] if tw else None, POLISH_WORKERS)
+
+    unserved = [df_split.iloc[n]['name'] for n in unserved_nodes(routes, len(df_split))]
+    if unserved:
+        print(f"   ⚠️ {len(unserved)} drop-off stops left unserved: {', '.join(unserved[:5])}{' ...' if len(unserved) > 5 else ''}")
+    service = tw['service'] if tw else np.zeros(len(df_split))
+    return {"nodes": df_split, "fleet": extended_fleet, "routes": mirror_routes(routes, service, demands),
+            "origin_min": parse_clock(dismissal_time) if tw else None, "unserved": unserved, "node_loc": node_loc, "matrix": matrix,
+            "reassigned": reassigned, "tw": tw}
+
+def save_dropoff(ckpt_dir, school, afternoon, artifact_dir, dismissal_time):
+    """Checkpoints a planned drop-off (mirrored routes; windows are those of the reversed problem)."""
+    tw = {"windows": afternoon["tw"]["windows"], "service": afternoon["tw"]["service"], "origin_min": afternoon["origin_min"]} if afternoon["tw"] else None
+    save_solution(ckpt_dir, "pm", school, afternoon["nodes"].assign(loc_idx=afternoon["node_loc"]), afternoon["fleet"],
+                  afternoon["routes"], artifact_dir, tw, dismissal_time)
+
+def load_dropoff(ckpt_dir):
+    """The drop-off dict of plan_dropoff from a checkpoint (None if no drop-off was stored)."""
+    plan, routes = load_solution(ckpt_dir, "pm")
+    if plan is None: return None
+    nodes = plan["nodes"]
+    return {"nodes": nodes, "fleet": plan["fleet"], "routes": routes, "origin_min": plan["time_windows"]["origin_min"] if plan["time_windows"] else None,
+            "unserved": [nodes.iloc[n]['name'] for n in unserved_nodes(routes, len(nodes))], "node_loc": nodes["loc_idx"].to_numpy(),
+            "matrix": load_matrix_artifact(plan["matrix_dir"]), "reassigned": None, "tw": plan["time_windows"]}
@@ -0,0 +1,99 @@
+import os
+import shutil
+import numpy as np
+
+from distance import create_distance_matrix, estimate_matrix
+from matrix_store import save_matrix_artifact, match_or_extend_matrix, coords_hash, COORD_DECIMALS
+from school_model import school_nodes
+from config import MATRIX_NEIGHBOURS
+
+# One matrix shared by all schools (cache/matrix_GLOBAL). Many physical stops serve several
+# schools, so the union of every school's active pickup / drop-off stops plus the depots is stored
+# once instead of once per school. Only cells inside a school are ever read, so schools are packed
+# into groups whose union still fits one OSRM table request and each group is fetched once; cells
+# between groups keep the estimates. Each school's nodes point at rows of this artifact (loc_idx).
+
+GLOBAL_MATRIX_DIR = "matrix_GLOBAL"
+# OSRM table API limit (same as create_distance_matrix)
+TABLE_LIMIT = 100
+
+def global_locations(data, depots):
+    """
+    Union of the active pickup and drop-off stops of the given schools plus their depots, one row per coordinate.
+    depots: {school_id: (lat, lon)}. Returns (node_ids, coords, members): members holds each school's rows.
+    """
+    index, node_ids, coords, members = {}, [], [], []
+    for school_id, (s_lat, s_lon) in depots.items():
+        rows = set()
+        for column in ('PickupStopMapID', 'DropStopMapID'):
+            school = school_nodes(school_id, data, s_lat, s_lon, stop_column=column)
+            if school is None: continue
+            df_model = school[0]
+            keys = np.round(df_model[['lat', 'lon']].to_numpy(dtype=np.float64), COORD_DECIMALS).tolist()
+            for name, key, lat, lon in zip(df_model['name'], keys, df_model['lat'], df_model['lon']):
+                key = tuple(key)
+                if key not in index:
+                    index[key] = len(coords)
+                    node_ids.append(f"SCHOOL_{school_id}" if name == 'SCHOOL' else name)
+                    coords.append((float(lat), float(lon)))
+                rows.add(index[key])
+        if rows: members.append(sorted(rows))
+    return node_ids, coords, members
+
+def pack_schools(members, limit=TABLE_LIMIT):
+    """
+    First-fit packing of the schools' row sets (largest first) into groups whose union has at most
+    `limit` locations, so each group is one table request. A school above the limit is a group of its own.
+    """
+    groups = []
+    for rows in sorted(members, key=len, reverse=True):
+        for group in groups:
+            if len(group | set(rows)) <= limit:
+                group.update(rows)
+                break
+        else:
+            groups.append(set(rows))
+    return [np.array(sorted(g), dtype=np.intp) for g in groups]
+
+def fetch_groups(coords, groups, tiles_dir=None):
+    """
+    (dist, dur, estimated) over all coords: real road values inside each group, estimates elsewhere
+    (estimated: True where a cell is an estimate, including group cells OSRM could not answer).
+    Groups above the table limit are chunked builds that keep their tiles in tiles_dir (see create_distance_matrix).
+    """
+    dist, dur = estimate_matrix(coords, coords)
+    np.fill_diagonal(dist, 0.0)
+    np.fill_diagonal(dur, 0.0)
+    estimated = ~np.eye(len(coords), dtype=bool)
+    for rows in groups:
+        sub = [coords[r] for r in rows]
+        group_dir = os.path.join(tiles_dir, f"group_{coords_hash(sub)[:12]}") if tiles_dir and len(rows) > TABLE_LIMIT else None
+        d, t, est = create_distance_matrix(sub, use_osrm_for_large=True, neighbours=MATRIX_NEIGHBOURS, checkpoint_dir=group_dir,
+                                           return_estimated=True)
+        dist[np.ix_(rows, rows)] = np.asarray(d)
+        dur[np.ix_(rows, rows)] = np.asarray(t)
+        estimated[np.ix_(rows, rows)] = est
+    return dist, dur, estimated
+
+def build_global_matrix(cache_dir, data, depots, resume=False, rebuild=False):
+    """
+    Builds (or completes) the shared matrix for these schools and returns its directory.
+    A stored artifact is reused and only locations it does not have yet are fetched (rebuild=True: fetched again).
+    """
+    artifact_dir = os.path.join(cache_dir, GLOBAL_MATRIX_DIR)
+    tiles_dir = os.path.join(artifact_dir, "tiles")
+    node_ids, coords, members = global_locations(data, depots)
+    groups = pack_schools(members)
+    print(f"🌍 Global matrix: {len(coords)} distinct locations ({sum(len(m) for m in members)} over the {len(members)} schools), "
+          f"fetched as {len(groups)} school group(s).")
+    unfinished = resume and os.path.isdir(tiles_dir)
+    if os.path.exists(os.path.join(artifact_dir, "meta.json")) and not unfinished and not rebuild:
+        match_or_extend_matrix(artifact_dir, node_ids, coords)
+        return artifact_dir
+
+    if unfinished: print("   ⏯️ Matrix build was interrupted: completing it from the saved tiles.")
+    if not resume: shutil.rmtree(tiles_dir, ignore_errors=True)
+    dist, dur, estimated = fetch_groups(coords, groups, tiles_dir)
+    save_matrix_artifact(artifact_dir, {"dist": dist, "dur": dur, "estimated": estimated}, node_ids, coords)
+    shutil.rmtree(tiles_dir, ignore_errors=True)
+    return artifact_dir
@@ -0,0 +1,407 @@
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import math
+import os
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Add parent directory to path to import the shared modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from matrix_store import load_matrix_artifact
+from time_windows import parse_clock, format_clock, service_times
+from plan_store import load_plan
+from checkpoint import checkpoint_dir
+from config import (TD_PROFILE_START, TD_BUCKET_MIN, TD_DURATION_FACTORS, SERVICE_TIME_BASE_MIN, SERVICE_TIME_PER_PAX_MIN,
+                    LIVE_ETA_HOST, LIVE_ETA_PORT, LIVE_QUEUE_SIZE, SNAP_TOLERANCE_M, ARRIVED_RADIUS_M, OFF_ROUTE_M)
+
+# Live ETAs: the saved plans (morning pickup, afternoon drop-off) and their matrix artifacts are loaded
+# once, then every (bus, lat, lon, timestamp) event updates that bus alone. The position is snapped to
+# the remaining legs of the bus's current trip (straight segments between stops) and the remaining
+# stops are re-timed from there with the matrix durations: O(remaining stops) per event, no solver.
+# Morning legs follow the traffic profile the plan was timed with (time_dependent.route_etas).
+# Events come from a replay file, a TCP line socket or any asyncio.Queue.
+#
+#   python live_eta.py make-replay replay.csv --slowdown 0.3   # events generated from the driver manifests
+#   python live_eta.py replay replay.csv --until 07:00         # ETA board at 07:00 -> outputs/live_etas.csv
+#   python live_eta.py listen                                  # `bus,lat,lon,timestamp` lines; `eta <bus>` queries
+
+KM_PER_DEG_LAT = 110.574
+KM_PER_DEG_LON = 111.320 # at the equator, times cos(latitude)
+SNAP_TOLERANCE_KM, ARRIVED_KM, OFF_ROUTE_KM = SNAP_TOLERANCE_M / 1000, ARRIVED_RADIUS_M / 1000, OFF_ROUTE_M / 1000
+PROFILE_START_MIN = parse_clock(TD_PROFILE_START)
+
+def plate_of(vehicle_name):
+    """'235825 (Trip 2)' -> '235825': extra trips are run by the same physical bus."""
+    return str(vehicle_name).split(" (Trip")[0]
+
+def _clock(moment):
+    return moment.hour * 60 + moment.minute + (moment.second + moment.microsecond / 1e6) / 60
+
+def parse_timestamp(value):
+    """Event time -> clock minutes: 'HH:MM[:SS]', an ISO datetime or epoch seconds (local time)."""
+    if isinstance(value, str):
+        value = value.strip()
+        if len(value) <= 8 and ":" in value:
+            parts = value.split(":")
+            return int(parts[0]) * 60 + int(parts[1]) + (float(parts[2]) / 60 if len(parts) > 2 else 0.0)
+        try:
+            value = float(value)
+        except ValueError:
+            return _clock(datetime.fromisoformat(value))
+    return _clock(datetime.fromtimestamp(float(value)))
+
+def format_timestamp(minutes):
+    """Clock minutes -> 'HH:MM:SS'."""
+    seconds = int(round(minutes * 60))
+    return f"{(seconds // 3600) % 24:02d}:{(seconds // 60) % 60:02d}:{seconds % 60:02d}"
+
+def parse_event(record):
+    """(bus, lat, lon, clock minutes) from a dict with bus, lat, lon and timestamp."""
+    return str(record["bus"]), float(record["lat"]), float(record["lon"]), parse_timestamp(record["timestamp"])
+
+def leg_minutes(buckets, t):
+    """Drive time of a leg left at clock t: interpolated between traffic buckets, as time_dependent.bucket_weights."""
+    if len(buckets) == 1: return buckets[0]
+    pos = min(max((t - PROFILE_START_MIN) / TD_BUCKET_MIN, 0.0), len(buckets) - 1)
+    b0 = int(pos)
+    b1 = min(b0 + 1, len(buckets) - 1)
+    return (1 - (pos - b0)) * buckets[b0] + (pos - b0) * buckets[b1]
+
+def build_trip(plan, route, vehicle_name, matrix, traffic):
+    """
+    Everything one trip needs per event, precomputed: stop names, planned clock times, service minutes,
+    leg durations (one value per traffic bucket with traffic=True) and the legs as planar segments in km.
+    """
+    nodes, tw = plan["nodes"], plan["time_windows"]
+    seq = np.array([step["node"] for step in route["route"]])
+    rows = nodes["loc_idx"].to_numpy()[seq]
+    lat, lon = nodes["lat"].to_numpy(dtype=np.float64)[seq], nodes["lon"].to_numpy(dtype=np.float64)[seq]
+    service = np.asarray(tw["service"], dtype=np.float64)[seq] if tw else np.zeros(len(seq))
+    service[0] = service[-1] = 0.0
+    planned = (tw["origin_min"] + np.array([step.get("arrival_time", np.nan) for step in route["route"]], dtype=np.float64)
+               if tw else np.full(len(seq), np.nan))
+    if traffic:
+        legs = np.asarray(TD_DURATION_FACTORS, dtype=np.float64)[:, None] * np.asarray(matrix["dur"][rows[:-1], rows[1:]], dtype=np.float64)
+    else:
+        legs = np.asarray(matrix["dur"][rows[:-1], rows[1:]], dtype=np.float64)[None, :]
+
+    kx = KM_PER_DEG_LON * math.cos(math.radians(lat[0]))
+    x, y = (lon - lon[0]) * kx, (lat - lat[0]) * KM_PER_DEG_LAT
+    abx, aby = np.diff(x), np.diff(y)
+    len2 = abx * abx + aby * aby
+    return {"name": vehicle_name, "school": plan["school"]["school_name"], "names": nodes["name"].to_numpy()[seq].tolist(),
+            "planned": planned.tolist(), "start": planned[0] if np.isfinite(planned[0]) else -np.inf,
+            "service": service.tolist(), "legs": legs.T.tolist(), "observed": [np.nan] * len(seq),
+            "lat0": lat[0], "lon0": lon[0], "kx": kx, "ax": x[:-1], "ay": y[:-1], "abx": abx, "aby": aby,
+            "len2": np.where(len2 > 0, len2, 1.0), "length": np.sqrt(len2).tolist()}
+
+def snap(trip, first_leg, lat, lon):
+    """
+    (leg, fraction along it, distance km) of a position on the trip's legs from first_leg on (vectorized).
+    Legs within SNAP_TOLERANCE_KM of the nearest one are ties: the earliest wins, buses only move forward.
+    """
+    px = (lon - trip["lon0"]) * trip["kx"] - trip["ax"][first_leg:]
+    py = (lat - trip["lat0"]) * KM_PER_DEG_LAT - trip["ay"][first_leg:]
+    abx, aby = trip["abx"][first_leg:], trip["aby"][first_leg:]
+    r = np.clip((px * abx + py * aby) / trip["len2"][first_leg:], 0.0, 1.0)
+    dx, dy = px - r * abx, py - r * aby
+    d2 = dx * dx + dy * dy
+    i = int(np.argmax(d2 <= (math.sqrt(d2.min()) + SNAP_TOLERANCE_KM) ** 2))
+    return first_leg + i, float(r[i]), math.sqrt(d2[i])
+
+class LiveEtaEngine:
+    def __init__(self):
+        self.buses = {} # plate -> state: its trips in running order and the progress on the current one
+        self.stop_coords = {} # (school name, stop name) -> (lat, lon)
+        self.schools = {} # school name -> safe name
+        self.stats = {"events": 0, "unknown_bus": 0, "stale": 0, "off_route": 0, "trips_done": 0}
+
+    def add_plan(self, plan, traffic):
+        """Adds a loaded plan's trips (traffic=True: legs follow the morning traffic profile). Returns the number of trips."""
+        matrix = load_matrix_artifact(plan["matrix_dir"])
+        nodes = plan["nodes"]
+        self.schools[plan["school"]["school_name"]] = plan["school"]["safe_name"]
+        for name, lat, lon in zip(nodes["name"], nodes["lat"], nodes["lon"]):
+            self.stop_coords[(plan["school"]["school_name"], name)] = (float(lat), float(lon))
+        added = 0
+        for route in plan["routes"]:
+            if len(route["route"]) < 2: continue
+            vehicle_name = plan["fleet"][route["vehicle_id"]]["name"]
+            state = self.buses.setdefault(plate_of(vehicle_name), {"trips": [], "trip": 0, "leg": 0, "r": 0.0, "stop": None,
+                                                                    "since": None, "t": -np.inf, "etas": [], "off_route": False})
+            state["trips"].append(build_trip(plan, route, vehicle_name, matrix, traffic))
+            state["trips"].sort(key=lambda trip: trip["start"])
+            added += 1
+        return added
+
+    def _next_trip(self, state, t):
+        state["trip"] += 1
+        state["leg"], state["r"], state["stop"], state["since"], state["etas"] = 0, 0.0, 0, t, []
+        self.stats["trips_done"] += 1
+        return state["trips"][state["trip"]] if state["trip"] < len(state["trips"]) else None
+
+    def update(self, bus, lat, lon, t):
+        """
+        One position event (t in clock minutes). Returns the bus's next stop, its ETA and delay vs the plan,
+        and the ETA at the trip's last stop; None for unknown buses, out-of-order events and finished buses.
+        """
+        self.stats["events"] += 1
+        state = self.buses.get(bus)
+        if state is None:
+            self.stats["unknown_bus"] += 1
+            return None
+        if t < state["t"]:
+            self.stats["stale"] += 1
+            return None
+        state["t"] = t
+        trips = state["trips"]
+        if state["trip"] >= len(trips): return None
+        trip = trips[state["trip"]]
+        leg, r, d = snap(trip, state["leg"], lat, lon)
+        if d > OFF_ROUTE_KM:
+            # The end of the last trip was missed (no fix at school): a later trip that has started takes over
+            later = state["trip"] + 1
+            if later < len(trips) and trips[later]["start"] <= t and snap(trips[later], 0, lat, lon)[2] <= OFF_ROUTE_KM:
+                trip = self._next_trip(state, t)
+                leg, r, d = snap(trip, 0, lat, lon)
+            else:
+                state["off_route"] = True
+                self.stats["off_route"] += 1
+                return self._recompute(bus, state, trip, t)
+        state["off_route"] = False
+
+        length = trip["length"][leg]
+        stop = None
+        if d <= ARRIVED_KM and r >= 0.5 and (1 - r) * length <= ARRIVED_KM: stop = leg + 1
+        elif d <= ARRIVED_KM and r * length <= ARRIVED_KM: stop = leg
+        if stop == len(trip["names"]) - 1:
+            trip["observed"][stop] = t
+            trip = self._next_trip(state, t)
+            if trip is None: return None
+            stop = 0
+        elif stop is not None and stop != state["stop"]:
+            trip["observed"][stop] = t
+            state["since"] = t
+        elif stop is not None:
+            # Stops at the same place are served one after the other without moving: count the dwell off
+            last, length, service = len(trip["names"]) - 2, trip["length"], trip["service"]
+            while stop < last and length[stop] <= ARRIVED_KM and t >= state["since"] + service[stop]:
+                state["since"] += service[stop] + leg_minutes(trip["legs"][stop], state["since"] + service[stop])
+                stop += 1
+                trip["observed"][stop] = state["since"]
+        if stop is not None:
+            state["leg"], state["r"], state["stop"] = stop, 0.0, stop
+        else:
+            state["leg"], state["r"], state["stop"] = leg, r, None
+        return self._recompute(bus, state, trip, t)
+
+    def _recompute(self, bus, state, trip, t):
+        """ETAs of the remaining stops: left to right, each leg timed at its own departure (O(remaining stops))."""
+        k, legs, service = state["leg"], trip["legs"], trip["service"]
+        if state["stop"] is not None:
+            # At a stop: boarding takes its service time; no trip leaves school before its planned start
+            depart = max(t, state["since"] + service[k], trip["start"] if k == 0 else -np.inf)
+            arrival = depart + leg_minutes(legs[k], depart)
+        else:
+            arrival = t + (1.0 - state["r"]) * leg_minutes(legs[k], t)
+        etas = [arrival]
+        for j in range(k + 1, len(legs)):
+            depart = arrival + service[j]
+            arrival = depart + leg_minutes(legs[j], depart)
+            etas.append(arrival)
+        state["etas"] = etas
+        return {"bus": bus, "trip": trip["name"], "next_stop": trip["names"][k + 1], "eta": etas[0],
+                "delay_min": etas[0] - trip["planned"][k + 1], "final_eta": etas[-1], "off_route": state["off_route"]}
+
+    def remaining(self, bus):
+        """The bus's current trip: remaining stops with planned time and live ETA (empty before its first event)."""
+        state = self.buses.get(bus)
+        if state is None or state["trip"] >= len(state["trips"]) or not state["etas"]: return []
+        trip, first = state["trips"][state["trip"]], state["leg"] + 1
+        return [{"stop": trip["names"][j], "planned": format_clock(trip["planned"][j]) if np.isfinite(trip["planned"][j]) else "",
+                 "eta": format_clock(eta), "delay_min": round(eta - trip["planned"][j], 1)}
+                for j, eta in zip(range(first, len(trip["names"])), state["etas"])]
+
+    def snapshot(self):
+        """ETA board: one row per remaining stop of every bus that is on a trip."""
+        rows = []
+        for bus, state in self.buses.items():
+            for stop in self.remaining(bus):
+                trip = state["trips"][state["trip"]]
+                rows.append({"School": trip["school"], "Bus Plate": bus, "Trip": trip["name"], "Stop Name": stop["stop"],
+                             "Planned Time": stop["planned"], "Live ETA": stop["eta"], "Delay (min)": stop["delay_min"],
+                             "Off Route": "yes" if state["off_route"] else ""})
+        return pd.DataFrame(rows)
+
+def load_engine(cache_dir, school_ids=None):
+    """Engine over the saved plans in cache_dir: each school's morning plan and, where stored, its afternoon drop-off."""
+    engine, plans, trips = LiveEtaEngine(), 0, 0
+    for plan_path in sorted(glob.glob(os.path.join(cache_dir, "plan_*.json"))):
+        plan = load_plan(plan_path)
+        if school_ids and plan["school"]["school_id"] not in school_ids: continue
+        trips += engine.add_plan(plan, traffic=True)
+        plans += 1
+        pm_path = os.path.join(checkpoint_dir(cache_dir, plan["school"]["safe_name"]), "pm_plan.json")
+        if os.path.exists(pm_path):
+            trips += engine.add_plan(load_plan(pm_path), traffic=False)
+            plans += 1
+    print(f"🚌 Live ETAs: {len(engine.buses)} buses, {trips} trips from {plans} plans.")
+    return engine
+
+def read_events(path):
+    """(bus, lat, lon, clock minutes) from a replay file: CSV with a bus,lat,lon,timestamp header, or JSON lines."""
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith((".jsonl", ".json")):
+            for line in f:
+                if line.strip(): yield parse_event(json.loads(line))
+        else:
+            for row in csv.DictReader(f): yield parse_event(row)
+
+def make_replay(engine, manifest_paths, out_path, interval_s=15, slowdown=0.0, noise_m=0.0, seed=0):
+    """
+    Position events for every bus from driver manifests: each trip reaches its stops at their Planned Time and
+    boards for the stop's service time, positions are interpolated in between every interval_s seconds.
+    A bus runs its trips one after the other.
+    slowdown: each bus drives up to this fraction slower than planned (drawn per bus); noise_m: GPS noise.
+    Returns the number of events written.
+    """
+    rng = np.random.default_rng(seed)
+    trips = {}
+    for path in manifest_paths:
+        df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        for (school, vehicle, _), rows in df.groupby(["School", "Bus Plate", "Trip Type"], sort=False):
+            rows = rows.sort_values("Sequence", key=lambda s: s.astype(int))
+            # Plans without time windows (empty) and reversed-AM placeholders ("N/A") have nothing to replay against
+            if not rows["Planned Time"].str.match(r"^\d{1,2}:\d{2}$").all(): continue
+            times = np.array([parse_clock(t) for t in rows["Planned Time"]], dtype=np.float64)
+            dwell = service_times(rows["Total Pax"].astype(int), SERVICE_TIME_BASE_MIN, SERVICE_TIME_PER_PAX_MIN)
+            points = np.array([engine.stop_coords[(school, name)] for name in rows["Stop Name"]])
+            trips.setdefault(plate_of(vehicle), []).append((times, dwell, points))
+
+    frames = []
+    for plate, plate_trips in trips.items():
+        factor, free = 1.0 + rng.uniform(0, slowdown), -np.inf
+        for times, dwell, points in sorted(plate_trips, key=lambda trip: trip[0][0]):
+            # The bus boards at each stop for its service time, the driving in between is slowed down
+            drive = np.maximum(np.diff(times) - dwell[:-1], 0) * factor
+            depart = max(times[0], free) + np.concatenate([[0], np.cumsum(dwell[:-1] + drive)]) + dwell
+            arrive = depart - dwell
+            times, points = np.column_stack([arrive, depart]).ravel(), np.repeat(points, 2, axis=0)
+            sample = np.union1d(np.arange(times[0], times[-1], interval_s / 60), times)
+            lat, lon = np.interp(sample, times, points[:, 0]), np.interp(sample, times, points[:, 1])
+            if noise_m:
+                lat = lat + rng.normal(0, noise_m / 1000 / KM_PER_DEG_LAT, len(sample))
+                lon = lon + rng.normal(0, noise_m / 1000 / (KM_PER_DEG_LON * math.cos(math.radians(points[0, 0]))), len(sample))
+            frames.append(pd.DataFrame({"bus": plate, "lat": lat.round(6), "lon": lon.round(6), "t": sample}))
+            free = times[-1]
+    events = pd.concat(frames, ignore_index=True).sort_values("t", kind="stable") if frames else pd.DataFrame(columns=["bus", "lat", "lon", "t"])
+    events["timestamp"] = [format_timestamp(t) for t in events["t"]]
+    events[["bus", "lat", "lon", "timestamp"]].to_csv(out_path, index=False)
+    return len(events)
+
+async def consume(engine, queue, on_update=None):
+    """Feeds events from an asyncio.Queue into the engine until a None arrives."""
+    while True:
+        event = await queue.get()
+        if event is None: break
+        result = engine.update(*event)
+        if on_update and result: on_update(result)
+
+def parse_line(text):
+    """A socket line: JSON {"bus", "lat", "lon", "timestamp"} or CSV bus,lat,lon,timestamp."""
+    if text.startswith("{"): return parse_event(json.loads(text))
+    bus, lat, lon, timestamp = text.split(",")
+    return bus.strip(), float(lat), float(lon), parse_timestamp(timestamp)
+
+async def listen(engine, host=LIVE_ETA_HOST, port=LIVE_ETA_PORT, queue_size=LIVE_QUEUE_SIZE):
+    """Line socket: every event line is queued for the engine (backpressure when full); `eta <bus>` answers with JSON."""
+    queue = asyncio.Queue(maxsize=queue_size)
+    consumer = asyncio.create_task(consume(engine, queue))
+
+    async def handle(reader, writer):
+        try:
+            async for line in reader:
+                text = line.decode("utf-8").strip()
+                if not text: continue
+                if text.startswith("eta "):
+                    bus = text[4:].strip()
+                    writer.write((json.dumps({"bus": bus, "stops": engine.remaining(bus)}) + "\n").encode("utf-8"))
+                    await writer.drain()
+                    continue
+                try:
+                    await queue.put(parse_line(text))
+                except (ValueError, KeyError) as e:
+                    writer.write((json.dumps({"error": f"{type(e).__name__}: {e}", "line": text}) + "\n").encode("utf-8"))
+                    await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"🛰️ Live ETAs on tcp://{host}:{server.sockets[0].getsockname()[1]}: send `bus,lat,lon,timestamp` lines, "
+          f"`eta <bus>` returns the bus's remaining stops.")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        consumer.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(description="Live ETAs from bus position events on the saved plans.")
+    parser.add_argument("--cache-dir", default=os.path.join(current_dir, 'cache'))
+    parser.add_argument("--outputs-dir", default=os.path.join(current_dir, 'outputs'))
+    parser.add_argument("--school", type=int, nargs="*", help="SchoolIDs to load (default: all)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    make = sub.add_parser("make-replay", help="Write a position replay file (CSV) from the driver manifests")
+    make.add_argument("out")
+    make.add_argument("--interval-s", type=float, default=15, help="Seconds between two positions of a bus")
+    make.add_argument("--slowdown", type=float, default=0.0, help="Buses drive up to this fraction slower than planned")
+    make.add_argument("--noise-m", type=float, default=0.0, help="GPS noise (standard deviation, meters)")
+    make.add_argument("--seed", type=int, default=0)
+    replay = sub.add_parser("replay", help="Feed a replay file (CSV or JSON lines) through the engine")
+    replay.add_argument("path")
+    replay.add_argument("--until", default=None, help="Stop at this clock time (HH:MM) and write the ETA board")
+    serve = sub.add_parser("listen", help="Take position events on a TCP line socket")
+    serve.add_argument("--host", default=LIVE_ETA_HOST)
+    serve.add_argument("--port", type=int, default=LIVE_ETA_PORT)
+    args = parser.parse_args()
+
+    engine = load_engine(args.cache_dir, args.school)
+    if args.command == "make-replay":
+        manifests = [os.path.join(args.outputs_dir, f"manifest_{safe_name}.csv") for safe_name in sorted(set(engine.schools.values()))]
+        manifests = [m for m in manifests if os.path.exists(m)]
+        count = make_replay(engine, manifests, args.out, args.interval_s, args.slowdown, args.noise_m, args.seed)
+        print(f"💾 Replay: {count} position events from {len(manifests)} manifests -> {args.out}")
+    elif args.command == "replay":
+        events = list(read_events(args.path))
+        if args.until: events = [e for e in events if e[3] <= parse_clock(args.until)]
+        t0 = time.perf_counter()
+        for event in events: engine.update(*event)
+        seconds = time.perf_counter() - t0
+        s = engine.stats
+        print(f"⚡ {s['events']} events in {seconds:.2f}s ({s['events'] / max(seconds, 1e-9):,.0f} events/s): "
+              f"{s['trips_done']} trips completed, {s['off_route']} off-route, {s['stale']} out of order, {s['unknown_bus']} unknown buses.")
+        board = engine.snapshot()
+        if len(board):
+            os.makedirs(args.outputs_dir, exist_ok=True)
+            path = os.path.join(args.outputs_dir, "live_etas.csv")
+            board.to_csv(path, index=False)
+            late = board.groupby("Bus Plate")["Delay (min)"].max().sort_values(ascending=False)
+            print(f"🕒 ETA board ({board['Bus Plate'].nunique()} buses on a trip) -> {path}")
+            for bus, delay in late.head(5).items(): print(f"   {bus}: up to {delay:+.1f} min vs plan")
+    else:
+        try:
+            asyncio.run(listen(engine, args.host, args.port))
+        except KeyboardInterrupt:
+            print("\n👋 Live ETAs stopped.")
+
+if __name__ == "__main__":
+    main()
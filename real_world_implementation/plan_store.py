@@ -0,0 +1,41 @@
+import json
+import os
+import pandas as pd
+
+def save_plan(path, school, df_model_split, fleet, routes, matrix_dir, tw=None, bell_time=None):
+    """
+    Persists a solved school so later stages (re-planning, live ETAs) can pick it up without re-solving.
+    school: dict with school_id, school_name, safe_name, lat, lon.
+    The matrix itself is not copied: matrix_dir points at the school's matrix artifact and
+    each node's loc_idx is its row there.
+    """
+    plan = {
+        "school": school,
+        "nodes": json.loads(df_model_split.to_json(orient="records")),
+        "fleet": [{"name": f["name"], "capacity": int(f["capacity"])} for f in fleet],
+        "routes": routes.to_routes() if hasattr(routes, "to_routes") else routes,
+        "matrix_dir": os.path.relpath(matrix_dir, os.path.dirname(os.path.abspath(path))),
+        "time_windows": None
+    }
+    if tw:
+        plan["time_windows"] = {
+            "windows": [[int(e), int(l)] for e, l in tw["windows"]],
+            "service": [float(s) for s in tw["service"]],
+            "origin_min": int(tw["origin_min"]),
+            "bell_time": bell_time,
+            # Time-dependent plans: the traffic profile their ETAs follow (see time_dependent.route_etas)
+            "traffic": tw.get("traffic")
+        }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Written to a temporary file and renamed, so an interrupted run never leaves half a plan
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(plan, f)
+    os.replace(path + ".tmp", path)
+
+def load_plan(path):
+    """Loads a plan saved by save_plan. 'nodes' comes back as a DataFrame, matrix_dir as an absolute path."""
+    with open(path, encoding="utf-8") as f:
+        plan = json.load(f)
+    plan["nodes"] = pd.DataFrame(plan["nodes"])
+    plan["matrix_dir"] = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(path)), plan["matrix_dir"]))
+    return plan
@@ -0,0 +1,429 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# Add parent directory to path to import the shared modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from matrix_store import load_matrix_artifact, extend_matrix, extend_matrix_artifact, locate_nodes, submatrix
+from time_windows import unserved_nodes
+from plan_store import load_plan, save_plan
+from school_model import build_time_windows
+from time_dependent import bucket_weights, build_td_stack, route_etas
+
+# Incremental re-planning: apply one change (add / remove / move a stop, or a demand change)
+# to a saved plan without re-running Stage 3. New locations only cost one OSRM row + column,
+# insertion positions are scored for every bus at once with numpy.
+
+INSERTION_TRIES = 10 # cheapest insertion positions re-timed exactly before a stop is reported unserved
+
+def load_state(plan_path):
+    """Loads a saved plan together with its (memory-mapped) location-level matrix artifact."""
+    plan = load_plan(plan_path)
+    return {"path": plan_path, "plan": plan, "matrix": load_matrix_artifact(plan["matrix_dir"])}
+
+def _base_name(name):
+    return str(name).split(" (Part")[0]
+
+def _arrays(state):
+    plan = state["plan"]
+    nodes = plan["nodes"]
+    tw = plan["time_windows"]
+    windows = np.asarray(tw["windows"], dtype=np.float64) if tw else None
+    service = np.asarray(tw["service"], dtype=np.float64) if tw else np.zeros(len(nodes))
+    return nodes["loc_idx"].to_numpy(), nodes["demand"].to_numpy(), windows, service
+
+def _traffic(state):
+    """The traffic profile of a time-dependent plan (saved by Stage 3), None for static plans."""
+    tw = state["plan"]["time_windows"]
+    return tw.get("traffic") if tw else None
+
+def _arc_minutes(state, la, lb, depart_clock):
+    """Drive minutes between artifact rows (scalars or arrays) when leaving at depart_clock: the plan's traffic profile, else static."""
+    traffic, dur = _traffic(state), state["matrix"]["dur"]
+    if traffic is None: return np.asarray(dur[la, lb], dtype=np.float64)
+    factors = np.asarray(traffic["factors"], dtype=np.float64)
+    b0, b1, w = bucket_weights(depart_clock, traffic["profile_start_min"], traffic["bucket_min"], len(factors))
+    return np.asarray(dur[la, lb], dtype=np.float64) * ((1 - w) * factors[b0] + w * factors[b1])
+
+def _route_stack(state, rows):
+    """Traffic stack (buckets, k, k) over the artifact rows of one route, for route_etas."""
+    return build_td_stack(state["matrix"]["dur"][np.ix_(rows, rows)], _traffic(state)["factors"])
+
+def _route_of(state, node):
+    for r in state["plan"]["routes"]:
+        if any(step["node"] == node for step in r["route"][1:-1]):
+            return r
+    return None
+
+def retime_route(state, seq, start_time=None, arrays=None):
+    """
+    Rebuilds the route steps for a node sequence: cumulative cost (minutes, as optimize_routes
+    reports when optimizing on durations) and, with time windows, arrival times.
+    Time-dependent plans are re-timed with route_etas on their traffic profile (as Stage 3 does);
+    static plans wait for the windows' earliest times. arrays: _arrays(state), when the caller has them.
+    Returns: (steps, cost in solver units, time-window feasible).
+    """
+    loc, _, windows, service = arrays if arrays is not None else _arrays(state)
+    t = start_time if start_time is not None else 0.0
+    traffic = _traffic(state)
+    if traffic is not None:
+        origin = state["plan"]["time_windows"]["origin_min"]
+        seq_service = service[seq]
+        etas = np.array(route_etas(range(len(seq)), _route_stack(state, loc[seq]), origin + t, seq_service,
+                                   traffic["profile_start_min"], traffic["bucket_min"])) - origin
+        drive = np.concatenate([[0.0], np.cumsum(np.diff(etas) - seq_service[:-1])])
+        steps = [{"node": int(node), "cumulative_distance": float(c), "arrival_time": float(a)} for node, c, a in zip(seq, drive, etas)]
+        return steps, int(round(drive[-1] * 1000)), bool(np.all(etas <= windows[seq, 1] + 1e-6))
+
+    dur = state["matrix"]["dur"]
+    cost, steps, feasible = 0.0, [], True
+    for i, node in enumerate(seq):
+        if i > 0:
+            arc = float(dur[loc[seq[i - 1]], loc[node]])
+            cost += arc
+            if windows is not None:
+                t = max(t + service[seq[i - 1]] + arc, windows[node, 0] if 0 < i < len(seq) - 1 else 0)
+        step = {"node": int(node), "cumulative_distance": cost}
+        if windows is not None:
+            step["arrival_time"] = t
+            feasible = feasible and t <= windows[node, 1] + 1e-6
+        steps.append(step)
+    return steps, int(round(cost * 1000)), feasible
+
+def insertion_candidates(state, node):
+    """
+    Feasible positions for `node` across all buses, cheapest first (vectorized delta cost).
+    Candidates are every consecutive pair of every route plus the largest idle bus.
+    Checks capacity and, with time windows, the node's own deadline and the downstream slack;
+    on time-dependent plans each arc is timed at its departure (the exact check is retime_route).
+    Returns a list of dict(vehicle_id, position, delta_min).
+    """
+    plan = state["plan"]
+    loc, demand, windows, service = _arrays(state)
+    origin = plan["time_windows"]["origin_min"] if plan["time_windows"] else 0
+    caps = np.array([f["capacity"] for f in plan["fleet"]])
+
+    A, B, V, P, ARR, SLACK, loads = [], [], [], [], [], [], {}
+    for r in plan["routes"]:
+        seq = [step["node"] for step in r["route"]]
+        n_pairs = len(seq) - 1
+        A += seq[:-1]; B += seq[1:]; V += [r["vehicle_id"]] * n_pairs; P += list(range(1, len(seq)))
+        loads[r["vehicle_id"]] = int(demand[seq].sum())
+        if windows is not None:
+            arr = np.array([step["arrival_time"] for step in r["route"]], dtype=np.float64)
+            slack = windows[seq, 1] - arr
+            ARR += list(arr[:-1])
+            SLACK += list(np.minimum.accumulate(slack[::-1])[::-1][1:])
+    idle = [v for v in range(len(caps)) if v not in loads]
+    if idle:
+        v = max(idle, key=lambda v: caps[v])
+        A.append(0); B.append(0); V.append(v); P.append(1); loads[v] = 0
+        if windows is not None:
+            ARR.append(max(0.0, windows[node, 0] - float(_arc_minutes(state, loc[0], loc[node], origin + windows[node, 0])))); SLACK.append(np.inf)
+    if not A: return []
+
+    A, B, V = np.array(A), np.array(B), np.array(V)
+    la, lb, ln = loc[A], loc[B], loc[node]
+    depart = origin + np.array(ARR) + service[A] if windows is not None else np.full(len(A), float(origin))
+    to_new = _arc_minutes(state, la, ln, depart)
+    from_new = _arc_minutes(state, ln, lb, depart + to_new + service[node])
+    delta = to_new + from_new - _arc_minutes(state, la, lb, depart)
+
+    ok = np.array([loads[v] for v in V]) + demand[node] <= caps[V]
+    if windows is not None:
+        arrival_new = np.maximum(np.array(ARR) + service[A] + to_new, windows[node, 0])
+        ok &= arrival_new <= windows[node, 1]
+        ok &= delta + service[node] <= np.array(SLACK)
+
+    order = np.flatnonzero(ok)[np.argsort(delta[ok], kind="stable")]
+    return [{"vehicle_id": int(V[i]), "position": int(P[i]), "delta_min": float(delta[i])} for i in order]
+
+def best_insertion(state, node):
+    """Cheapest feasible position for `node` (see insertion_candidates), or None if no bus can take it."""
+    candidates = insertion_candidates(state, node)
+    return candidates[0] if candidates else None
+
+def relocate_repair(state, seq, start_time, max_passes=3):
+    """Short local repair: move single stops within the route while the duration drops (keeps time-window feasibility)."""
+    arrays = _arrays(state)
+    _, best_cost, _ = retime_route(state, seq, start_time, arrays)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, len(seq) - 1):
+            for j in range(1, len(seq) - 1):
+                if i == j: continue
+                cand = seq[:i] + seq[i + 1:]
+                cand.insert(j, seq[i])
+                _, c, ok = retime_route(state, cand, start_time, arrays)
+                if ok and c < best_cost:
+                    seq, best_cost, improved = cand, c, True
+                    break
+            if improved: break
+        if not improved: break
+    return seq
+
+def _set_route(state, vehicle_id, seq, start_time, repair, require_feasible=False):
+    """Writes one bus's route; with require_feasible a sequence that misses a window is not written (returns False)."""
+    plan = state["plan"]
+    if repair: seq = relocate_repair(state, seq, start_time)
+    steps, cost, feasible = retime_route(state, seq, start_time)
+    if require_feasible and not feasible: return False
+    plan["routes"] = [r for r in plan["routes"] if r["vehicle_id"] != vehicle_id]
+    if len(seq) > 2:
+        plan["routes"].append({"vehicle_id": vehicle_id, "route": steps, "distance_meters": cost})
+        plan["routes"].sort(key=lambda r: r["vehicle_id"])
+    return True
+
+def _remove_from_route(state, node, repair):
+    r = _route_of(state, node)
+    if r is None: return None
+    seq = [step["node"] for step in r["route"] if step["node"] != node or step is r["route"][0] or step is r["route"][-1]]
+    _set_route(state, r["vehicle_id"], seq, r["route"][0].get("arrival_time"), repair)
+    return r["vehicle_id"]
+
+def _insert(state, node, repair):
+    # The vectorized check is first-order: the cheapest candidates are re-timed exactly until one keeps every window
+    for choice in insertion_candidates(state, node)[:INSERTION_TRIES]:
+        r = next((r for r in state["plan"]["routes"] if r["vehicle_id"] == choice["vehicle_id"]), None)
+        if r is None:
+            seq, start = [0, node, 0], None
+            if state["plan"]["time_windows"]:
+                _, _, windows, _ = _arrays(state)
+                loc = state["plan"]["nodes"]["loc_idx"].to_numpy()
+                origin = state["plan"]["time_windows"]["origin_min"]
+                start = max(0.0, windows[node, 0] - float(_arc_minutes(state, loc[0], loc[node], origin + windows[node, 0])))
+        else:
+            seq = [step["node"] for step in r["route"]]
+            seq.insert(choice["position"], node)
+            start = r["route"][0].get("arrival_time")
+        if _set_route(state, choice["vehicle_id"], seq, start, repair, require_feasible=True): return choice
+    return None
+
+def _refresh_time_window(state, node):
+    """Recomputes one node's window / service time (demand changed or node is new)."""
+    plan = state["plan"]
+    tw = plan["time_windows"]
+    if not tw: return
+    nodes, dur = plan["nodes"], state["matrix"]["dur"]
+    l0, ln = int(nodes.iloc[0]["loc_idx"]), int(nodes.iloc[node]["loc_idx"])
+    pair = nodes.iloc[[0, node]].reset_index(drop=True)
+    d2 = np.array([[0.0, dur[l0, ln]], [dur[ln, l0], 0.0]])
+    one = build_time_windows(pair, d2, tw["bell_time"])
+    if _traffic(state):
+        # Time-dependent plan: the direct trip to school is timed when the bus would leave at the latest
+        back = _arc_minutes(state, ln, l0, tw["origin_min"] + one["windows"][1][1] + one["service"][1])
+        d2 = np.array([[0.0, dur[l0, ln]], [float(back), 0.0]])
+        one = build_time_windows(pair, d2, tw["bell_time"])
+    window, service = list(one["windows"][1]), float(one["service"][1])
+    if node < len(tw["windows"]):
+        tw["windows"][node], tw["service"][node] = window, service
+    else:
+        tw["windows"].append(window); tw["service"].append(service)
+
+def _add_node(state, row):
+    plan = state["plan"]
+    plan["nodes"] = pd.concat([plan["nodes"], pd.DataFrame([row])], ignore_index=True)
+    node = len(plan["nodes"]) - 1
+    _refresh_time_window(state, node)
+    return node
+
+def _location_row(state, name, lat, lon):
+    """
+    Row of (lat, lon) in the matrix artifact; new locations are appended (one OSRM row + column).
+    In a dry run (state['dry_run']) the matrix is only grown in memory and the stored artifact is left alone.
+    """
+    idx = locate_nodes(state["matrix"], [(lat, lon)])
+    if idx is not None: return int(idx[0])
+    if state.get("dry_run"):
+        state["matrix"], new_rows = extend_matrix(state["matrix"], [name], [(lat, lon)])
+    else:
+        state["matrix"], new_rows = extend_matrix_artifact(state["plan"]["matrix_dir"], [name], [(lat, lon)])
+    return int(new_rows[0])
+
+def apply_change(state, change, repair=True):
+    """
+    Applies one change to the plan in `state` (in memory; call commit() to persist; with state['dry_run']
+    a new location does not grow the stored matrix artifact either).
+    change['op']:
+      - 'demand': {'stop', 'students': +/-k, 'staff': +/-k, 'student_ids', 'staff_ids'}
+      - 'add_stop': {'stop', 'lat', 'lon', 'students', 'staff', ...} (existing stop -> demand change)
+      - 'remove_stop': {'stop'}
+      - 'move_stop': {'stop', 'lat', 'lon'}
+    Returns: {'affected': [vehicle_id], 'unserved': [node], 'elapsed_s': float}
+    """
+    t0 = time.perf_counter()
+    plan = state["plan"]
+    nodes = plan["nodes"]
+    op, stop = change["op"], change["stop"]
+    parts = [i for i, n in enumerate(nodes["name"]) if i > 0 and _base_name(n) == stop and nodes.iloc[i]["demand"] > 0]
+    affected, unserved = set(), []
+
+    if op == "add_stop" and not parts:
+        loc_row = _location_row(state, stop, float(change["lat"]), float(change["lon"]))
+        students, staff = int(change.get("students", 0)), int(change.get("staff", 0))
+        node = _add_node(state, {"stop_id": -1, "name": stop, "lat": float(change["lat"]), "lon": float(change["lon"]),
+                                 "student_count": students, "staff_count": staff, "demand": students + staff,
+                                 "student_ids": change.get("student_ids", ""), "staff_ids": change.get("staff_ids", ""), "walk_ins": "", "loc_idx": loc_row})
+        choice = _insert(state, node, repair)
+        if choice: affected.add(choice["vehicle_id"])
+        else: unserved.append(node)
+
+    elif op in ("add_stop", "demand"):
+        if not parts: raise ValueError(f"Unknown stop: {stop}")
+        d_students, d_staff = int(change.get("students", 0)), int(change.get("staff", 0))
+        delta = d_students + d_staff
+        caps = [f["capacity"] for f in plan["fleet"]]
+        loads = {r["vehicle_id"]: int(nodes["demand"].iloc[[s["node"] for s in r["route"]]].sum()) for r in plan["routes"]}
+        # Prefer the part whose bus still has room (or the largest part when passengers leave)
+        target = None
+        if all(_route_of(state, node) is None for node in parts):
+            # Stop was dropped by the solver: keep its demand current, it stays unserved
+            target = parts[0]
+            unserved.append(target)
+        for node in parts if target is None else []:
+            r = _route_of(state, node)
+            if r is None: continue
+            if (delta > 0 and loads[r["vehicle_id"]] + delta <= caps[r["vehicle_id"]]) or (delta <= 0 and nodes.iloc[node]["demand"] + delta >= 0):
+                target = node; break
+        if target is not None:
+            nodes.loc[target, ["student_count", "staff_count", "demand"]] = [
+                max(0, int(nodes.iloc[target]["student_count"]) + d_students), max(0, int(nodes.iloc[target]["staff_count"]) + d_staff),
+                max(0, int(nodes.iloc[target]["demand"]) + delta)]
+            for col in ("student_ids", "staff_ids"):
+                if change.get(col): nodes.loc[target, col] = ", ".join(x for x in (str(nodes.iloc[target][col]), str(change[col])) if x)
+            _refresh_time_window(state, target)
+            if nodes.iloc[target]["demand"] == 0:
+                affected.add(_remove_from_route(state, target, repair))
+            elif target not in unserved:
+                r = _route_of(state, target)
+                _set_route(state, r["vehicle_id"], [s["node"] for s in r["route"]], r["route"][0].get("arrival_time"), repair)
+                affected.add(r["vehicle_id"])
+        elif delta > 0:
+            # No bus serving this stop has room: add a new part and insert it wherever it is cheapest
+            base = nodes.iloc[parts[0]].to_dict()
+            base.update({"name": f"{stop} (Part {len(parts) + 1})", "student_count": max(0, d_students), "staff_count": max(0, d_staff),
+                         "demand": delta, "student_ids": change.get("student_ids", ""), "staff_ids": change.get("staff_ids", ""), "walk_ins": ""})
+            node = _add_node(state, base)
+            choice = _insert(state, node, repair)
+            if choice: affected.add(choice["vehicle_id"])
+            else: unserved.append(node)
+        else:
+            raise ValueError(f"Stop {stop} has fewer passengers than requested to remove.")
+
+    elif op == "remove_stop":
+        for node in parts:
+            affected.add(_remove_from_route(state, node, repair))
+            nodes.loc[node, ["student_count", "staff_count", "demand"]] = [0, 0, 0]
+
+    elif op == "move_stop":
+        loc_row = _location_row(state, stop, float(change["lat"]), float(change["lon"]))
+        for node in parts:
+            affected.add(_remove_from_route(state, node, repair))
+            nodes.loc[node, ["lat", "lon", "loc_idx"]] = [float(change["lat"]), float(change["lon"]), loc_row]
+            _refresh_time_window(state, node)
+            choice = _insert(state, node, repair)
+            if choice: affected.add(choice["vehicle_id"])
+            else: unserved.append(node)
+    else:
+        raise ValueError(f"Unknown change op: {op}")
+
+    affected.discard(None)
+    return {"affected": sorted(affected), "unserved": unserved, "elapsed_s": time.perf_counter() - t0}
+
+def afternoon_data(state, bus_names=None):
+    """
+    Manifest entries of the drop-off stored with the school's Stage 3 checkpoint (None if no drop-off was planned),
+    optionally only for the given buses (AM names; "(Trip n)" suffixes are ignored).
+    """
+    from dropoff import load_dropoff
+    from reporting import dropoff_dashboard_data
+    from checkpoint import checkpoint_dir
+    afternoon = load_dropoff(checkpoint_dir(os.path.dirname(state["path"]), state["plan"]["school"]["safe_name"]))
+    if afternoon is None: return None
+    data = dropoff_dashboard_data(afternoon)
+    if bus_names is not None:
+        plates = {str(name).split(" (Trip")[0] for name in bus_names}
+        data["routes"] = [r for r in data["routes"] if str(r["vehicle_name"]).split(" (Trip")[0] in plates]
+    return data
+
+def affected_manifest(state, vehicle_ids):
+    """Driver manifest rows (same columns as Stage 3) for the given buses only, with their planned drop-off trips."""
+    from reporting import route_manifest_stops, build_manifest
+    plan = state["plan"]
+    tw = plan["time_windows"]
+    loc = plan["nodes"]["loc_idx"].to_numpy()
+    routes = {r["vehicle_id"]: r for r in plan["routes"]}
+    dashboard_data = {"routes": []}
+    for v in vehicle_ids:
+        stops = route_manifest_stops(routes[v], plan["nodes"], state["matrix"]["dist"], state["matrix"]["dur"],
+                                     tw["origin_min"] if tw else None, node_loc=loc, estimated=state["matrix"].get("estimated")) if v in routes else []
+        dashboard_data["routes"].append({"vehicle_name": plan["fleet"][v]["name"], "stops": stops})
+    return build_manifest(plan["school"]["school_name"], dashboard_data,
+                          afternoon_data(state, [r["vehicle_name"] for r in dashboard_data["routes"]]))
+
+def render_plan_report(state, outputs_dir):
+    """Re-renders the full HTML dashboard and manifest for the current plan (no solving)."""
+    from reporting import render_school_report, build_manifest
+    plan = state["plan"]
+    nodes, school, tw = plan["nodes"], plan["school"], plan["time_windows"]
+    loc = nodes["loc_idx"].to_numpy()
+    unserved = [nodes.iloc[n]["name"] for n in unserved_nodes(plan["routes"], len(nodes)) if nodes.iloc[n]["demand"] > 0]
+    dashboard_html, dashboard_data = render_school_report(
+        school["school_name"], school["lat"], school["lon"], plan["routes"], plan["fleet"], nodes, list(zip(nodes["lat"], nodes["lon"])),
+        submatrix(state["matrix"]["dist"], loc), submatrix(state["matrix"]["dur"], loc), tw["origin_min"] if tw else None, unserved,
+        submatrix(state["matrix"]["estimated"], loc) if "estimated" in state["matrix"] else None)
+    report_path = os.path.join(outputs_dir, f"report_{school['safe_name']}.html")
+    with open(report_path, "w", encoding="utf-8") as f: f.write(dashboard_html)
+    csv_path = os.path.join(outputs_dir, f"manifest_{school['safe_name']}.csv")
+    build_manifest(school["school_name"], dashboard_data, afternoon_data(state)).to_csv(csv_path, index=False)
+    return report_path, csv_path
+
+def commit(state, result, outputs_dir):
+    """Persists the plan and rewrites only the affected buses' morning rows in the school's manifest CSV (drop-off rows are kept)."""
+    plan = state["plan"]
+    save_plan(state["path"], plan["school"], plan["nodes"], plan["fleet"], plan["routes"], plan["matrix_dir"],
+              plan["time_windows"], plan["time_windows"]["bell_time"] if plan["time_windows"] else None)
+    df_changes = affected_manifest(state, result["affected"])
+    csv_path = os.path.join(outputs_dir, f"manifest_{plan['school']['safe_name']}.csv")
+    if os.path.exists(csv_path):
+        buses = {plan["fleet"][v]["name"] for v in result["affected"]}
+        from reporting import order_manifest
+        df_manifest = pd.read_csv(csv_path, dtype={"Bus Plate": str})
+        replaced = df_manifest["Bus Plate"].isin(buses) & (df_manifest["Trip Type"] == "AM (Pickup)")
+        df_changes = order_manifest(pd.concat([df_manifest[~replaced], df_changes[df_changes["Trip Type"] == "AM (Pickup)"]], ignore_index=True))
+    df_changes.to_csv(csv_path, index=False)
+    return csv_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply one change to a solved school plan without re-running Stage 3.")
+    parser.add_argument("--school", required=True, help="School safe name, e.g. PEARL_SCHOOL_WESTBAY")
+    parser.add_argument("--change", required=True, help='JSON, e.g. \'{"op": "demand", "stop": "GHARAFA", "students": 1}\'')
+    parser.add_argument("--no-repair", action="store_true", help="Skip the local repair of the affected routes")
+    parser.add_argument("--dry-run", action="store_true", help="Print the result without saving")
+    args = parser.parse_args()
+
+    plan_path = os.path.join(current_dir, "cache", f"plan_{args.school}.json")
+    if not os.path.exists(plan_path):
+        print(f"❌ Error: {plan_path} not found. Run Step 3 first.")
+        return
+
+    state = load_state(plan_path)
+    state["dry_run"] = args.dry_run
+    result = apply_change(state, json.loads(args.change), repair=not args.no_repair)
+    buses = ", ".join(state["plan"]["fleet"][v]["name"] for v in result["affected"]) or "none"
+    print(f"⚡ Re-planned in {result['elapsed_s'] * 1000:.0f} ms. Affected buses: {buses}")
+    if result["unserved"]:
+        print(f"   ⚠️ No bus can take: {', '.join(state['plan']['nodes'].iloc[n]['name'] for n in result['unserved'])}")
+    if not args.dry_run:
+        csv_path = commit(state, result, os.path.join(current_dir, "outputs"))
+        print(f"📄 Manifest updated: {csv_path}")
+
+if __name__ == "__main__":
+    main()
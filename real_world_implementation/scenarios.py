@@ -0,0 +1,173 @@
+import argparse
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+try:
+    import resource # peak RSS column (Unix only)
+except ImportError:
+    resource = None
+
+# Add parent directory to path to import the shared modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from matrix_store import get_or_build_matrix, load_matrix_artifact
+from config import (SCHOOL_BELL_TIMES, DEFAULT_BELL_TIME, DROP_PENALTY, MATRIX_NEIGHBOURS, TD_PROFILE_START, TD_BUCKET_MIN,
+                    TD_DURATION_FACTORS, TD_ITERATIONS, POLISH_ROUTES, USE_TIME_WINDOWS, USE_TIME_DEPENDENT)
+from school_model import (load_pipeline_data, school_safe_name, locate_school, school_nodes, split_giant_stops,
+                          split_stops_by_fleet, extend_fleet_trips, build_time_windows)
+
+# What-if sweeps for one school ("what if we remove 5 buses", "split limit 30 instead of 25").
+# The school's location-level matrix is built (or reused) once; every worker process opens the
+# same artifact as a read-only memory map, so the matrix pages are shared through the OS page
+# cache and memory stays flat as workers are added. Each scenario is solved like Stage 3: the
+# duration objective on the time-dependent stack, then the polish (one process per scenario, as
+# the scenarios already run in parallel); the distance objective is a static solve on distances.
+# With USE_TIME_WINDOWS off both objectives are capacity-only static solves, as in Stage 3;
+# with USE_TIME_DEPENDENT off the duration objective is a static time-window solve.
+# No map or manifest is rendered.
+
+OBJECTIVES = ("duration", "distance")
+
+def scenario_grid(remove_buses=(0,), capacities=(None,), split_limits=(None,), time_limits=(10,), objectives=("duration",)):
+    """Cartesian product of the parameter lists, one dict per scenario (None = as in the real fleet / Stage 3)."""
+    keys = ("remove_buses", "capacity", "split_limit", "time_limit", "objective")
+    return [dict(zip(keys, values)) for values in itertools.product(remove_buses, capacities, split_limits, time_limits, objectives)]
+
+def scenario_fleet(fleet_list, remove_buses=0, capacity=None):
+    """The fleet of a scenario: the `remove_buses` smallest buses are taken out, `capacity` overrides every bus."""
+    fleet = sorted(fleet_list, key=lambda f: -f['capacity'])[:max(1, len(fleet_list) - remove_buses)]
+    return [dict(f, capacity=capacity) for f in fleet] if capacity else fleet
+
+_WORKER = {}
+
+def _init_worker(artifact_dir, rows, df_model, fleet_list, bell_time):
+    _WORKER.update(matrix=load_matrix_artifact(artifact_dir), rows=rows, df_model=df_model, fleet_list=fleet_list, bell_time=bell_time)
+
+def _peak_rss_mb():
+    """Peak resident memory of this process (None where the resource module is missing, e.g. Windows)."""
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1) # bytes on macOS, KiB on Linux
+
+def run_scenario(scenario, shared=None):
+    """Solves one scenario. shared: the worker state (defaults to the process-wide one set by _init_worker)."""
+    from optimizer import optimize_routes # OR-Tools is only needed in the solver processes
+    from polish import polish_solution
+    from time_dependent import build_td_stack, solve_time_dependent, frozen_durations, retime_routes, late_stops
+    from time_windows import unserved_nodes, parse_clock, travel_time_matrix
+
+    w = shared or _WORKER
+    t0 = time.perf_counter()
+    fleet = scenario_fleet(w['fleet_list'], scenario['remove_buses'], scenario['capacity'])
+    df_split = split_stops_by_fleet(w['df_model'], fleet) if not scenario['split_limit'] else split_giant_stops(w['df_model'], scenario['split_limit'])
+    extended_fleet = extend_fleet_trips(fleet, df_split['demand'].sum())
+
+    # Fancy indexing reads only the scenario's rows / columns out of the shared memory map
+    loc = w['rows'][df_split['loc_idx'].to_numpy()]
+    dist, dur = w['matrix']['dist'][np.ix_(loc, loc)], w['matrix']['dur'][np.ix_(loc, loc)]
+    tw = build_time_windows(df_split, dur, w['bell_time']) if USE_TIME_WINDOWS else None
+    demands, capacities = list(df_split['demand']), [f['capacity'] for f in extended_fleet]
+    time_dependent = scenario['objective'] == "duration" and tw is not None and USE_TIME_DEPENDENT
+    late = []
+    if time_dependent:
+        # Same path as Stage 3: traffic-profile stack, polish on frozen arc times, exact re-timing
+        profile_start = parse_clock(TD_PROFILE_START)
+        td_stack = build_td_stack(dur, TD_DURATION_FACTORS)
+        routes = solve_time_dependent(td_stack, demands, capacities, tw['windows'], tw['service'], tw['origin_min'], profile_start,
+                                      TD_BUCKET_MIN, iterations=TD_ITERATIONS, time_limit_s=int(scenario['time_limit']), drop_penalty=DROP_PENALTY)
+        if routes and POLISH_ROUTES:
+            frozen = frozen_durations(routes, td_stack, tw['service'], tw['origin_min'], profile_start, TD_BUCKET_MIN)
+            routes, _ = polish_solution(routes, frozen, demands, travel_time_matrix(frozen, tw['service']), tw['windows'])
+            retime_routes(routes, td_stack, tw['service'], tw['origin_min'], profile_start, TD_BUCKET_MIN)
+        if routes: late = late_stops(routes, tw['windows'])
+    else:
+        cost = dur if scenario['objective'] == "duration" else dist
+        routes = optimize_routes(cost, demands, capacities, tw['windows'] if tw else None, tw['travel_times'] if tw else None,
+                                 time_limit_s=int(scenario['time_limit']), drop_penalty=DROP_PENALTY)
+        if routes and POLISH_ROUTES:
+            routes, _ = polish_solution(routes, cost, demands, tw['travel_times'] if tw else None, tw['windows'] if tw else None)
+
+    # Route metrics straight from the solution arrays (legs that cross a route boundary are masked out);
+    # km / min are static matrix totals, ride times come from the (traffic-timed) arrivals
+    a, b = routes.nodes[:-1], routes.nodes[1:]
+    leg = np.ones(len(a), dtype=bool)
+    leg[routes.offsets[1:-1] - 1] = False
+    first, last = routes.offsets[:-1] + 1, routes.offsets[1:] - 1
+    names = {extended_fleet[v]['name'].split(" (Trip")[0] for v in routes.vehicle_ids.tolist()}
+    unserved = [n for n in unserved_nodes(routes, len(df_split)) if df_split.iloc[n]['demand'] > 0]
+    return dict(scenario, time_dependent=time_dependent, polished=POLISH_ROUTES, buses=len(names), routes=len(routes), nodes=len(df_split),
+                total_km=round(float(dist[a[leg], b[leg]].sum()), 1), total_min=round(float(dur[a[leg], b[leg]].sum()), 1),
+                max_ride_min=round(float((routes.arrival[last] - routes.arrival[first]).max()), 1) if len(routes) and tw else None,
+                late_stops=len(late), unserved=len(unserved), unserved_pax=int(df_split['demand'].iloc[unserved].sum()),
+                solve_s=round(time.perf_counter() - t0, 2), peak_rss_mb=_peak_rss_mb())
+
+def run_sweep(df_model, fleet_list, artifact_dir, rows, bell_time, scenarios, workers=None):
+    """Runs the scenarios on a process pool sharing the memory-mapped matrix. Returns the comparison table."""
+    workers = min(workers or os.cpu_count() or 1, len(scenarios))
+    args = (artifact_dir, rows, df_model, fleet_list, bell_time)
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=args) as pool:
+            results = list(pool.map(run_scenario, scenarios))
+    else:
+        _init_worker(*args)
+        results = [run_scenario(s) for s in scenarios]
+    return pd.DataFrame(results)
+
+def _value(text):
+    """CLI grid values: integers, or 'real' / 'fleet' for "as in Stage 3"."""
+    return None if text in ("real", "fleet", "none") else int(text)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare what-if scenarios for one school on a shared matrix.")
+    parser.add_argument("--school", type=int, required=True, help="SchoolID")
+    parser.add_argument("--remove-buses", type=int, nargs="+", default=[0], help="Take out the N smallest buses, e.g. 0 2 5")
+    parser.add_argument("--capacity", type=_value, nargs="+", default=[None], help="Seats per bus, e.g. real 40")
+    parser.add_argument("--split-limit", type=_value, nargs="+", default=[None], help="Strict split limit, e.g. fleet 25 30")
+    parser.add_argument("--time-limit", type=int, nargs="+", default=[10], help="Solver budget per scenario (seconds)")
+    parser.add_argument("--objective", nargs="+", default=["duration"], choices=OBJECTIVES)
+    parser.add_argument("--workers", type=int, default=None, help="Solver processes (default: all cores)")
+    parser.add_argument("--no-geocode", action="store_true", help="Skip school geocoding (central Doha depot)")
+    args = parser.parse_args()
+
+    data_dir, cache_dir, outputs_dir = (os.path.join(current_dir, d) for d in ('data', 'cache', 'outputs'))
+    data = load_pipeline_data(data_dir)
+    s_row = data['school'][data['school']['SchoolID'] == args.school]
+    if s_row.empty: return print(f"❌ Unknown school: {args.school}")
+    s_row = s_row.iloc[0]
+    if args.no_geocode:
+        s_lat, s_lon = 25.2854, 51.5310
+    else:
+        from geopy.geocoders import Nominatim
+        s_lat, s_lon = locate_school(Nominatim(user_agent="school_optimizer_v14"), s_row)
+    school = school_nodes(args.school, data, s_lat, s_lon)
+    if school is None: return print(f"❌ {s_row['SchoolName']} has no buses or no demand.")
+    df_model, fleet_list = school
+
+    safe_name = school_safe_name(s_row['SchoolName'])
+    artifact_dir = os.path.join(cache_dir, f'matrix_{safe_name}')
+    matrix = get_or_build_matrix(artifact_dir, df_model['name'], list(zip(df_model['lat'], df_model['lon'])),
+                                 use_osrm_for_large=True, neighbours=MATRIX_NEIGHBOURS)
+    rows = np.asarray(matrix['rows'])
+    del matrix # workers open their own memory maps
+
+    scenarios = scenario_grid(args.remove_buses, args.capacity, args.split_limit, args.time_limit, args.objective)
+    print(f"\n🧪 {s_row['SchoolName']}: {len(scenarios)} scenarios, {len(df_model)} locations, {len(fleet_list)} buses")
+    t0 = time.perf_counter()
+    table = run_sweep(df_model, fleet_list, artifact_dir, rows, SCHOOL_BELL_TIMES.get(args.school, DEFAULT_BELL_TIME), scenarios, args.workers)
+    table = table.astype({"capacity": object, "split_limit": object}).fillna({"capacity": "real", "split_limit": "fleet"})
+    print(table.to_string(index=False))
+    print(f"\n⏱️ {len(scenarios)} scenarios in {time.perf_counter() - t0:.1f}s")
+
+    os.makedirs(outputs_dir, exist_ok=True)
+    out_path = os.path.join(outputs_dir, f'scenarios_{safe_name}.csv')
+    table.to_csv(out_path, index=False)
+    print(f"💾 Comparison table: {out_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import pandas as pd
+import numpy as np
+import math
+import os
+from time_windows import parse_clock, service_times, travel_time_matrix
+from config import (SCHOOL_ARRIVAL_BUFFER_MIN, PLANNING_HORIZON_MIN, SERVICE_TIME_BASE_MIN,
+                    SERVICE_TIME_PER_PAX_MIN, MAX_RIDE_MIN)
+
+PIPELINE_FILES = {'school': 'raw_school.csv', 'stops': 'geocoded_stops.csv', 'students': 'raw_students.csv',
+                  'staff': 'raw_staff.csv', 'vehicles': 'raw_vehicles.csv'}
+
+def load_pipeline_data(data_dir, data=None):
+    """
+    Stage 1/2 outputs as DataFrames: school, stops (geocoded), students, staff, vehicles.
+    Frames already in `data` (e.g. produced earlier in the same process) are kept; the rest is read from CSV.
+    """
+    data = dict(data or {})
+    for key, file_name in PIPELINE_FILES.items():
+        if key not in data: data[key] = pd.read_csv(os.path.join(data_dir, file_name))
+    return data
+
+def school_safe_name(school_name):
+    return school_name.replace(" ", "_").replace(",", "").replace("-", "_").replace("__", "_")
+
+def locate_school(geolocator, s_row):
+    """School (depot) coordinates from Nominatim; central Doha if geocoding fails."""
+    try:
+        loc = geolocator.geocode(f"{s_row['Address1']}, {s_row['Place']}, Qatar", country_codes="qa")
+        return loc.latitude, loc.longitude
+    except: return 25.2854, 51.5310
+
+def aggregate_stop_demand(all_stops_df, school_students, school_staff, stop_column='PickupStopMapID'):
+    """
+    Groups students and staff by StopName/coordinate (stop_column: PickupStopMapID, or DropStopMapID for drop-offs).
+    Returns the active stops (demand > 0, valid coordinates) with counts and passenger IDs.
+    """
+    stops_distinct = all_stops_df.groupby(['StopName', 'final_lat', 'final_lon']).agg({'RouteStopMapIID': list}).reset_index()
+    id_to_group = {iid: row['StopName'] for _, row in stops_distinct.iterrows() for iid in row['RouteStopMapIID']}
+
+    school_students = school_students.copy()
+    school_staff = school_staff.copy()
+    school_students['GroupKey'] = school_students[stop_column].map(id_to_group)
+    school_staff['GroupKey'] = school_staff[stop_column].map(id_to_group)
+    student_data = school_students.groupby('GroupKey').agg({'StudentID': [('count', 'size'), ('ids', lambda x: ", ".join(x.astype(str).unique()))]}); student_data.columns = ['student_count', 'student_ids']
+    staff_data = school_staff.groupby('GroupKey').agg({'StaffID': [('count', 'size'), ('ids', lambda x: ", ".join(x.astype(str).unique()))]}); staff_data.columns = ['staff_count', 'staff_ids']
+
+    stops_final = pd.merge(stops_distinct, student_data, left_on='StopName', right_index=True, how='left')
+    stops_final = pd.merge(stops_final, staff_data, left_on='StopName', right_index=True, how='left')
+    stops_final[['student_count', 'staff_count']] = stops_final[['student_count', 'staff_count']].fillna(0).astype(int)
+    stops_final['total_demand'] = stops_final['student_count'] + stops_final['staff_count']
+    stops_final[['student_ids', 'staff_ids']] = stops_final[['student_ids', 'staff_ids']].fillna("")
+
+    return stops_final[(stops_final['total_demand'] > 0) & (stops_final['final_lat'] > 24.5)].copy()
+
+def build_model_nodes(active_stops, s_lat, s_lon):
+    """
+    Node table for the solver: row 0 is the SCHOOL depot, one row per active stop.
+    loc_idx is the row of the location in the school's matrix artifact; split parts keep it.
+    """
+    model_data = [{'stop_id': 0, 'name': 'SCHOOL', 'lat': float(s_lat), 'lon': float(s_lon), 'student_count': 0, 'staff_count': 0, 'demand': 0, 'student_ids': "", 'staff_ids': "", 'walk_ins': ""}]
+    for idx, row in active_stops.iterrows():
+        model_data.append({'stop_id': idx, 'name': row['StopName'], 'lat': float(row['final_lat']), 'lon': float(row['final_lon']), 'student_count': int(row['student_count']), 'staff_count': int(row['staff_count']), 'demand': int(row['total_demand']), 'student_ids': row['student_ids'], 'staff_ids': row['staff_ids'], 'walk_ins': ""})
+    df_model = pd.DataFrame(model_data)
+    df_model['loc_idx'] = range(len(df_model))
+    return df_model
+
+def school_nodes(school_id, data, s_lat, s_lon, stop_column='PickupStopMapID'):
+    """Model nodes (depot + aggregated stops) and fleet of one school, or None if it has no buses or no demand."""
+    school_vehicles = data['vehicles'][data['vehicles']['SchoolID'] == school_id].copy()
+    if school_vehicles.empty: return None
+    school_students = data['students'][data['students']['SchoolID'] == school_id].copy()
+    school_staff = data['staff'][data['staff']['SchoolID'] == school_id].copy()
+    active_stops = aggregate_stop_demand(data['stops'], school_students, school_staff, stop_column)
+    if active_stops.empty: return None
+    return build_model_nodes(active_stops, s_lat, s_lon), build_fleet(school_vehicles)
+
+def build_fleet(school_vehicles):
+    return [{'name': str(v.get('VehicleRegistrationNumber', f"V{i+1}")), 'capacity': int(v.get('MaximumSeatingCapacity', 30))} for i, v in school_vehicles.iterrows()]
+
+def split_giant_stops(df_model, split_limit):
+    """
+    STRICT SPLITTING logic: any stop with demand > split_limit becomes "Part 1..N".
+    Passenger IDs (and walk-ins) stay on Part 1 so the manifest lists each person once.
+    """
+    split_rows = []
+    for idx, row in df_model.iterrows():
+        if idx == 0: split_rows.append(row); continue
+        if row['demand'] > split_limit:
+            num_parts = math.ceil(row['demand'] / split_limit)
+            for i in range(num_parts):
+                new_part = row.copy()
+                new_part['demand'] = row['demand'] // num_parts + (1 if i < row['demand'] % num_parts else 0)
+                new_part['student_count'] = row['student_count'] // num_parts + (1 if i < row['student_count'] % num_parts else 0)
+                new_part['staff_count'] = row['staff_count'] // num_parts + (1 if i < row['staff_count'] % num_parts else 0)
+                new_part['name'] = f"{row['name']} (Part {i+1})"
+                if i > 0: new_part['student_ids'] = ""; new_part['staff_ids'] = ""; new_part['walk_ins'] = ""
+                split_rows.append(new_part)
+        else:
+            split_rows.append(row)
+    return pd.DataFrame(split_rows).reset_index(drop=True)
+
+def _part_rows(row, sizes):
+    """
+    One row per part with the given demands. Students fill the parts first, then staff,
+    so each part's counts add up to its demand. Passenger IDs (and walk-ins) stay on Part 1.
+    """
+    name = str(row['name'])
+    students_left, parts = int(row['student_count']), []
+    for i, size in enumerate(sizes):
+        part = row.copy()
+        part['demand'] = size
+        part['student_count'] = min(size, students_left)
+        part['staff_count'] = size - part['student_count']
+        students_left -= part['student_count']
+        # An already split part ("X (Part 2)") becomes "X (Part 2.1)", "X (Part 2.2)"...
+        part['name'] = f"{name[:-1]}.{i+1})" if name.endswith(")") and " (Part " in name else f"{name} (Part {i+1})"
+        if i > 0: part['student_ids'] = ""; part['staff_ids'] = ""; part['walk_ins'] = ""
+        parts.append(part)
+    return parts
+
+def fleet_split_sizes(demands, capacities, max_trips=6):
+    """
+    Fleet-aware part sizes: a stop that fits in the largest bus stays whole. Bigger stops are
+    cut into bus-sized parts, taking the largest remaining buses first from a pool shared by
+    all stops (each bus once per trip). The remainder becomes the last part.
+    Returns {stop index: [part demands]} for the stops that must be split.
+    """
+    max_cap = max(capacities)
+    pool = sorted(list(capacities) * max_trips, reverse=True)
+    sizes = {}
+    for idx in sorted((i for i, d in enumerate(demands) if d > max_cap), key=lambda i: -demands[i]):
+        remaining, parts = int(demands[idx]), []
+        while remaining > max_cap:
+            cap = pool.pop(0) if pool else max_cap
+            parts.append(cap)
+            remaining -= cap
+        sizes[idx] = parts + [remaining]
+    return sizes
+
+def split_stops_by_fleet(df_model, fleet_list):
+    """Splits only the stops no single bus can carry, into parts sized by the real fleet (see fleet_split_sizes)."""
+    sizes = fleet_split_sizes([0 if i == 0 else d for i, d in enumerate(df_model['demand'])], [f['capacity'] for f in fleet_list])
+    split_rows = []
+    for idx, row in df_model.iterrows():
+        split_rows.extend(_part_rows(row, sizes[idx]) if idx in sizes else [row])
+    return pd.DataFrame(split_rows).reset_index(drop=True)
+
+def split_overflow(df_model_split, nodes, split_limit):
+    """
+    Lazy splitting after a first solve: only the given nodes (e.g. stops the solver had to drop
+    because no bus had room for them) are cut into parts of at most split_limit.
+    """
+    nodes, split_rows = set(nodes), []
+    for idx, row in df_model_split.iterrows():
+        if idx in nodes and row['demand'] > split_limit:
+            num_parts = math.ceil(row['demand'] / split_limit)
+            split_rows.extend(_part_rows(row, [row['demand'] // num_parts + (1 if i < row['demand'] % num_parts else 0) for i in range(num_parts)]))
+        else:
+            split_rows.append(row)
+    return pd.DataFrame(split_rows).reset_index(drop=True)
+
+def extend_fleet_trips(fleet_list, total_pax, max_trips=6):
+    """Simulate Fleet Trips: adds "Virtual Vehicles" (Trip 2, Trip 3...) until the fleet can carry everyone."""
+    extended_fleet = list(fleet_list)
+    mult = 1
+    while sum(f['capacity'] for f in extended_fleet) < total_pax and mult < max_trips:
+        mult += 1
+        for f in fleet_list: extended_fleet.append({'name': f"{f['name']} (Trip {mult})", 'capacity': f['capacity']})
+    return extended_fleet
+
+def build_time_windows(df_model_split, dur_matrix, bell_time):
+    """
+    Pickup windows for the solver's Time dimension, in minutes from the planning origin
+    (bell - PLANNING_HORIZON_MIN).
+    - Depot: buses must be back before the bell minus the arrival buffer.
+    - Stops: no earlier than the max ride time (students, or staff-only stops) allows, and late
+      enough only if the bus can still reach school directly after boarding.
+    Stops whose window is empty are flagged; with disjunctions the solver drops and reports them.
+    Returns dict: windows, travel_times, service, origin_min (clock of minute 0), infeasible.
+    """
+    origin_min = parse_clock(bell_time) - PLANNING_HORIZON_MIN
+    latest_arrival = PLANNING_HORIZON_MIN - SCHOOL_ARRIVAL_BUFFER_MIN
+
+    dur = np.asarray(dur_matrix, dtype=np.float64)
+    service = service_times(df_model_split['demand'].to_numpy(), SERVICE_TIME_BASE_MIN, SERVICE_TIME_PER_PAX_MIN)
+    has_students = df_model_split['student_count'].to_numpy() > 0
+    max_ride = np.where(has_students, MAX_RIDE_MIN['student'], MAX_RIDE_MIN['staff'])
+
+    earliest = np.maximum(0, latest_arrival - max_ride)
+    latest = np.floor(latest_arrival - service - dur[:, 0]).astype(np.int64)
+    infeasible = latest < earliest
+    latest = np.maximum(latest, earliest)
+    earliest[0], latest[0], infeasible[0] = 0, latest_arrival, False
+
+    return {
+        "windows": [(int(e), int(l)) for e, l in zip(earliest, latest)],
+        "travel_times": travel_time_matrix(dur, service),
+        "service": service,
+        "origin_min": origin_min,
+        "infeasible": infeasible
+    }
@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import copy
+import importlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Add parent directory to path to import the shared modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+sys.path.append(current_dir)
+
+from geopy.geocoders import Nominatim
+import distance
+import replan
+from detour_model import calibrate_from_cache
+from config import SERVICE_HOST, SERVICE_PORT, SERVICE_WORKERS, SERVICE_QUEUE_SIZE
+
+stage3 = importlib.import_module("3_run_optimization")
+
+# Long-running optimization service: Stage 1/2 data, school coordinates, the detour model,
+# re-plan states (plans + memory-mapped matrices) and the pooled OSRM session stay warm in one
+# process. Jobs (solve / replan / report / reload) go through a bounded queue to a fixed pool of
+# workers; clients submit over HTTP (TCP or Unix socket) and poll, or wait, for the result.
+#
+#   POST /jobs       {"type": "replan", "school": "PEARL_SCHOOL_WESTBAY", "change": {...}, "wait": true}
+#   GET  /jobs/<id>  status and result of one job
+#   GET  /health     queue depth, running jobs, uptime, OSRM circuit state
+
+JOB_TYPES = ("solve", "replan", "report", "reload")
+MAX_FINISHED_JOBS = 1000 # Older finished jobs are forgotten
+
+class ReadWriteLock:
+    """Many shared holders or one exclusive holder. Waiting exclusive holders block new shared ones (no starvation)."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers, self.writer, self.writers_waiting = 0, False, 0
+
+    @contextmanager
+    def shared(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.writer and not self.writers_waiting)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers: self.cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.cond:
+            self.writers_waiting += 1
+            self.cond.wait_for(lambda: not self.writer and not self.readers)
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+class OptimizationService:
+    def __init__(self, workers=SERVICE_WORKERS, queue_size=SERVICE_QUEUE_SIZE):
+        self.data_dir = os.path.join(current_dir, 'data')
+        self.cache_dir = os.path.join(current_dir, 'cache')
+        self.outputs_dir = os.path.join(current_dir, 'outputs')
+        os.makedirs(self.outputs_dir, exist_ok=True)
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.jobs, self.job_ids = {}, itertools.count(1)
+        self.running = 0
+        self.started = time.time()
+        self.geolocator = Nominatim(user_agent="school_optimizer_v14")
+        self.school_coords = {} # SchoolID -> (lat, lon), geocoded once
+        self.plans = {} # safe_name -> replan state
+        self.locks = {} # safe_name -> lock, so two jobs never write the same school at once
+        self.locks_guard = threading.Lock()
+        self.state_lock = ReadWriteLock() # jobs hold it shared, reload exclusive (data, detour model and plans swap under it)
+        self.reload()
+
+    # --- Warm state ---
+    def reload(self):
+        """(Re)reads the Stage 1/2 CSVs, refits the detour model and drops cached plans, once running jobs have finished."""
+        with self.state_lock.exclusive():
+            self.data = stage3.load_pipeline_data(self.data_dir)
+            distance.DETOUR_MODEL = calibrate_from_cache(self.cache_dir)
+            distance.check_osrm()
+            self.plans.clear()
+        return {"schools": len(self.data['school']), "stops": len(self.data['stops']), "detour_model": distance.DETOUR_MODEL is not None,
+                "osrm": distance.OSRM_CLIENT.healthy}
+
+    def _lock(self, safe_name):
+        with self.locks_guard:
+            return self.locks.setdefault(safe_name, threading.Lock())
+
+    def _plan_state(self, safe_name):
+        if safe_name not in self.plans:
+            plan_path = os.path.join(self.cache_dir, f"plan_{safe_name}.json")
+            if not os.path.exists(plan_path): raise ValueError(f"No plan for {safe_name}. Run a solve job first.")
+            self.plans[safe_name] = replan.load_state(plan_path)
+        return self.plans[safe_name]
+
+    # --- Job handlers (run on the worker threads) ---
+    def _solve(self, job):
+        schools = self.data['school']
+        if job.get("school_id") is not None: schools = schools[schools['SchoolID'] == int(job["school_id"])]
+        if schools.empty: raise ValueError(f"Unknown school: {job.get('school_id')}")
+        results = []
+        for _, s_row in schools.iterrows():
+            safe_name = stage3.school_safe_name(s_row['SchoolName'])
+            if s_row['SchoolID'] not in self.school_coords:
+                self.school_coords[s_row['SchoolID']] = stage3.locate_school(self.geolocator, s_row)
+            with self._lock(safe_name):
+                s_lat, s_lon = self.school_coords[s_row['SchoolID']]
+                summary = stage3.optimize_school(s_row, self.data, s_lat, s_lon, self.cache_dir, self.outputs_dir)
+                self.plans.pop(safe_name, None)
+            if summary: results.append(summary)
+        return {"schools": results}
+
+    def _replan(self, job):
+        safe_name = job["school"]
+        with self._lock(safe_name):
+            state = self._plan_state(safe_name)
+            if job.get("dry_run"): state = dict(state, plan=copy.deepcopy(state["plan"]), dry_run=True)
+            result = replan.apply_change(state, job["change"], repair=job.get("repair", True))
+            result["buses"] = [state["plan"]["fleet"][v]["name"] for v in result["affected"]]
+            result["unserved"] = [state["plan"]["nodes"].iloc[n]["name"] for n in result["unserved"]]
+            if not job.get("dry_run"):
+                result["manifest"] = replan.commit(state, result, self.outputs_dir)
+        return result
+
+    def _report(self, job):
+        with self._lock(job["school"]):
+            report_path, csv_path = replan.render_plan_report(self._plan_state(job["school"]), self.outputs_dir)
+        return {"report": report_path, "manifest": csv_path}
+
+    def run_job(self, job):
+        if job["type"] == "reload": return self.reload()
+        handler = {"solve": self._solve, "replan": self._replan, "report": self._report}[job["type"]]
+        with self.state_lock.shared():
+            return handler(job["params"])
+
+    # --- Queue ---
+    def submit(self, params):
+        """Queues a job. Raises ValueError for bad input and asyncio.QueueFull when the queue is full."""
+        if params.get("type") not in JOB_TYPES: raise ValueError(f"Unknown job type: {params.get('type')}. Use one of {', '.join(JOB_TYPES)}.")
+        if params["type"] in ("replan", "report") and not params.get("school"): raise ValueError("'school' (safe name) is required.")
+        if params["type"] == "replan" and not isinstance(params.get("change"), dict): raise ValueError("'change' must be an object.")
+        job = {"id": str(next(self.job_ids)), "type": params["type"], "params": params, "status": "queued",
+               "submitted": time.time(), "done": asyncio.Event()}
+        self.queue.put_nowait(job)
+        self.jobs[job["id"]] = job
+        self._forget_old_jobs()
+        return job
+
+    def _forget_old_jobs(self):
+        finished = [j for j in self.jobs.values() if j["status"] in ("done", "failed")]
+        for job in sorted(finished, key=lambda j: j["submitted"])[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job["id"]]
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            job["status"], job["started"] = "running", time.time()
+            self.running += 1
+            try:
+                job["result"] = await loop.run_in_executor(self.executor, self.run_job, job)
+                job["status"] = "done"
+            except Exception as e:
+                job["status"], job["error"] = "failed", f"{type(e).__name__}: {e}"
+                traceback.print_exc()
+            finally:
+                self.running -= 1
+                job["finished"] = time.time()
+                job["done"].set()
+                self.queue.task_done()
+            print(f"   🧾 Job {job['id']} ({job['type']}) {job['status']} in {job['finished'] - job['started']:.2f}s")
+
+    @staticmethod
+    def job_view(job):
+        view = {k: job[k] for k in ("id", "type", "status") if k in job}
+        if "started" in job: view["queued_s"] = round(job["started"] - job["submitted"], 3)
+        if "finished" in job: view["run_s"] = round(job["finished"] - job["started"], 3)
+        for k in ("result", "error"):
+            if k in job: view[k] = job[k]
+        return view
+
+    def health(self):
+        return {"status": "ok", "uptime_s": round(time.time() - self.started, 1), "workers": self.workers,
+                "queued": self.queue.qsize(), "running": self.running, "jobs": len(self.jobs), "warm_plans": sorted(self.plans),
+                "osrm_circuit": "open" if distance.OSRM_CLIENT.is_open() else "closed", "osrm_requests": dict(distance.OSRM_REQUESTS)}
+
+    # --- HTTP ---
+    async def handle(self, reader, writer):
+        try:
+            try:
+                request_line = (await reader.readline()).decode("latin-1").split()
+                if len(request_line) < 2: return
+                method, path = request_line[0], request_line[1].split("?")[0]
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line: break
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = await self.route(method, path, body)
+            except Exception as e:
+                status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+            data = json.dumps(payload, default=str).encode("utf-8")
+            reason = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 503: "Service Unavailable"}.get(status, "Error")
+            writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, self.health()
+        if method == "GET" and path == "/jobs":
+            return 200, [self.job_view(j) for j in self.jobs.values()]
+        if method == "GET" and path.startswith("/jobs/"):
+            job = self.jobs.get(path[len("/jobs/"):])
+            return (200, self.job_view(job)) if job else (404, {"error": "Unknown job"})
+        if method == "POST" and path == "/jobs":
+            try:
+                params = json.loads(body or b"{}")
+                job = self.submit(params)
+            except (ValueError, TypeError) as e:
+                return 400, {"error": str(e)}
+            except asyncio.QueueFull:
+                return 503, {"error": f"Queue full ({self.queue.maxsize} jobs). Retry later."}
+            if params.get("wait"):
+                await job["done"].wait()
+                return 200, self.job_view(job)
+            return 202, self.job_view(job)
+        return 404, {"error": f"No route for {method} {path}"}
+
+async def serve(host, port, unix_path, workers, queue_size):
+    service = OptimizationService(workers, queue_size)
+    tasks = [asyncio.create_task(service.worker()) for _ in range(workers)]
+    if unix_path:
+        server = await asyncio.start_unix_server(service.handle, path=unix_path)
+        where = unix_path
+    else:
+        server = await asyncio.start_server(service.handle, host, port)
+        where = f"http://{host}:{server.sockets[0].getsockname()[1]}"
+    print(f"🛰️ Optimization service on {where} ({workers} workers, queue {queue_size}). Data and caches are warm.")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in tasks: task.cancel()
+        service.executor.shutdown(wait=False)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Stage 3 as a long-running service with warm data and a job queue.")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--unix", default=None, help="Listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+    parser.add_argument("--queue-size", type=int, default=SERVICE_QUEUE_SIZE)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.queue_size))
+    except KeyboardInterrupt:
+        print("\n👋 Service stopped.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+# Offline road-graph backend: an OSM extract is parsed once into a directed CSR graph
+# (travel time + length per edge), cached next to the extract as a .csr.npz file, and
+# many-to-many travel times come from batched multi-source Dijkstra (scipy csgraph).
+
+# Free-flow speeds by OSM highway class when an edge has no usable maxspeed tag
+HIGHWAY_SPEEDS_KMH = {
+    "motorway": 100, "trunk": 80, "primary": 60, "secondary": 50, "tertiary": 40,
+    "motorway_link": 60, "trunk_link": 50, "primary_link": 40, "secondary_link": 35, "tertiary_link": 30,
+    "residential": 25, "living_street": 10, "service": 15, "unclassified": 30
+}
+DEFAULT_SPEED_KMH = 30.0
+ACCESS_SPEED_KMH = 15.0 # Stop -> nearest road node (the leg OSRM would also add when snapping)
+CACHE_SUFFIX = ".csr.npz"
+KM_PER_DEG = 111.32
+
+def graph_from_edges(lat, lon, u, v, length_m, speed_kmh):
+    """
+    Compact graph dict from plain arrays: node coordinates and directed edges u -> v.
+    Parallel edges keep the fastest one. Arrays are sorted by (u, v) so CSR rows are ordered.
+    """
+    u, v = np.asarray(u, dtype=np.int64), np.asarray(v, dtype=np.int64)
+    length_m = np.asarray(length_m, dtype=np.float64)
+    time_s = length_m / (np.asarray(speed_kmh, dtype=np.float64) / 3.6)
+
+    order = np.lexsort((time_s, v, u))
+    u, v, time_s, length_m = u[order], v[order], time_s[order], length_m[order]
+    keep = np.ones(len(u), dtype=bool)
+    keep[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    keep &= u != v
+    u, v, time_s, length_m = u[keep], v[keep], time_s[keep], length_m[keep]
+
+    indptr = np.zeros(len(lat) + 1, dtype=np.int64)
+    np.add.at(indptr, u + 1, 1)
+    return {"lat": np.asarray(lat, dtype=np.float64), "lon": np.asarray(lon, dtype=np.float64),
+            "indptr": np.cumsum(indptr), "indices": v, "time_s": time_s, "length_m": length_m}
+
+def _edge_speed(data):
+    """Speed (km/h) of one osmnx edge: numeric maxspeed, else the highway class default."""
+    maxspeed = data.get("maxspeed")
+    if isinstance(maxspeed, list): maxspeed = maxspeed[0]
+    try:
+        return float(str(maxspeed).split()[0])
+    except (TypeError, ValueError):
+        highway = data.get("highway")
+        if isinstance(highway, list): highway = highway[0]
+        return HIGHWAY_SPEEDS_KMH.get(highway, DEFAULT_SPEED_KMH)
+
+def graph_from_osm(path):
+    """Parses an OSM XML extract (.osm) or an osmnx .graphml file into a graph dict. Requires osmnx."""
+    try:
+        import osmnx as ox
+    except ImportError:
+        raise ImportError("osmnx is required to parse OSM extracts (pip install osmnx); "
+                          "a cached .csr.npz graph can be loaded without it.")
+    G = ox.load_graphml(path) if path.endswith(".graphml") else ox.graph_from_xml(path, simplify=True)
+    ids = {osm_id: i for i, osm_id in enumerate(G.nodes)}
+    lat = [data["y"] for _, data in G.nodes(data=True)]
+    lon = [data["x"] for _, data in G.nodes(data=True)]
+    u, v, length_m, speed = [], [], [], []
+    for a, b, data in G.edges(data=True):
+        u.append(ids[a]); v.append(ids[b])
+        length_m.append(float(data.get("length", 0.0)))
+        speed.append(_edge_speed(data))
+    return graph_from_edges(lat, lon, u, v, length_m, speed)
+
+def save_road_graph(path, graph):
+    np.savez(path, **graph)
+
+def load_road_graph(path, rebuild=False):
+    """
+    Loads a road graph. A .npz path is read directly; an OSM extract is parsed once and
+    cached as <path>.csr.npz (re-parsed when the extract is newer than the cache).
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    cache = path + CACHE_SUFFIX
+    if not rebuild and os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return load_road_graph(cache)
+    print(f"🗺️ Parsing road graph from {os.path.basename(path)} (cached afterwards)...")
+    graph = graph_from_osm(path)
+    save_road_graph(cache, graph)
+    print(f"✅ Road graph: {len(graph['lat'])} nodes, {len(graph['indices'])} edges -> {cache}")
+    return graph
+
+def snap_to_graph(graph, coords):
+    """Nearest road node for each (lat, lon) and the straight-line offset to it (km)."""
+    coords = np.asarray(coords, dtype=np.float64)
+    scale = np.cos(np.radians(graph["lat"].mean()))
+    tree = cKDTree(np.column_stack((graph["lat"], graph["lon"] * scale)) * KM_PER_DEG)
+    offset_km, nodes = tree.query(np.column_stack((coords[:, 0], coords[:, 1] * scale)) * KM_PER_DEG)
+    return nodes, offset_km
+
+def _csr(graph, weight):
+    n = len(graph["lat"])
+    return csr_matrix((graph[weight], graph["indices"], graph["indptr"]), shape=(n, n))
+
+def _tree_lengths(graph, pred):
+    """
+    Length (m) along each shortest-time tree for a (sources, nodes) predecessor array.
+    Pointer jumping: every pass doubles the path each node has summed, so log(depth) passes.
+    """
+    n = len(graph["lat"])
+    nodes = np.broadcast_to(np.arange(n), pred.shape)
+    has_pred = pred >= 0
+    parent = np.where(has_pred, pred, nodes)
+    # Length of the tree edge parent -> node, looked up in the (u, v)-sorted edge list
+    u = np.repeat(np.arange(n), np.diff(graph["indptr"]))
+    keys = u * n + graph["indices"]
+    pos = np.searchsorted(keys, parent.astype(np.int64) * n + nodes)
+    d = np.where(has_pred, graph["length_m"][np.minimum(pos, len(keys) - 1)], 0.0)
+    while True:
+        grand = np.take_along_axis(parent, parent, axis=1)
+        if np.array_equal(grand, parent): return d
+        d = d + np.take_along_axis(d, parent, axis=1)
+        parent = grand
+
+_WORKER_GRAPH = None
+
+def _init_worker(graph):
+    global _WORKER_GRAPH
+    _WORKER_GRAPH = graph
+
+def _solve_sources(sources, targets, graph=None):
+    """Travel time (s) and length (m) of the fastest path from each source to each target node."""
+    graph = graph if graph is not None else _WORKER_GRAPH
+    times, pred = dijkstra(_csr(graph, "time_s"), directed=True, indices=sources, return_predecessors=True)
+    return times[:, targets], _tree_lengths(graph, pred)[:, targets]
+
+def graph_matrix(graph, locations, workers=None, batch=16):
+    """
+    Many-to-many matrices over the road graph, same contract as create_distance_matrix:
+    (distance_matrix in km, duration_matrix in minutes) as numpy arrays.
+    Sources are solved in batches of `batch` across `workers` processes (default: all cores).
+    Pairs with no road connection fall back to distance.estimate_matrix (the detour model when one
+    is calibrated, else Haversine at 30 km/h).
+    """
+    from distance import estimate_matrix
+
+    nodes, offset_km = snap_to_graph(graph, locations)
+    unique_nodes, inverse = np.unique(nodes, return_inverse=True)
+    batches = [unique_nodes[i:i + batch] for i in range(0, len(unique_nodes), batch)]
+    workers = min(workers or os.cpu_count() or 1, len(batches))
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(graph,)) as pool:
+            parts = list(pool.map(_solve_sources, batches, [unique_nodes] * len(batches)))
+    else:
+        parts = [_solve_sources(b, unique_nodes, graph) for b in batches]
+    times = np.vstack([p[0] for p in parts])[inverse][:, inverse]
+    lengths = np.vstack([p[1] for p in parts])[inverse][:, inverse]
+
+    # Off-network legs at both ends (stop -> road node -> ... -> road node -> stop)
+    access_km = offset_km[:, None] + offset_km[None, :]
+    dist = lengths / 1000.0 + access_km
+    dur = times / 60.0 + access_km / ACCESS_SPEED_KMH * 60.0
+
+    unreachable = ~np.isfinite(times)
+    if unreachable.any():
+        est_dist, est_dur = estimate_matrix(locations, locations)
+        dist[unreachable] = np.asarray(est_dist)[unreachable]
+        dur[unreachable] = np.asarray(est_dur)[unreachable]
+        print(f"⚠️ Road graph: {int(unreachable.sum())} pairs not connected. Using Haversine/Estimates for them.")
+    np.fill_diagonal(dist, 0.0)
+    np.fill_diagonal(dur, 0.0)
+    return dist, dur
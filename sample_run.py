@@ -2,6 +2,7 @@ import pandas as pd
 import folium
 from distance import create_distance_matrix
 from optimizer import optimize_routes
+from time_windows import service_times, travel_time_matrix as build_travel_time_matrix
 import os
 
 def format_time(minutes):
@@ -50,23 +51,12 @@ def run_demo():
         else:
             time_windows.append((30, 135))
 
-    # Create distance matrix
+    # Create distance / duration matrices
     print("Calculating distance matrix...")
-    dist_matrix = create_distance_matrix(all_stops)
+    dist_matrix, dur_matrix = create_distance_matrix(all_stops)
     
-    # Create travel time matrix (assuming 30 km/h -> 2 mins per km)
-    # We add 2 mins for each stop for pickup time
-    speed_km_min = 30 / 60 
-    travel_time_matrix = []
-    for row in dist_matrix:
-        time_row = []
-        for d in row:
-            if d == 0:
-                time_row.append(0)
-            else:
-                # Travel time + 2 mins stop service time
-                time_row.append(int(d / speed_km_min) + 2)
-        travel_time_matrix.append(time_row)
+    # Travel time matrix (vectorized): drive time + 2 mins pickup service time at each stop
+    travel_time_matrix = build_travel_time_matrix(dur_matrix, service_times(demands, 2, 0))
     
     # Prepare capacities
     capacities = list(vehicles_df['capacity'])
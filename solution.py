@@ -0,0 +1,99 @@
+import numpy as np
+
+# Flat, array-backed VRP solution. All routes are concatenated into one set of step arrays;
+# route r owns steps offsets[r]:offsets[r + 1] (depot start ... depot end).
+#   nodes      int32   node index of each step
+#   cost       float64 cumulative arc cost at each step (cost units / 1000, the old cumulative_distance)
+#   arrival    float64 Time dimension cumul at each step (minutes), NaN when solved without time windows
+#   load       int32   passengers on board after each step
+# Per route: vehicle_ids (int32) and distance_meters (int64, total cost units).
+# Iterating yields the old {"vehicle_id", "route": [{"node", "cumulative_distance", "arrival_time"}], "distance_meters"}
+# dicts, so code written against the list-of-dicts routes keeps working unchanged.
+
+SOLUTION_ARRAYS = ("nodes", "offsets", "vehicle_ids", "distance_meters", "cost", "arrival", "load")
+
+class RouteSolution:
+    def __init__(self, nodes, offsets, vehicle_ids, distance_meters, cost, arrival=None, load=None):
+        self.nodes = np.asarray(nodes, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.vehicle_ids = np.asarray(vehicle_ids, dtype=np.int32)
+        self.distance_meters = np.asarray(distance_meters, dtype=np.int64)
+        self.cost = np.asarray(cost, dtype=np.float64)
+        self.arrival = np.full(len(self.nodes), np.nan) if arrival is None else np.asarray(arrival, dtype=np.float64)
+        self.load = np.zeros(len(self.nodes), dtype=np.int32) if load is None else np.asarray(load, dtype=np.int32)
+
+    @classmethod
+    def from_routes(cls, routes, demands=None):
+        """Builds the arrays from list-of-dicts routes (e.g. a plan loaded from JSON)."""
+        routes = list(routes)
+        steps = [step for r in routes for step in r['route']]
+        offsets = np.zeros(len(routes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(r['route']) for r in routes])
+        nodes = np.array([step['node'] for step in steps], dtype=np.int32)
+        solution = cls(nodes, offsets, [r['vehicle_id'] for r in routes], [r['distance_meters'] for r in routes],
+                       [step['cumulative_distance'] for step in steps],
+                       [step.get('arrival_time', np.nan) for step in steps])
+        if demands is not None: solution.set_loads(demands)
+        return solution
+
+    def set_loads(self, demands):
+        """Cumulative on-board load per step (vectorized over all routes at once)."""
+        picked = np.cumsum(np.asarray(demands, dtype=np.int64)[self.nodes])
+        before = np.concatenate([[0], picked])[self.offsets[:-1]]
+        self.load = (picked - np.repeat(before, np.diff(self.offsets))).astype(np.int32)
+
+    # --- Views ---
+    def __len__(self):
+        return len(self.vehicle_ids)
+
+    @property
+    def has_time(self):
+        return len(self.arrival) > 0 and not np.isnan(self.arrival).all()
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in SOLUTION_ARRAYS)
+
+    def route(self, r):
+        """Route r as array views (no copies): writing into them updates the solution."""
+        s = slice(self.offsets[r], self.offsets[r + 1])
+        return {"vehicle_id": int(self.vehicle_ids[r]), "nodes": self.nodes[s], "cost": self.cost[s],
+                "arrival": self.arrival[s], "load": self.load[s], "distance_meters": int(self.distance_meters[r])}
+
+    def route_dict(self, r):
+        """Route r in the old list-of-dicts shape (plain Python values, JSON-ready)."""
+        s = slice(self.offsets[r], self.offsets[r + 1])
+        nodes, cost, arrival = self.nodes[s].tolist(), self.cost[s].tolist(), self.arrival[s].tolist()
+        if self.has_time:
+            arrival = [int(a) if a.is_integer() else a for a in arrival] # solver cumuls stay ints, re-timed ETAs floats
+            steps = [{"node": n, "cumulative_distance": c, "arrival_time": a} for n, c, a in zip(nodes, cost, arrival)]
+        else:
+            steps = [{"node": n, "cumulative_distance": c} for n, c in zip(nodes, cost)]
+        return {"vehicle_id": int(self.vehicle_ids[r]), "route": steps, "distance_meters": int(self.distance_meters[r])}
+
+    def __getitem__(self, r):
+        if r < 0: r += len(self)
+        if not 0 <= r < len(self): raise IndexError("route index out of range")
+        return self.route_dict(r)
+
+    def __iter__(self):
+        for r in range(len(self)):
+            yield self.route_dict(r)
+
+    def to_routes(self):
+        return [self.route_dict(r) for r in range(len(self))]
+
+    def served_mask(self, n_nodes):
+        served = np.zeros(n_nodes, dtype=bool)
+        served[self.nodes] = True
+        return served
+
+    # --- Binary serialization ---
+    def save(self, path):
+        """Stores the arrays as one uncompressed .npz (loads back without any parsing)."""
+        np.savez(path, **{name: getattr(self, name) for name in SOLUTION_ARRAYS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in SOLUTION_ARRAYS})
@@ -0,0 +1,118 @@
+import time
+import numpy as np
+from optimizer import optimize_routes, summarize_progress
+from time_windows import travel_time_matrix
+
+# Time-dependent durations are stored as one stacked float32 array of shape (buckets, n, n):
+# stack[b] holds the drive times for departures at profile_start + b * bucket_min (clock minutes).
+# Between bucket starts the value is linearly interpolated; outside the profile it is clamped.
+
+def build_td_stack(dur_matrix, factors):
+    """Stack from one free-flow matrix and a duration multiplier per bucket (e.g. 1.0 off-peak, 1.5 at 7:00)."""
+    base = np.asarray(dur_matrix, dtype=np.float32)
+    return base[None, :, :] * np.asarray(factors, dtype=np.float32)[:, None, None]
+
+def bucket_weights(t_clock, profile_start_min, bucket_min, n_buckets):
+    """Vectorized: (lower bucket, upper bucket, weight of upper bucket) for departure clock times."""
+    pos = np.clip((np.asarray(t_clock, dtype=np.float64) - profile_start_min) / bucket_min, 0, n_buckets - 1)
+    b0 = np.floor(pos).astype(np.intp)
+    b1 = np.minimum(b0 + 1, n_buckets - 1)
+    return b0, b1, pos - b0
+
+def durations_at(stack, t_clock, profile_start_min, bucket_min):
+    """Full (n, n) duration matrix for a single departure time."""
+    b0, b1, w = bucket_weights(t_clock, profile_start_min, bucket_min, stack.shape[0])
+    return (1 - w) * stack[b0] + w * stack[b1]
+
+def departure_matrix(stack, depart_clock, profile_start_min, bucket_min):
+    """
+    (n, n) matrix where row i uses the durations for node i's own departure time.
+    This is how arc times follow the Time dimension: an arc costs what it costs when the bus leaves its origin.
+    """
+    n = stack.shape[1]
+    b0, b1, w = bucket_weights(depart_clock, profile_start_min, bucket_min, stack.shape[0])
+    rows = np.arange(n)
+    return (1 - w)[:, None] * stack[b0, rows] + w[:, None] * stack[b1, rows]
+
+def route_etas(nodes, stack, depart_clock, service, profile_start_min, bucket_min):
+    """Exact time-dependent arrival clock at each node of one route (O(route length))."""
+    t, etas = float(depart_clock), [float(depart_clock)]
+    for a, b in zip(nodes[:-1], nodes[1:]):
+        t += service[a]
+        b0, b1, w = bucket_weights(t, profile_start_min, bucket_min, stack.shape[0])
+        t += float((1 - w) * stack[b0, a, b] + w * stack[b1, a, b])
+        etas.append(t)
+    return etas
+
+def planned_departures(routes, depart, service, origin_min):
+    """Departure clock of every served stop (arrival + service) and of the depot (mean route start), written into depart."""
+    starts = routes.arrival[routes.offsets[:-1]]
+    inner = np.ones(len(routes.nodes), dtype=bool)
+    inner[routes.offsets[:-1]] = inner[routes.offsets[1:] - 1] = False
+    stops = routes.nodes[inner]
+    depart[stops] = origin_min + routes.arrival[inner] + np.asarray(service)[stops]
+    if len(starts): depart[0] = origin_min + float(np.mean(starts))
+    return depart
+
+def frozen_durations(routes, stack, service, origin_min, profile_start_min, bucket_min):
+    """(n, n) durations frozen at a solution's planned departures (nodes off the routes leave at the origin)."""
+    depart = planned_departures(routes, np.full(stack.shape[1], float(origin_min)), service, origin_min)
+    return departure_matrix(stack, depart, profile_start_min, bucket_min)
+
+def retime_routes(routes, stack, service, origin_min, profile_start_min, bucket_min):
+    """Exact time-dependent arrival times for every route of a RouteSolution, written in place."""
+    for r in range(len(routes)):
+        route = routes.route(r)
+        # The views write straight into the solution's arrival array
+        route["arrival"][:] = np.array(route_etas(route["nodes"], stack, origin_min + route["arrival"][0], service,
+                                                  profile_start_min, bucket_min)) - origin_min
+
+def late_stops(routes, time_windows, tolerance_min=0.5):
+    """
+    (route index, node, minutes late) for every stop and school arrival of a RouteSolution that is past
+    its window's latest time, e.g. after re-timing with route_etas (the solver only saw frozen arc times).
+    """
+    latest = np.array([l for _, l in time_windows], dtype=np.float64)
+    late = []
+    for r in range(len(routes)):
+        route = routes.route(r)
+        over = route["arrival"][1:] - latest[route["nodes"][1:]]
+        late += [(r, int(node), float(m)) for node, m in zip(route["nodes"][1:], over) if m > tolerance_min]
+    return late
+
+def solve_time_dependent(stack, demands, capacities, time_windows, service, origin_min, profile_start_min, bucket_min,
+                         iterations=2, time_limit_s=30, **solver_kwargs):
+    """
+    Time-dependent VRP by fixed-point iteration around optimize_routes:
+    1. Guess each node's departure (middle of its window) and freeze arc times at those departures.
+    2. Solve, read the planned departures back from the Time dimension, re-freeze, solve again.
+    3. Re-time the final routes exactly with route_etas so manifest ETAs follow the traffic profile.
+    time_limit_s is the budget of the whole call, shared by the iterations (at least 1 s each).
+    solver_kwargs are passed to optimize_routes (drop_penalty, return_progress...). The progress then holds the
+    solutions of every iteration (elapsed from the first one, 'iteration' per solution) and 'late_stops'
+    (late_stops after re-timing: objectives of different iterations are not comparable).
+    """
+    return_progress = solver_kwargs.get("return_progress")
+    share = max(1, int(time_limit_s) // iterations)
+    budgets = [max(1, int(time_limit_s) - share * (iterations - 1))] + [share] * (iterations - 1)
+    depart = origin_min + np.array([(e + l) / 2 for e, l in time_windows], dtype=np.float64)
+    solutions, started_at, last, elapsed = [], None, None, 0.0
+    for i, budget in enumerate(budgets):
+        t0 = time.perf_counter()
+        dur = departure_matrix(stack, depart, profile_start_min, bucket_min)
+        result = optimize_routes(dur, demands, capacities, time_windows, travel_time_matrix(dur, service), time_limit_s=budget, **solver_kwargs)
+        routes = result[0] if return_progress else result
+        if return_progress:
+            last = result[1]
+            started_at = started_at or last["started_at"]
+            solutions += [dict(sol, elapsed_s=round(elapsed + sol["elapsed_s"], 3), iteration=i + 1) for sol in last["solutions"]]
+        elapsed += time.perf_counter() - t0
+        depart = planned_departures(routes, depart, service, origin_min)
+
+    retime_routes(routes, stack, service, origin_min, profile_start_min, bucket_min)
+    if not return_progress: return routes
+    progress = summarize_progress({"started_at": started_at, "solutions": solutions}, time_limit_s)
+    progress["still_improving"] = last["still_improving"] # only the last iteration's search decides the routes
+    progress["iterations"] = iterations
+    progress["late_stops"] = late_stops(routes, time_windows)
+    return routes, progress
@@ -0,0 +1,36 @@
+import numpy as np
+
+def parse_clock(hhmm):
+    """'07:30' -> minutes after midnight."""
+    hours, minutes = str(hhmm).split(":")
+    return int(hours) * 60 + int(minutes)
+
+def format_clock(minutes):
+    """Minutes after midnight -> 'HH:MM'."""
+    minutes = int(round(minutes))
+    return f"{(minutes // 60) % 24:02d}:{minutes % 60:02d}"
+
+def service_times(demands, base_min, per_pax_min):
+    """Dwell time at each stop: base + per-passenger boarding time. Nodes without demand (depot) get 0."""
+    demands = np.asarray(demands, dtype=np.float64)
+    service = base_min + per_pax_min * demands
+    service[demands == 0] = 0.0
+    return service
+
+def travel_time_matrix(dur_matrix, service):
+    """
+    Integer transit times for the solver's Time dimension (vectorized).
+    Arc i -> j costs the service time at i plus the drive time, rounded up to whole minutes.
+    """
+    tt = np.ceil(np.asarray(dur_matrix, dtype=np.float64) + np.asarray(service, dtype=np.float64)[:, None]).astype(np.int64)
+    np.fill_diagonal(tt, 0)
+    return tt
+
+def unserved_nodes(routes, n_nodes, depot_idx=0):
+    """Nodes the solver dropped (disjunctions) - every node that appears on no route."""
+    if hasattr(routes, "served_mask"): # RouteSolution: one vectorized pass over the node array
+        served = routes.served_mask(n_nodes)
+        served[depot_idx] = True
+        return np.flatnonzero(~served).tolist()
+    served = {step['node'] for r in routes for step in r['route']}
+    return [n for n in range(n_nodes) if n != depot_idx and n not in served]